@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+
+Benchmark of the HLUT generation and evaluation with synthetic workbooks of scaling size.
+
+HLUT calibration and evaluation code, Copyright (c) 2025, CT-in-RT working group.
+
+This software (any code and/or associated documentation: the “Software”)
+is distributed under the terms of the MIT license (the “License”).
+Refer to the License for more details. You should have received a copy of
+the License along with the code. If not, see
+https://choosealicense.com/licenses/mit/.
+SPDX-License-Identifier: MIT
+
+EXAMPLE:
+    python benchmark.py --inserts 1 2 4 --tissues 1 10 100 --output_folder_name Benchmarks
+    python benchmark.py --inserts 1 2 4 --tissues 1 10 100 --baseline Benchmarks/benchmark_<date>.json
+
+"""
+
+from utils import benchmark
+import argparse
+import os
+import sys
+
+
+if __name__ == "__main__":
+
+    #################################################
+    # PARAMETER DEFINITION ##########################
+    #################################################
+
+    # Shipped example the synthetic workbooks are created from:
+    input_folder_name = 'Input_folder'
+    file_name = 'DataForCTCalibration_GammexAEDphantom_Siemens_goOpenPro_120kVp.xlsx'
+
+    # Data sizes: copies of every phantom insert and tabulated human tissue, and additional
+    # CT number columns. The lists are used element-wise, single values are used for all sizes.
+    inserts = [1, 2, 4, 8]
+    tissues = [1, 10, 100, 1000]
+    ctn_columns = [0]
+
+    #################################################
+    # Run script ####################################
+    #################################################
+
+    parser = argparse.ArgumentParser(description='Benchmark of the HLUT generation and evaluation tool.')
+    parser.add_argument('--input_folder_name', type=str, default=input_folder_name,
+                        help='Name of the input folder where the example excel file is located.')
+    parser.add_argument('--file_name', type=str, default=file_name,
+                        help='Name of the example excel file the synthetic workbooks are created from.')
+    parser.add_argument('--inserts', type=int, default=inserts, nargs='+',
+                        help='Number of copies of every phantom insert, per data size.')
+    parser.add_argument('--tissues', type=int, default=tissues, nargs='+',
+                        help='Number of copies of every tabulated human tissue, per data size.')
+    parser.add_argument('--ctn_columns', type=int, default=ctn_columns, nargs='+',
+                        help='Number of additional CT number columns, per data size.')
+    parser.add_argument('--output_parameter', type=str, default='SPR',
+                        help='Output parameter for the HLUT. Options: MD, RED, SPR.')
+    parser.add_argument('--recon_type', type=str, default='regular',
+                        help='Type of HLUT to create. Options: regular, DD.')
+    parser.add_argument('--e_prot', type=float, default=100,
+                        help='Initial energy of the proton beam (MeV).')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Number of runs per data size, the fastest time of each stage is kept.')
+    parser.add_argument('--no_report', action='store_true',
+                        help='Do not create the PDF report.')
+    parser.add_argument('--output_folder_name', type=str, default=None,
+                        help='Folder for the benchmark results (JSON, table and scaling plot).')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON file of a previous benchmark. Stages that got slower are reported and the '
+                             'script exits with status 1.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Relative increase of a stage time, compared with the baseline, that is reported.')
+    args = parser.parse_args()
+
+    # Use the lists element-wise, single values for all sizes:
+    lengths = {len(args.inserts), len(args.tissues), len(args.ctn_columns)} - {1}
+    if len(lengths) > 1:
+        raise ValueError('--inserts, --tissues and --ctn_columns must have the same number of values, '
+                         'or only one value (which will be used for all).')
+    n_sizes = max(lengths, default=1)
+    sizes = [(args.inserts[i % len(args.inserts)], args.tissues[i % len(args.tissues)],
+              args.ctn_columns[i % len(args.ctn_columns)]) for i in range(n_sizes)]
+
+    # Relative paths are interpreted relative to the location of this script:
+    base_folder = os.path.dirname(os.path.abspath(__file__))
+    output_folder_name = args.output_folder_name
+    if output_folder_name is not None:
+        output_folder_name = os.path.join(base_folder, output_folder_name)
+
+    result = benchmark.main(os.path.join(base_folder, args.input_folder_name, args.file_name), sizes,
+                            args.output_parameter, args.recon_type, args.e_prot, args.repeats, output_folder_name,
+                            not args.no_report, args.baseline, args.tolerance)
+
+    if len(result.get('regressions', [])) > 0:
+        sys.exit(1)
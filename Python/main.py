@@ -17,7 +17,7 @@ Read the README file for more details.
 
 """
 
-from utils import hlut_generation_and_evaluation, control_input
+from utils import hlut_generation_and_evaluation, control_input, batch_processing, report_queue
 import numpy as np
 
 
@@ -81,6 +81,64 @@ if __name__ == "__main__":
     #   Option 2 - multiple inputs: e_prot = [100, 100]
     e_prot = 100
 
+    # Batch mode:
+    # If True, every combination of file_name, output_parameter, recon_type and e_prot
+    # is run, distributed over 'workers' processes. file_name may contain wildcards.
+    # Without batch mode, the HLUT fit and the independent evaluation boxes of each HLUT
+    # are run concurrently in 'workers' processes.
+    # EXAMPLE:
+    #   batch = True
+    #   file_name = 'DataForCTCalibration_*.xlsx'
+    #   output_parameter = ['MD', 'RED', 'SPR']
+    batch = False
+    workers = 1
+
+    # Profiling:
+    # The wall and CPU time of every stage is written to trace.json in the output folder.
+    # The stages named in 'profile' are additionally profiled with 'profiler' (cProfile or
+    # pyinstrument), trace_memory = True records the peak memory of each stage (slower).
+    # With trace_memory or a profiled report, the PDF report is not created in the background.
+    # EXAMPLE:
+    #   profile = ['HLUT fit', 'Report']
+    profile = []
+    profiler = 'cProfile'
+    trace_memory = False
+
+    # Optional analyses of every HLUT:
+    # energies - proton energies (MeV) of an energy family of SPR HLUTs, which is written to
+    #            SPR_HLUT_family.txt (only for SPR). An empty list skips the analysis.
+    # EXAMPLE:
+    #   energies = [70, 100, 150, 200, 250]
+    energies = []
+    # ctn_sd - standard deviation (HU) of the mean CT numbers of the phantom inserts, one value or one
+    #          per insert. The uncertainty of the HLUTs is estimated from n_samples realizations of the
+    #          CT numbers and written to <output_parameter>_HLUT_uncertainty.txt. None skips the analysis.
+    # EXAMPLE:
+    #   ctn_sd = 2
+    ctn_sd = None
+    n_samples = 1000
+    seed = None
+    # crossvalidation - leave-one-out cross-validation of the HLUT accuracy, written to
+    #                   Eval_crossvalidation_<folds>.txt. Options: 'insert' (each phantom insert is
+    #                   held out), 'tissue' (each tabulated human tissue is held out) or None.
+    crossvalidation = None
+    # convert_volumes - CT volumes (.npy files or folders with a DICOM series) to be converted with the
+    #                   HLUT given by volume_hlut ('head', 'body' or 'avgdCT'). The results are written
+    #                   to <volume>_<output_parameter>_<HLUT>.npy. An empty list skips the analysis.
+    # EXAMPLE:
+    #   convert_volumes = ['Input_folder/patient_1.npy']
+    convert_volumes = []
+    volume_hlut = 'body'
+    # difference_volumes - CT volumes (.npy files or folders with a DICOM series) for the differences
+    #                      between the HLUTs, weighted with the voxels of the volumes. Only the voxels with
+    #                      CT numbers in difference_ctn_range (min, max) are included, None for all voxels.
+    #                      Written to Eval_HLUT_differences_volumes.txt. An empty list skips the analysis.
+    # EXAMPLE:
+    #   difference_volumes = ['Input_folder/patient_1.npy', 'Input_folder/patient_2.npy']
+    #   difference_ctn_range = [-950, 3000]
+    difference_volumes = []
+    difference_ctn_range = None
+
     #################################################
     # Run script ####################################
     #################################################
@@ -88,7 +146,11 @@ if __name__ == "__main__":
     # Parse command line arguments, if available:
     input_parameters = control_input.command_line_input(input_folder_name, 
                                             file_name, output_parameter, recon_type,
-                                            output_folder_name, e_prot)
+                                            output_folder_name, e_prot, batch, workers,
+                                            profile, profiler, trace_memory, energies,
+                                            ctn_sd, n_samples, seed, crossvalidation,
+                                            convert_volumes, volume_hlut, difference_volumes,
+                                            difference_ctn_range)
 
     # Run the HLUT generation and evaluation for each set of input parameters:
     note = "\n{}\n{} {}\n{}\n{}\n".format('###############################',
@@ -99,16 +161,27 @@ if __name__ == "__main__":
     print(note)
     del note
         
-    results = []
-    for i in np.arange(len(input_parameters.recon_type)):
-        print('\nRunning HLUT number {}/{}:'.format(i + 1, len(input_parameters.recon_type)))
-        results.append({'file_name': input_parameters.file_name[i],
-                        'output_parameter': input_parameters.output_parameter[i],
-                        'results': hlut_generation_and_evaluation.main(input_parameters.input_folder_name[i], 
-                                                input_parameters.file_name[i],
-                                                input_parameters.output_parameter[i], 
-                                                input_parameters.recon_type[i],
-                                                input_parameters.output_folder_name[i], 
-                                                input_parameters.e_prot[i])})
-
-    del i, input_parameters
\ No newline at end of file
+    if input_parameters.batch:
+        results = batch_processing.main(input_parameters)
+    else:
+        results = []
+        for i in np.arange(len(input_parameters.recon_type)):
+            print('\nRunning HLUT number {}/{}:'.format(i + 1, len(input_parameters.recon_type)))
+            results.append({'file_name': input_parameters.file_name[i],
+                            'output_parameter': input_parameters.output_parameter[i],
+                            'results': hlut_generation_and_evaluation.main(input_parameters.input_folder_name[i], 
+                                                    input_parameters.file_name[i],
+                                                    input_parameters.output_parameter[i], 
+                                                    input_parameters.recon_type[i],
+                                                    input_parameters.output_folder_name[i], 
+                                                    input_parameters.e_prot[i],
+                                                    input_parameters.workers,
+                                                    input_parameters.profile,
+                                                    input_parameters.trace_memory,
+                                                    input_parameters.analyses)})
+
+        del i
+
+        # Wait for the PDF reports, which are created in the background:
+        report_queue.wait_all()
+    del input_parameters
\ No newline at end of file
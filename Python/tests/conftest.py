@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures of the tests: the calibration and the HLUTs of the shipped example workbook
+
+% SPDX-License-Identifier: MIT
+"""
+
+import copy
+import os
+import sys
+
+import matplotlib
+import pytest
+
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import hlut_generation_and_evaluation
+from utils.calculation import initialize_data
+
+WORKBOOK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Input_folder',
+                        'DataForCTCalibration_GammexAEDphantom_Siemens_goOpenPro_120kVp.xlsx')
+
+
+@pytest.fixture(scope='session')
+def sheets():
+    return initialize_data.read_workbook(WORKBOOK)
+
+
+@pytest.fixture(scope='session')
+def calibration(sheets):
+    return hlut_generation_and_evaluation.calibrate(sheets, 'regular', 100)
+
+
+@pytest.fixture(scope='session')
+def results(calibration):
+    """ Results of the HLUT fit and evaluation per output parameter (not written to files) """
+    return {output_parameter: hlut_generation_and_evaluation.evaluate(copy.deepcopy(calibration), output_parameter,
+                                                                      'regular', export_tables=False)
+            for output_parameter in ['MD', 'RED', 'SPR']}
+
+
+@pytest.fixture(scope='session')
+def evaluated(results):
+    """ Datasheets with the fitted and evaluated HLUTs per output parameter """
+    return {output_parameter: result['datasheet'] for output_parameter, result in results.items()}
+
+
+@pytest.fixture
+def datasheet(evaluated):
+    """ Copy of the evaluated datasheets, which can be modified by a test """
+    return copy.deepcopy(evaluated)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Implementations of the k value fit, the HLUT fit and the accuracy metrics before they were
+batched and vectorized, kept as references for the tests
+
+% SPDX-License-Identifier: MIT
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+
+
+def k_value_formulas(datasheet, wi_mat, zi, ai):
+    """
+    Material parameters of the stoichiometric model (Eq. 9 and Eq. 10 in Schneider et al. 1996)
+    Input:  wi_mat, zi, ai - elemental composition parameters of the material
+    Output: z_tilde, z_tilde_w, z_hat, z_hat_w, ng, ng_w - material parameters
+    """
+
+    wi_w = datasheet['Data_water']['wi_w']
+    zi_w = datasheet['Data_water']['zi_w']
+    ai_w = datasheet['Data_water']['ai_w']
+
+    z_tilde = np.matmul(wi_mat, zi ** (3.62 + 1) / ai) / np.matmul(wi_mat, (zi / ai))
+    z_hat = np.matmul(wi_mat, zi ** (1.86 + 1) / ai) / np.matmul(wi_mat, (zi / ai))
+    ng = np.matmul(wi_mat, (zi / ai))
+
+    z_tilde_w = (np.matmul(wi_w, zi_w ** (3.62 + 1) / ai_w) / np.matmul(wi_w, (zi_w / ai_w)))
+    z_hat_w = (np.matmul(wi_w, zi_w ** (1.86 + 1) / ai_w) / np.matmul(wi_w, (zi_w / ai_w)))
+    ng_w = np.matmul(wi_w, (zi_w / ai_w))
+
+    return z_tilde, z_tilde_w, z_hat, z_hat_w, ng, ng_w
+
+
+def k_value_fit(datasheet, phantom, inserts):
+    """
+    K value fit with the bounded nonlinear least squares of scipy
+    Input:  datasheet - Dictionary containing data from excel sheets
+            phantom - column of the CT numbers
+            inserts - selection of the phantom inserts
+    Output: k_values - fitted k values
+    """
+
+    density_mat = np.array(datasheet['PhantomInserts']['Density (g/cm3)'])
+    zi = np.array(datasheet['ElementParameters']['Zi'])
+    ai = np.array(datasheet['ElementParameters']['Ai'])
+    ctn = np.array(datasheet['CTnumbers'][phantom])
+    wi_mat = np.array(pd.DataFrame(datasheet['PhantomInserts'], columns=datasheet['elements']))
+    rho_w = datasheet['Data_water']['rho_w']
+
+    z_tilde, z_tilde_w, z_hat, z_hat_w, ng, ng_w = k_value_formulas(datasheet, wi_mat[inserts, :], zi, ai)
+
+    def residuals(k):
+        mu = density_mat[inserts] * ng * (k[0] * z_tilde + k[1] * z_hat + k[2])
+        mu_w = rho_w * ng_w * (k[0] * z_tilde_w + k[1] * z_hat_w + k[2])
+        return ctn[inserts] - 1000 * (mu / mu_w - 1)
+
+    return least_squares(residuals, [10 ** (-5), 10 ** (-4), 0.5], bounds=[np.zeros(3), 10 * np.ones(3)],
+                         ftol=1e-8, xtol=1e-8, gtol=1e-8).x
+
+
+def ctn_calculation(datasheet, dataset, inserts, k):
+    """
+    CT numbers of the selected materials for a k set
+    """
+
+    density_mat = np.array(datasheet[dataset]['Density (g/cm3)'])
+    zi = np.array(datasheet['ElementParameters']['Zi'])
+    ai = np.array(datasheet['ElementParameters']['Ai'])
+    wi_mat = np.array(pd.DataFrame(datasheet[dataset], columns=datasheet['elements']))
+    rho_w = datasheet['Data_water']['rho_w']
+
+    z_tilde, z_tilde_w, z_hat, z_hat_w, ng, ng_w = k_value_formulas(datasheet, wi_mat[inserts, :], zi, ai)
+    mu = density_mat[inserts] * ng * (k[0] * z_tilde + k[1] * z_hat + k[2])
+    mu_w = rho_w * ng_w * (k[0] * z_tilde_w + k[1] * z_hat_w + k[2])
+
+    return 1000 * (mu / mu_w - 1)
+
+
+def hlut_fit(datasheet, phantom_ctn, tabul_ctn, par_phantom, par_tiss, par_air):
+    """
+    HLUT fit with lists per tissue group and np.polyfit
+    Input:  datasheet - Dictionary containing data from excel sheets
+            phantom_ctn, tabul_ctn - CT numbers of the phantom inserts and the tabulated human tissues
+            par_phantom, par_tiss, par_air - reference values
+    Output: cp_ctn, cp_par - connection points
+    """
+
+    ctn_tiss_fat, ctn_tiss_soft, ctn_tiss_bone = [], [], []
+    ctn_lung, ctn_fat, ctn_soft, ctn_bone = [], [], [], []
+    par_lung, par_fat, par_soft, par_bone = [], [], [], []
+    ctn_groups = {1: ctn_lung, 2: ctn_fat, 3: ctn_soft, 4: ctn_bone}
+    par_groups = {1: par_lung, 2: par_fat, 3: par_soft, 4: par_bone}
+
+    if not (datasheet['output_parameter'] == 'MD'):
+        for group, ctn, par in zip(datasheet['PhantomInserts']['Tissue group'], phantom_ctn, par_phantom):
+            ctn_groups[group].append(ctn)
+            par_groups[group].append(par)
+    tiss_groups = {2: ctn_tiss_fat, 3: ctn_tiss_soft, 4: ctn_tiss_bone}
+    for group, ctn, par in zip(datasheet['TabulatedHumanTissues']['Tissue group'], tabul_ctn, par_tiss):
+        ctn_groups[group].append(ctn)
+        par_groups[group].append(par)
+        if group in tiss_groups:
+            tiss_groups[group].append(ctn)
+
+    p_lung_soft = np.polyfit(ctn_lung + ctn_soft, par_lung + par_soft, 1)
+    p_fat = np.polyfit(ctn_fat, par_fat, 1)
+    p_bone = np.polyfit(ctn_bone, par_bone, 1)
+
+    cp_ctn_lung = [-1024, -999, -950, np.round(min(ctn_tiss_fat) - 60)]
+    cp_ctn_fat = [np.round(min(ctn_tiss_fat) - 40), -30]
+    cp_ctn_soft = [0, np.round(max(ctn_tiss_soft)) + 10]
+    if max(ctn_bone) > 2000:
+        cp_ctn_bone = [np.round(min(ctn_tiss_bone) + 50), np.ceil((max(ctn_bone) + 100) / 100) * 100]
+    else:
+        cp_ctn_bone = [np.round(min(ctn_tiss_bone) + 50), 2000]
+
+    cp_par_lung = [np.polyval(p_lung_soft, i) for i in cp_ctn_lung]
+    cp_par_fat = [np.polyval(p_fat, i) for i in cp_ctn_fat]
+    cp_par_soft = [np.polyval(p_lung_soft, i) for i in cp_ctn_soft]
+    cp_par_bone = [np.polyval(p_bone, i) for i in cp_ctn_bone]
+    cp_par_lung[0], cp_par_lung[1] = par_air, par_air
+
+    offs = 1 * 10 ** (-4)
+    if cp_par_lung[1] >= cp_par_lung[2]:
+        cp_ctn_lung[2] = math.ceil((cp_par_lung[1] + offs - p_lung_soft[1]) / p_lung_soft[0])
+        cp_par_lung[2] = np.polyval(p_lung_soft, cp_ctn_lung[2])
+    if cp_par_fat[-1] >= cp_par_soft[0]:
+        cp_ctn_fat[-1] = math.floor((cp_par_soft[0] - offs - p_fat[1]) / p_fat[0])
+        cp_par_fat[-1] = np.polyval(p_fat, cp_ctn_fat[-1])
+    if cp_par_soft[-1] >= cp_par_bone[0]:
+        cp_ctn_bone[0] = math.ceil((cp_par_soft[-1] + offs - p_bone[1]) / p_bone[0])
+        cp_par_bone[0] = np.polyval(p_bone, cp_ctn_bone[0])
+
+    return (np.array(cp_ctn_lung + cp_ctn_fat + cp_ctn_soft + cp_ctn_bone, dtype=float),
+            np.array(cp_par_lung + cp_par_fat + cp_par_soft + cp_par_bone, dtype=float))
+
+
+def group_metrics(difference, groups):
+    """
+    ME, MAE and RMSE of the differences per tissue group, one group after another
+    Input:  difference - differences of the materials
+            groups - tissue group of the materials
+    Output: Dictionary of the metrics per group ('all', 'lung', 'adipose', 'soft tissue', 'bone'),
+            NaN for groups without materials
+    """
+
+    difference, groups = np.asarray(difference, dtype=float), np.asarray(groups)
+    selections = {'all': np.ones(len(groups), dtype=bool), 'lung': groups == 1, 'adipose': groups == 2,
+                  'soft tissue': groups == 3, 'bone': groups == 4}
+    metrics = {'ME': {}, 'MAE': {}, 'RMSE': {}}
+    for group, selection in selections.items():
+        values = list(difference[selection])
+        if len(values) == 0:
+            for metric in metrics:
+                metrics[metric][group] = np.nan
+            continue
+        metrics['ME'][group] = sum(values) / len(values)
+        metrics['MAE'][group] = sum(abs(i) for i in values) / len(values)
+        metrics['RMSE'][group] = math.sqrt(sum(i ** 2 for i in values) / len(values))
+
+    return metrics
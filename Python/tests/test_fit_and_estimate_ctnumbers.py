@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the k value fit and the estimation of the CT numbers
+
+% SPDX-License-Identifier: MIT
+"""
+
+import itertools
+
+import numpy as np
+import pytest
+from scipy.optimize import minimize
+
+import reference_implementation
+from utils.calculation import fit_and_estimate_ctnumbers
+
+
+@pytest.mark.parametrize('recon_type', ['regular', 'DD'])
+def test_k_value_fit_matches_least_squares(calibration, recon_type):
+    # The CT numbers do not depend on the scale of the k values, the estimates are compared:
+    datasheet = calibration
+    selections = fit_and_estimate_ctnumbers.tissue_selections(datasheet['PhantomInserts'], recon_type)
+    tissues = fit_and_estimate_ctnumbers.tissue_selections(datasheet['TabulatedHumanTissues'], recon_type)
+    ctn = np.array(datasheet['CTnumbers'][fit_and_estimate_ctnumbers.CTN_COLUMNS], dtype=float)
+    k_values = fit_and_estimate_ctnumbers.k_value_fit_batch(datasheet, ctn, list(selections.values()))
+    ctn_calc = fit_and_estimate_ctnumbers.ctn_calculation_batch(datasheet, 'TabulatedHumanTissues', k_values)
+
+    for i, column in enumerate(fit_and_estimate_ctnumbers.CTN_COLUMNS):
+        for j, (name, inserts) in enumerate(selections.items()):
+            k_reference = reference_implementation.k_value_fit(datasheet, column, inserts)
+            expected = reference_implementation.ctn_calculation(datasheet, 'TabulatedHumanTissues', tissues[name],
+                                                                k_reference)
+            assert np.allclose(ctn_calc[i, j][tissues[name]], expected, rtol=0, atol=0.05)
+            assert np.allclose(k_values[i, j] / np.linalg.norm(k_values[i, j]),
+                               k_reference / np.linalg.norm(k_reference), rtol=0, atol=1e-3)
+
+
+def test_k_values_are_scaled_to_the_initial_guess(calibration):
+    ctn = np.array(calibration['CTnumbers']['CT number (Head)'], dtype=float)
+    k_values = fit_and_estimate_ctnumbers.k_value_fit_batch(calibration, ctn, [np.ones(len(ctn), dtype=bool)])
+    assert k_values.shape == (1, 1, 3)
+    assert np.isclose(np.linalg.norm(k_values), np.linalg.norm(fit_and_estimate_ctnumbers.K_SCALE))
+    assert np.all(k_values >= 0)
+
+
+def constrained_fit(a, b, c):
+    """ min |b - a k|^2 subject to c @ k = 1 and k >= 0, with a general solver """
+    return minimize(lambda k: np.sum((b - a @ k) ** 2), np.full(3, 1 / np.sum(c)), method='SLSQP',
+                    bounds=[(0, None)] * 3, constraints=[{'type': 'eq', 'fun': lambda k: c @ k - 1}],
+                    options={'ftol': 1e-14, 'maxiter': 1000}).x
+
+
+def test_k_value_solve_active_subset():
+    # Data from k with a negative second value (c @ k = 1), so that the bound k >= 0 is active:
+    rng = np.random.default_rng(3)
+    a = rng.uniform(0.5, 2.0, (12, 3))
+    c = np.array([1.0, 1.0, 1.0])
+    b = a @ np.array([0.5, -0.2, 0.7]) + rng.normal(scale=1e-3, size=12)
+
+    # The unconstrained solution with c @ k = 1 is not feasible:
+    kkt = np.block([[a.T @ a, c[:, np.newaxis]], [c[np.newaxis], np.zeros((1, 1))]])
+    assert np.linalg.solve(kkt, np.append(a.T @ b, 1))[1] < 0
+
+    masks = np.ones((1, 12), dtype=bool)
+    k = fit_and_estimate_ctnumbers.k_value_solve(a, b[np.newaxis], c, masks)[0, 0]
+    k = k / (c @ k)
+    assert k[1] == 0 and np.all(k >= 0)
+    expected = constrained_fit(a, b, c)
+    assert np.sum((b - a @ k) ** 2) <= np.sum((b - a @ expected) ** 2) + 1e-12
+    assert np.allclose(k, expected, atol=1e-6)
+
+
+def test_k_value_solve_masks_exclude_inserts():
+    rng = np.random.default_rng(4)
+    a = rng.uniform(0.5, 2.0, (10, 3))
+    c = np.array([0.5, 1.0, 2.0])
+    b = rng.uniform(0.5, 2.0, (2, 10))
+    masks = np.array([np.arange(10) < 6, np.arange(10) >= 3])
+
+    k_values = fit_and_estimate_ctnumbers.k_value_solve(a, b, c, masks)
+    for i, j in itertools.product(range(2), range(2)):
+        # Masked fit = fit of the selected inserts only (outliers outside of the mask do not matter):
+        b_outlier = np.where(masks[j], b[i], 1e6)
+        expected = fit_and_estimate_ctnumbers.k_value_solve(a[masks[j]], b[i:i + 1, masks[j]], c,
+                                                            np.ones((1, masks[j].sum()), dtype=bool))[0, 0]
+        assert np.allclose(k_values[i, j], expected)
+        assert np.allclose(fit_and_estimate_ctnumbers.k_value_solve(a, b_outlier[np.newaxis], c, masks[j:j + 1]),
+                           expected)
+
+
+def test_k_value_solve_without_feasible_solution_raises():
+    # No k >= 0 fulfils c @ k = 1 for negative water terms:
+    rng = np.random.default_rng(5)
+    with pytest.raises(ValueError):
+        fit_and_estimate_ctnumbers.k_value_solve(rng.uniform(size=(6, 3)), np.ones((1, 6)), -np.ones(3),
+                                                 np.ones((1, 6), dtype=bool))
+
+
+def test_main_matches_the_calibration_for_dd(sheets):
+    from utils import hlut_generation_and_evaluation
+
+    datasheet = hlut_generation_and_evaluation.calibrate(sheets, 'DD', 100)
+    assert set(datasheet['k_values']['head']) == {'soft', 'bone'}
+    bone = np.asarray(datasheet['TabulatedHumanTissues']['Tissue group']) == 4
+    k_bone = reference_implementation.k_value_fit(datasheet, 'CT number (Body)',
+                                                  np.asarray(datasheet['PhantomInserts']['Tissue group'] == 4))
+    expected = reference_implementation.ctn_calculation(datasheet, 'TabulatedHumanTissues', bone, k_bone)
+    # With DD, the estimates of the soft tissues come first, then those of the bones:
+    assert np.allclose(np.asarray(datasheet['TabulatedHumanTissues']['ctn_calc_body'])[-bone.sum():], expected,
+                       atol=0.05)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the HLUT fit
+
+% SPDX-License-Identifier: MIT
+"""
+
+import numpy as np
+import pytest
+
+import reference_implementation
+from utils.calculation import fit_and_plot_hluts
+from utils.calculation.fit_and_estimate_ctnumbers import CTN_COLUMNS, CTN_CALC_COLUMNS
+
+
+def ct_numbers(datasheet, i):
+    return (np.array(datasheet['CTnumbers'][CTN_COLUMNS[i]], dtype=float),
+            np.array(datasheet['TabulatedHumanTissues'][CTN_CALC_COLUMNS[i]], dtype=float))
+
+
+def subset(datasheet, phantom_keep, tabul_keep):
+    """ Datasheet with the selected materials only """
+    return {'PhantomInserts': datasheet['PhantomInserts'][phantom_keep].reset_index(drop=True),
+            'TabulatedHumanTissues': datasheet['TabulatedHumanTissues'][tabul_keep].reset_index(drop=True),
+            'output_parameter': datasheet['output_parameter']}
+
+
+@pytest.mark.parametrize('output_parameter', ['MD', 'RED', 'SPR'])
+def test_hlut_fit_batch_matches_polyfit(evaluated, output_parameter):
+    datasheet = evaluated[output_parameter]
+    par_values = fit_and_plot_hluts.reference_values(datasheet)
+    for i in range(len(CTN_COLUMNS)):
+        phantom_ctn, tabul_ctn = ct_numbers(datasheet, i)
+        cp_ctn, cp_par, notes = fit_and_plot_hluts.hlut_fit_batch(datasheet, phantom_ctn, tabul_ctn, par_values)
+        expected = reference_implementation.hlut_fit(datasheet, phantom_ctn, tabul_ctn, *par_values)
+        assert np.array_equal(cp_ctn[0], expected[0])
+        assert np.allclose(cp_par[0], expected[1], rtol=1e-10, atol=1e-12)
+
+
+@pytest.mark.parametrize('output_parameter', ['MD', 'SPR'])
+def test_hlut_fit_batch_masks_match_the_reduced_data(evaluated, output_parameter):
+    # Each data set of the batch leaves out other materials, the masked materials must not affect the fit:
+    datasheet = evaluated[output_parameter]
+    par_phantom, par_tiss, par_air = fit_and_plot_hluts.reference_values(datasheet)
+    phantom_ctn, tabul_ctn = ct_numbers(datasheet, 1)
+    n_phantom, n_tiss = len(phantom_ctn), len(tabul_ctn)
+    rng = np.random.default_rng(0)
+    phantom_keep = rng.uniform(size=(6, n_phantom)) > 0.3
+    tabul_keep = np.ones((6, n_tiss), dtype=bool)
+    tabul_keep[np.arange(6), rng.integers(0, n_tiss, 6)] = False
+    tabul_keep[:, np.asarray(datasheet['TabulatedHumanTissues']['Tissue group']) != 3] = True
+
+    cp_ctn, cp_par, notes = fit_and_plot_hluts.hlut_fit_batch(datasheet, phantom_ctn, tabul_ctn,
+                                                              (par_phantom, par_tiss, par_air),
+                                                              phantom_keep, tabul_keep)
+    assert cp_ctn.shape == cp_par.shape == (6, 10)
+    for j in range(6):
+        reduced = subset(datasheet, phantom_keep[j], tabul_keep[j])
+        expected = reference_implementation.hlut_fit(reduced, phantom_ctn[phantom_keep[j]],
+                                                     tabul_ctn[tabul_keep[j]], par_phantom[phantom_keep[j]],
+                                                     par_tiss[tabul_keep[j]], par_air)
+        assert np.array_equal(cp_ctn[j], expected[0])
+        assert np.allclose(cp_par[j], expected[1], rtol=1e-10, atol=1e-12)
+
+
+def test_hlut_fit_batch_broadcasts_the_ct_numbers(evaluated):
+    # A batch of CT numbers with a single set of masks and reference values:
+    datasheet = evaluated['RED']
+    par_values = fit_and_plot_hluts.reference_values(datasheet)
+    phantom_ctn, tabul_ctn = ct_numbers(datasheet, 0)
+    shifts = np.array([-5.0, 0.0, 5.0])[:, np.newaxis]
+    cp_ctn, cp_par, notes = fit_and_plot_hluts.hlut_fit_batch(datasheet, phantom_ctn + shifts, tabul_ctn + shifts,
+                                                              par_values)
+    assert set(notes) == {'air_lung', 'lung_adipose', 'adipose_soft', 'soft_bone'}
+    for j in range(3):
+        expected = reference_implementation.hlut_fit(datasheet, phantom_ctn + shifts[j], tabul_ctn + shifts[j],
+                                                     *par_values)
+        assert np.allclose(cp_par[j], expected[1], rtol=1e-10, atol=1e-12)
+
+
+def test_hlut_fit_batch_needs_tabulated_tissues_of_each_group(evaluated):
+    datasheet = evaluated['SPR']
+    phantom_ctn, tabul_ctn = ct_numbers(datasheet, 0)
+    tabul_keep = np.asarray(datasheet['TabulatedHumanTissues']['Tissue group']) != 4
+    with pytest.raises(ValueError, match='bone'):
+        fit_and_plot_hluts.hlut_fit_batch(datasheet, phantom_ctn, tabul_ctn,
+                                          fit_and_plot_hluts.reference_values(datasheet), tabul_keep=tabul_keep)
+
+
+def test_hlut_fit_batch_needs_two_points_per_line_without_missing_values(evaluated):
+    datasheet = evaluated['MD']
+    phantom_ctn, tabul_ctn = ct_numbers(datasheet, 0)
+    par_values = fit_and_plot_hluts.reference_values(datasheet)
+    groups = np.asarray(datasheet['TabulatedHumanTissues']['Tissue group'])
+
+    # The phantom inserts are not used for MD, a single tabulated bone tissue gives no straight line:
+    tabul_keep = (groups != 4) | (np.arange(len(groups)) == np.flatnonzero(groups == 4)[0])
+    with pytest.raises(ValueError, match='two materials of the bone'):
+        fit_and_plot_hluts.hlut_fit_batch(datasheet, phantom_ctn, tabul_ctn, par_values, tabul_keep=tabul_keep)
+
+    # Missing CT numbers of the selected materials:
+    tabul_ctn[np.flatnonzero(groups == 2)[0]] = np.nan
+    with pytest.raises(ValueError, match='adipose tissue group contain missing values'):
+        fit_and_plot_hluts.hlut_fit_batch(datasheet, phantom_ctn, tabul_ctn, par_values)
+
+    # Missing values of materials which are not used are ignored:
+    tabul_keep = np.arange(len(groups)) != np.flatnonzero(groups == 2)[0]
+    cp_ctn, cp_par, notes = fit_and_plot_hluts.hlut_fit_batch(datasheet, phantom_ctn, tabul_ctn, par_values,
+                                                              tabul_keep=tabul_keep)
+    assert np.isfinite(cp_par).all()
+
+
+def test_hlut_family_stage_matches_the_hluts_of_the_run(calibration):
+    from utils import hlut_generation_and_evaluation
+
+    # The calibration is done for 100 MeV, the measured SPR of the workbook is not given:
+    result = hlut_generation_and_evaluation.evaluate(calibration, 'SPR', 'regular', export_tables=False,
+                                                     analyses={'energies': [70, 100, 200]})
+    family = result['datasheet']['hlut_family']
+    assert list(family['energies']) == [70, 100, 200]
+    for hluttype, hlut in result['HLUTs'].items():
+        assert np.array_equal(family[hluttype]['ctn'][1], hlut['ctn'])
+        assert np.allclose(family[hluttype]['SPR'][1], hlut['SPR'], rtol=1e-12)
+        assert not np.allclose(family[hluttype]['SPR'][2], hlut['SPR'], rtol=1e-4)
+
+    # The family is only fitted for SPR:
+    result = hlut_generation_and_evaluation.evaluate(calibration, 'RED', 'regular', export_tables=False,
+                                                     analyses={'energies': [70]})
+    assert 'hlut_family' not in result['datasheet']
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the accuracy metrics of the HLUTs
+
+% SPDX-License-Identifier: MIT
+"""
+
+import numpy as np
+import pytest
+
+import reference_implementation
+from utils.evaluation import hlut_accuracy
+
+PARAMETERS = {'MD': 'Density (g/cm3)', 'RED': 'rhoe_calc', 'SPR': 'SPR_calc'}
+
+
+@pytest.mark.parametrize('output_parameter', ['MD', 'RED', 'SPR'])
+def test_accuracy_of_the_run_matches_the_metrics_per_group(evaluated, output_parameter):
+    # Differences of the tabulated human tissues, and of the phantom inserts except for MD:
+    datasheet = evaluated[output_parameter]
+    tissues = datasheet['TabulatedHumanTissues']
+    inserts = datasheet['PhantomInserts']
+    for hluttype in ['head', 'body']:
+        difference = 100 * (tissues[hluttype + '_fromHLUT'] - tissues[PARAMETERS[output_parameter]])
+        groups = tissues['Tissue group']
+        if output_parameter != 'MD':
+            phantom_par = 'SPR Measured' if output_parameter == 'SPR' and not np.isnan(
+                inserts['SPR Measured'][0]) else PARAMETERS[output_parameter]
+            difference = np.concatenate((100 * (inserts[hluttype + '_fromHLUT'] - inserts[phantom_par]), difference))
+            groups = np.concatenate((inserts['Tissue group'], groups))
+        # The metrics of the run are rounded to two decimals:
+        expected = reference_implementation.group_metrics(difference, groups)
+        for metric, values in expected.items():
+            for group, value in values.items():
+                assert np.isclose(datasheet['accuracy'][hluttype][metric][group], value, rtol=0, atol=0.005 + 1e-9)
+
+
+def test_grouped_metrics_for_a_batch():
+    rng = np.random.default_rng(0)
+    groups = np.array([1, 2, 2, 3, 3, 3, 4, 4])
+    difference = rng.normal(size=(5, 2, len(groups)))
+
+    metrics = hlut_accuracy.grouped_metrics(difference, groups)
+    assert metrics.shape == (5, 2, len(hlut_accuracy.METRICS), len(hlut_accuracy.GROUPS))
+    batch = hlut_accuracy.metrics_dict(metrics)
+    for i in range(5):
+        for j in range(2):
+            expected = reference_implementation.group_metrics(difference[i, j], groups)
+            single = hlut_accuracy.metrics_dict(hlut_accuracy.grouped_metrics(difference[i, j], groups))
+            for metric, values in expected.items():
+                for group, value in values.items():
+                    assert np.isclose(single[metric][group], value)
+                    assert np.isclose(batch[metric][group][i, j], value)
+
+
+def test_grouped_metrics_of_empty_groups_are_nan():
+    metrics = hlut_accuracy.metrics_dict(hlut_accuracy.grouped_metrics([1.0, -3.0], [3, 3]))
+    assert metrics['ME']['soft tissue'] == -1.0
+    assert metrics['MAE']['all'] == 2.0
+    assert np.isclose(metrics['RMSE']['all'], np.sqrt(5))
+    for group in ['lung', 'adipose', 'bone']:
+        assert all(np.isnan(metrics[metric][group]) for metric in hlut_accuracy.METRICS)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the cross-validation of the HLUT accuracy
+
+% SPDX-License-Identifier: MIT
+"""
+
+import numpy as np
+import pytest
+
+from utils.evaluation import hlut_crossvalidation
+
+
+def test_md_tissue_folds_skip_single_lung(datasheet):
+    # The example workbook has a single tabulated lung tissue, which is the only lung material for MD:
+    datasheet = hlut_crossvalidation.main(datasheet['MD'], 'regular', folds='tissue')
+    crossvalidation = datasheet['crossvalidation']
+    lung = np.asarray(datasheet['TabulatedHumanTissues']['Tissue group']) == 1
+
+    assert crossvalidation['skipped'] == list(datasheet['TabulatedHumanTissues']['Tissue name'][lung])
+    for hluttype in hlut_crossvalidation.HLUT_TYPES:
+        assert np.isnan(crossvalidation['predictions'][hluttype][lung]).all()
+        assert np.isfinite(crossvalidation['predictions'][hluttype][~lung]).all()
+        assert np.isnan(crossvalidation['accuracy'][hluttype]['MAE']['lung'])
+        assert np.isfinite(crossvalidation['accuracy'][hluttype]['MAE']['all'])
+
+
+@pytest.mark.parametrize('output_parameter', ['RED', 'SPR'])
+def test_tissue_folds_keep_lung_with_inserts(datasheet, output_parameter):
+    # The lung inserts are used in the HLUT fit, so the lung tissue can be held out:
+    datasheet = hlut_crossvalidation.main(datasheet[output_parameter], 'regular', folds='tissue')
+    assert datasheet['crossvalidation']['skipped'] == []
+    assert np.isfinite(datasheet['crossvalidation']['predictions']['body']).all()
+
+
+def test_single_tabulated_adipose_is_skipped(datasheet):
+    # Without the skip, the fold would have no tabulated adipose tissue and the HLUT fit would fail:
+    datasheet = datasheet['SPR']
+    tissues = datasheet['TabulatedHumanTissues']
+    adipose = np.flatnonzero(np.asarray(tissues['Tissue group']) == 2)
+    datasheet['TabulatedHumanTissues'] = tissues.drop(tissues.index[adipose[1:]]).reset_index(drop=True)
+
+    datasheet = hlut_crossvalidation.main(datasheet, 'regular', folds='tissue')
+    assert datasheet['crossvalidation']['skipped'] == [tissues['Tissue name'][adipose[0]]]
+    assert np.isnan(datasheet['crossvalidation']['accuracy']['head']['ME']['adipose'])
+
+
+def test_md_insert_folds_hold_out_all_inserts(datasheet):
+    # For MD, the phantom inserts only enter the k value fit:
+    datasheet = hlut_crossvalidation.main(datasheet['MD'], 'regular', folds='insert')
+    assert datasheet['crossvalidation']['skipped'] == []
+    assert np.isfinite(datasheet['crossvalidation']['predictions']['head']).all()
+
+
+@pytest.mark.parametrize('folds', ['insert', 'tissue'])
+def test_workers_give_the_same_predictions(evaluated, folds):
+    sequential = hlut_crossvalidation.main(dict(evaluated['MD']), 'regular', folds)['crossvalidation']
+    pool = hlut_crossvalidation.main(dict(evaluated['MD']), 'regular', folds, workers=2)['crossvalidation']
+    assert pool['skipped'] == sequential['skipped']
+    for hluttype in hlut_crossvalidation.HLUT_TYPES:
+        assert np.array_equal(pool['predictions'][hluttype], sequential['predictions'][hluttype], equal_nan=True)
+
+
+def test_crossvalidation_stage_of_the_evaluation(calibration, evaluated):
+    from utils import hlut_generation_and_evaluation
+
+    analyses = {'crossvalidation': 'tissue'}
+    stages = hlut_generation_and_evaluation.evaluation_stages('SPR', 'regular', analyses, workers=2)
+    assert stages['Cross-validation']['args'][-1] == 2
+
+    # The folds of the stage are run in worker processes with workers > 1, the result is the same as the sequential one:
+    expected = hlut_crossvalidation.main(dict(evaluated['SPR']), 'regular', 'tissue')['crossvalidation']
+    for workers in [1, 2]:
+        result = hlut_generation_and_evaluation.evaluate(calibration, 'SPR', 'regular', export_tables=False,
+                                                         workers=workers, analyses=analyses)
+        crossvalidation = result['datasheet']['crossvalidation']
+        assert crossvalidation['folds'] == 'tissue' and crossvalidation['skipped'] == expected['skipped']
+        for hluttype in hlut_crossvalidation.HLUT_TYPES:
+            assert np.array_equal(crossvalidation['predictions'][hluttype], expected['predictions'][hluttype],
+                                  equal_nan=True)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the compiled HLUT tables
+
+% SPDX-License-Identifier: MIT
+"""
+
+import numpy as np
+import pytest
+from scipy import interpolate
+
+from utils.calculation import hlut_table
+
+
+@pytest.fixture
+def hlut(evaluated):
+    datasheet = evaluated['SPR']
+    return (np.asarray(datasheet['HLUTs']['body']['ctn'], dtype=float),
+            np.asarray(datasheet['HLUTs']['body']['SPR'], dtype=float))
+
+
+def test_lookup_matches_interp1d(hlut):
+    # Before the compiled tables, the HLUTs were evaluated with scipy's interp1d:
+    table = hlut_table.compile_hlut(*hlut)
+    reference = interpolate.interp1d(*hlut)
+    rng = np.random.default_rng(0)
+    ctn = np.concatenate((rng.uniform(hlut[0][0], hlut[0][-1], 1000), hlut[0]))
+    assert np.allclose(hlut_table.lookup(table, ctn), reference(ctn), rtol=0, atol=1e-12)
+
+    integers = np.arange(hlut[0][0], hlut[0][-1] + 1).astype(np.int16)
+    assert np.allclose(hlut_table.lookup(table, integers), reference(integers), rtol=0, atol=1e-12)
+    assert hlut_table.lookup(table, np.zeros((2, 3), dtype=np.int16)).shape == (2, 3)
+
+
+def test_float32_tables(hlut):
+    table = hlut_table.compile_hlut(*hlut, dtype=np.float32)
+    ctn = np.array([-1000, -10.5, 0, 250.25, 1500])
+    par = hlut_table.lookup(table, ctn)
+    assert par.dtype == np.float32
+    assert np.allclose(par, np.interp(ctn, *hlut), rtol=1e-6)
+    with pytest.raises(ValueError):
+        hlut_table.compile_hlut(*hlut, dtype=np.int16)
+
+
+def test_out_of_range_policies(hlut):
+    cp_ctn, cp_par = hlut
+    ctn = np.array([cp_ctn[0] - 10, cp_ctn[0], 0.0, cp_ctn[-1], cp_ctn[-1] + 100, np.nan])
+    inside = np.interp(ctn[1:4], cp_ctn, cp_par)
+
+    table = hlut_table.compile_hlut(cp_ctn, cp_par)
+    with pytest.raises(ValueError):
+        hlut_table.lookup(table, ctn)
+    with pytest.raises(ValueError):
+        hlut_table.lookup(table, np.array([int(cp_ctn[-1]) + 1]))
+
+    # The error reports the number and the range of the CT numbers outside of the HLUT:
+    with pytest.raises(ValueError, match='^2 CT numbers between {} HU and {} HU'.format(ctn[0], ctn[4])):
+        hlut_table.lookup(table, ctn)
+    with pytest.raises(ValueError, match='^1 CT numbers between {0} HU and {0} HU'.format(ctn[4])):
+        hlut_table.lookup(table, ctn[1:])
+    above = np.array([0, cp_ctn[-1] + 5, cp_ctn[-1] + 20]).astype(np.int16)
+    with pytest.raises(ValueError, match='^2 CT numbers between {} HU and {} HU'.format(above[1], above[2])):
+        hlut_table.lookup(table, above)
+
+    clip = hlut_table.lookup(table, ctn, 'clip')
+    assert np.allclose(clip[:5], np.interp(ctn[:5], cp_ctn, cp_par))
+    assert np.isnan(clip[5])
+
+    nan = hlut_table.lookup(table, ctn, 'nan')
+    assert np.isnan(nan[[0, 4, 5]]).all()
+    assert np.allclose(nan[1:4], inside)
+
+    extrapolate = hlut_table.lookup(hlut_table.compile_hlut(cp_ctn, cp_par, out_of_range='extrapolate'), ctn)
+    slope_first = (cp_par[1] - cp_par[0]) / (cp_ctn[1] - cp_ctn[0])
+    slope_last = (cp_par[-1] - cp_par[-2]) / (cp_ctn[-1] - cp_ctn[-2])
+    assert np.isclose(extrapolate[0], cp_par[0] - 10 * slope_first)
+    assert np.isclose(extrapolate[4], cp_par[-1] + 100 * slope_last)
+    assert np.allclose(extrapolate[1:4], inside)
+
+    # The policy of the table is the default, an explicit policy overrides it:
+    assert np.isnan(hlut_table.lookup(hlut_table.compile_hlut(cp_ctn, cp_par, out_of_range='nan'), ctn[:1]))[0]
+    assert not np.isnan(hlut_table.lookup(hlut_table.compile_hlut(cp_ctn, cp_par, out_of_range='nan'), ctn[:1],
+                                          'clip'))[0]
+
+
+def test_integer_ct_numbers_out_of_range(hlut):
+    table = hlut_table.compile_hlut(*hlut)
+    ctn = np.array([-2000, -1024, 0, 5000], dtype=np.int32)
+    clip = hlut_table.lookup(table, ctn, 'clip')
+    assert clip[0] == table['values'][0] and clip[-1] == table['values'][-1]
+    assert np.isnan(hlut_table.lookup(table, ctn, 'nan')[[0, 3]]).all()
+
+
+def test_invalid_policy_and_unsorted_points(hlut):
+    with pytest.raises(ValueError):
+        hlut_table.compile_hlut(*hlut, out_of_range='wrap')
+    with pytest.raises(ValueError):
+        hlut_table.lookup(hlut_table.compile_hlut(*hlut), 0.0, 'wrap')
+
+    # The connection points are sorted when the table is compiled:
+    order = np.random.default_rng(1).permutation(len(hlut[0]))
+    table = hlut_table.compile_hlut(hlut[0][order], hlut[1][order])
+    assert np.array_equal(table['values'], hlut_table.compile_hlut(*hlut)['values'])
+
+
+def test_empty_lookup(hlut):
+    assert hlut_table.lookup(hlut_table.compile_hlut(*hlut), np.array([])).shape == (0,)
+
+
+def test_tables_of_the_run_are_kept_apart_from_the_hluts(results):
+    result = results['SPR']
+    assert all(set(hlut) == {'ctn', 'SPR'} for hlut in result['HLUTs'].values())
+    datasheet = result['datasheet']
+    assert set(datasheet['hlut_tables']) == {'head', 'body', 'avgdCT'}
+    assert hlut_table.hlut_evaluator(datasheet, 'body') is datasheet['hlut_tables']['body']
+
+    # Changed connection points are compiled again, without changing the tables of the run:
+    changed = dict(datasheet, HLUTs=dict(datasheet['HLUTs'], body={'ctn': [-1024, 0, 3000], 'SPR': [0, 1, 2.5]}))
+    table = hlut_table.hlut_evaluator(changed, 'body')
+    assert table is not datasheet['hlut_tables']['body']
+    assert np.isclose(hlut_table.lookup(table, 1500), 1.75)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the uncertainty of the HLUTs
+
+% SPDX-License-Identifier: MIT
+"""
+
+import numpy as np
+import pytest
+
+from utils.evaluation import hlut_uncertainty
+
+
+def test_interpolation_of_the_realizations_matches_numpy(evaluated):
+    datasheet = hlut_uncertainty.main(dict(evaluated['SPR']), 'regular', 5.0, n_samples=200, seed=0)
+    cp_ctn, cp_par = [datasheet['uncertainty']['samples']['body'][i] for i in ['ctn', 'SPR']]
+
+    # CT numbers inside and beyond the HLUTs, at the connection points and missing:
+    rng = np.random.default_rng(0)
+    ctn = rng.uniform(-1200, 3000, (len(cp_ctn), 50))
+    ctn[:, :cp_ctn.shape[1]] = cp_ctn
+    ctn[0, -1] = np.nan
+
+    expected = np.array([np.interp(ctn[j], cp_ctn[j], cp_par[j]) for j in range(len(ctn))])
+    assert np.allclose(hlut_uncertainty.interpolate_realizations(ctn, cp_ctn, cp_par), expected, rtol=0, atol=1e-12,
+                       equal_nan=True)
+
+
+def test_bands_are_reproducible_and_ordered(evaluated):
+    bands = [hlut_uncertainty.main(dict(evaluated['MD']), 'regular', 5.0, n_samples=100, seed=1, workers=workers)[
+        'uncertainty'] for workers in [1, 2]]
+    for hluttype in ['head', 'body']:
+        mae = bands[0]['accuracy'][hluttype]['MAE']['all']
+        assert np.allclose(mae, bands[1]['accuracy'][hluttype]['MAE']['all'])
+        assert np.all(np.diff(mae) >= 0)
+
+
+@pytest.mark.parametrize('ctn_sd', [[5.0, 5.0], np.ones((3, 2)), np.ones((1, 3))])
+def test_ctn_sd_of_the_wrong_shape_raises(evaluated, ctn_sd):
+    with pytest.raises(ValueError, match='standard deviation of the CT numbers'):
+        hlut_uncertainty.main(dict(evaluated['MD']), 'regular', ctn_sd, n_samples=10, seed=0)
+
+
+def test_ctn_sd_per_insert_and_phantom(evaluated):
+    n_inserts = len(evaluated['MD']['CTnumbers'])
+    for ctn_sd in [np.full(n_inserts, 5.0), np.full((n_inserts, 2), 5.0)]:
+        datasheet = hlut_uncertainty.main(dict(evaluated['MD']), 'regular', ctn_sd, n_samples=10, seed=0)
+        assert datasheet['uncertainty']['n_samples'] == 10
+
+
+def test_uncertainty_stage_of_the_evaluation(calibration, evaluated):
+    from utils import hlut_generation_and_evaluation
+
+    analyses = {'ctn_sd': [5.0], 'n_samples': 50, 'seed': 2}
+    stages = hlut_generation_and_evaluation.evaluation_stages('RED', 'regular', analyses, workers=3)
+    assert stages['HLUT uncertainty']['args'][-1] == 3
+    stage = [hlut_generation_and_evaluation.evaluate(calibration, 'RED', 'regular', export_tables=False,
+                                                     workers=workers, analyses=analyses)['datasheet']['uncertainty']
+             for workers in [1, 3]]
+    expected = hlut_uncertainty.main(dict(evaluated['RED']), 'regular', [5.0], n_samples=50, seed=2)['uncertainty']
+    for uncertainty in stage:
+        assert uncertainty['n_samples'] == 50
+        for hluttype, bands in expected['HLUTs'].items():
+            assert np.array_equal(uncertainty['HLUTs'][hluttype]['RED'], bands['RED'])
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the differences between the HLUTs on CT volumes
+
+% SPDX-License-Identifier: MIT
+"""
+
+import itertools
+
+import numpy as np
+
+from utils.calculation import hlut_table
+from utils.evaluation import hlut_volume_differences
+
+
+def test_volume_differences_stage_of_the_evaluation(tmp_path, calibration):
+    from utils import hlut_generation_and_evaluation
+
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(2):
+        paths.append(str(tmp_path / 'patient_{}.npy'.format(i)))
+        np.save(paths[-1], rng.integers(-1024, 2000, (10, 8, 8)).astype(np.int16))
+
+    result = hlut_generation_and_evaluation.evaluate(calibration, 'SPR', 'regular', export_tables=False, workers=2,
+                                                     analyses={'difference_volumes': paths,
+                                                               'difference_ctn_range': [-950, 3000]})
+    differences = result['datasheet']['volume_differences']
+    assert differences['volumes'] == paths and differences['ctn_range'] == [-950, 3000]
+
+    # The histograms count all voxels, the statistics only the voxels in the CT number range:
+    voxels = [np.load(path) for path in paths]
+    total = hlut_volume_differences.combine_histograms(differences['histograms'])
+    assert total['counts'].sum() == sum(i.size for i in voxels)
+    assert total['offset'] == min(i.min() for i in voxels)
+    for volume, statistics in zip(voxels, differences['statistics']):
+        assert statistics['head - body']['voxels'] == np.count_nonzero(volume >= -950)
+    assert differences['total']['body - avgdCT']['voxels'] == sum(np.count_nonzero(i >= -950) for i in voxels)
+
+    # The statistics from the histograms match the statistics of the differences of every voxel:
+    tables = {i: hlut_table.hlut_evaluator(result['datasheet'], i) for i in ['head', 'body', 'avgdCT']}
+    volumes = voxels + [np.concatenate(voxels)]
+    for volume, statistics in zip(volumes, differences['statistics'] + [differences['total']]):
+        ctn = volume[volume >= -950]
+        par = {i: hlut_table.lookup(tables[i], ctn, 'clip').astype(np.float64) for i in tables}
+        for a, b in itertools.combinations(tables, 2):
+            difference = 100 * (par[a] - par[b])
+            absolute = np.abs(difference)
+            expected = {'ME': difference.mean(), 'MAE': absolute.mean(), 'RMSE': np.sqrt(np.mean(difference ** 2)),
+                        'P95': np.percentile(absolute, 95, method='inverted_cdf'), 'max': absolute.max()}
+            for metric, value in expected.items():
+                assert np.isclose(statistics['{} - {}'.format(a, b)][metric], value, rtol=1e-9, atol=1e-12)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the timing and profiling of the stages
+
+% SPDX-License-Identifier: MIT
+"""
+
+import threading
+import tracemalloc
+
+from utils import profiling
+
+
+def test_background_stages_do_not_change_the_tracing_of_the_main_thread():
+    trace = profiling.new_trace(memory=True, profile=['Main', 'Background'])
+    background = profiling.new_trace(memory=True, profile=['Background'])
+
+    def run_background():
+        with profiling.stage(background, 'Background'):
+            sum(range(1000))
+
+    with profiling.stage(trace, 'Main'):
+        data = [0] * 1000000
+        thread = threading.Thread(target=run_background, name='report_0')
+        thread.start()
+        thread.join()
+        assert tracemalloc.is_tracing()
+    del data
+
+    assert not tracemalloc.is_tracing()
+    main_record = trace['stages'][0]
+    assert main_record['peak_memory_mb'] >= 8 and main_record['profile'] is None
+    background_record = background['stages'][0]
+    assert background_record['thread'] == 'report_0'
+    assert 'peak_memory_mb' not in background_record and 'profile' not in background_record
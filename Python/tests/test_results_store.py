@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the results store
+
+% SPDX-License-Identifier: MIT
+"""
+
+import os
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from utils import results_store
+from conftest import WORKBOOK
+
+
+@pytest.fixture
+def store(tmp_path, results):
+    """ Store with the MD and SPR runs of the example workbook on two dates, and one run of another scanner """
+    store = str(tmp_path / results_store.STORE_NAME)
+    run_ids = {}
+    for date in [datetime(2024, 1, 10, 8), datetime(2024, 6, 10, 8)]:
+        for output_parameter in ['MD', 'SPR']:
+            run_ids[date.month, output_parameter] = results_store.record_run(
+                store, results[output_parameter], WORKBOOK, 'hash', 'regular', 100, output='Results', date=date)
+    run_ids['other'] = results_store.record_run(store, results['SPR'], WORKBOOK, 'hash', 'regular', 150,
+                                                date=datetime(2024, 3, 1), scanner='GE_Revolution', protocol=None)
+    return store, run_ids
+
+
+def test_runs(store):
+    store, run_ids = store
+    runs = results_store.query_runs(store)
+    assert list(runs['run_id']) == [run_ids[1, 'MD'], run_ids[1, 'SPR'], run_ids['other'], run_ids[6, 'MD'],
+                                    run_ids[6, 'SPR']]
+    run = runs.set_index('run_id').loc[run_ids[1, 'SPR']]
+    assert (run['phantom'], run['scanner'], run['protocol']) == ('GammexAED', 'Siemens_goOpenPro', '120kVp')
+    assert (run['file_name'], run['date'], run['e_prot']) == (os.path.basename(WORKBOOK), '2024-01-10T08:00:00', 100)
+    # The proton energy is only recorded for SPR, the info replaces the values from the file name (if not None):
+    assert np.isnan(runs.set_index('run_id').loc[run_ids[1, 'MD'], 'e_prot'])
+    other = runs.set_index('run_id').loc[run_ids['other']]
+    assert (other['scanner'], other['protocol'], other['e_prot']) == ('GE_Revolution', '120kVp', 150)
+
+
+def test_filters(store):
+    store, run_ids = store
+    assert list(results_store.query_runs(store, scanner='GE_Revolution')['run_id']) == [run_ids['other']]
+    assert len(results_store.query_runs(store, scanner=['GE_Revolution', 'Siemens_goOpenPro'])) == 5
+    assert list(results_store.query_runs(store, '2024-02-01', datetime(2024, 6, 10, 8), output_parameter='MD')[
+        'run_id']) == [run_ids[6, 'MD']]
+    assert len(results_store.query_runs(store, scanner=None)) == 5
+    with pytest.raises(ValueError):
+        results_store.query_runs(store, file_name='x')
+
+
+def test_history_round_trip(store, results):
+    store, run_ids = store
+    result = results['SPR']
+
+    points = results_store.history(store, 'hlut_points', output_parameter='SPR', start='2024-06-01')
+    assert set(points['run_id']) == {run_ids[6, 'SPR']}
+    for hluttype, hlut in result['HLUTs'].items():
+        rows = points[points['hluttype'] == hluttype].sort_values('point')
+        assert np.array_equal(rows['ctn'], np.asarray(hlut['ctn'], dtype=float))
+        assert np.array_equal(rows['value'], np.asarray(hlut['SPR'], dtype=float))
+
+    accuracy = results_store.history(store, 'accuracy', columns=['hluttype', 'metric', 'tissue_group', 'value'],
+                                     run_columns=False, output_parameter='SPR', end='2024-02-01')
+    assert list(accuracy.columns) == ['run_id', 'hluttype', 'metric', 'tissue_group', 'value']
+    for row in accuracy.itertuples():
+        expected = result['accuracy'][row.hluttype][row.metric][row.tissue_group]
+        assert np.isclose(row.value, expected, equal_nan=True)
+
+    k_values = results_store.history(store, 'k_values', output_parameter='MD')
+    assert len(k_values) == 2 * len(results['MD']['k_values'])
+    row = k_values.iloc[0]
+    assert np.allclose(row[['k1', 'k2', 'k3']].to_numpy(dtype=float),
+                       results['MD']['k_values'][row['hluttype']][row['selection']])
+
+    ctn = results_store.history(store, 'ct_numbers', output_parameter='MD', end='2024-02-01')
+    body = ctn[ctn['phantom_size'] == 'body'].sort_values('insert_index')
+    assert np.allclose(body['value'], results['MD']['datasheet']['CTnumbers']['CT number (Body)'], equal_nan=True)
+    assert (body['scanner'] == 'Siemens_goOpenPro').all()
+
+
+def test_evaluation_tables_and_invalid_table(store, results):
+    store, run_ids = store
+    tables = results_store.history(store, 'evaluation_tables', output_parameter='SPR', scanner='GE_Revolution')
+    assert dict(zip(tables['name'], tables['rows'])) == results['SPR']['tables']
+    with pytest.raises(ValueError):
+        results_store.history(store, 'runs')
+
+
+def test_missing_values_are_stored_as_null():
+    assert results_store.none_if_nan(np.nan) is None
+    assert results_store.none_if_nan(np.float32(1.5)) == 1.5
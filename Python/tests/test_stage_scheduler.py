@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the scheduling of the stages
+
+% SPDX-License-Identifier: MIT
+"""
+
+import copy
+import os
+import time
+
+import pandas as pd
+import pytest
+
+from utils import profiling, stage_scheduler
+
+
+# Stage functions (module level, so that they can be run in the worker processes):
+def add_column(datasheet, name, value):
+    datasheet['sheet'][name] = datasheet['sheet']['x'] * value
+
+
+def sum_columns(datasheet, names, key):
+    time.sleep(0.05)
+    datasheet[key] = float(sum(datasheet['sheet'][name].sum() for name in names))
+
+
+def add_table(datasheet, name):
+    datasheet['tables'][name] = [os.getpid(), datasheet['total']]
+
+
+def skip_table(datasheet, name):
+    pass
+
+
+def plot(datasheet, name):
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure()
+    datasheet['figure_sink'](name, fig)
+    datasheet['plotted'] = True
+
+
+def write_files(datasheet, name, count):
+    time.sleep(0.05)
+    for i in range(count):
+        file_name = os.path.join(datasheet['output'], '{}_{}.txt'.format(name, i))
+        with open(file_name, 'w') as f:
+            f.write(name)
+        profiling.record_file(datasheet, file_name)
+    datasheet[name] = count
+
+
+def stage(function, args, reads, writes):
+    return {'function': function, 'args': args, 'reads': reads, 'writes': writes}
+
+
+STAGES = {
+    'double': stage(add_column, ('double', 2), [('sheet', 'x')], [('sheet', 'double')]),
+    'triple': stage(add_column, ('triple', 3), [('sheet', 'x')], [('sheet', 'triple')]),
+    'total': stage(sum_columns, (['double', 'triple'], 'total'), [('sheet', 'double'), ('sheet', 'triple')],
+                   ['total']),
+    'table': stage(add_table, ('first',), ['total'], [('tables', 'first')]),
+    'skipped': stage(skip_table, ('second',), [], [('tables', 'second')]),
+    'plot': stage(plot, ('figure',), [('sheet', 'x')], ['plotted']),
+}
+
+
+def new_datasheet(figures):
+    return {'sheet': pd.DataFrame({'x': [1.0, 2.0, 3.0]}), 'tables': {}, 'output_parameter': 'SPR', 'output': None,
+            'figure_sink': lambda name, fig: figures.append(name)}
+
+
+def test_stage_dependencies():
+    dependencies = stage_scheduler.stage_dependencies(STAGES)
+    assert dependencies == {'double': set(), 'triple': set(), 'total': {'double', 'triple'}, 'table': {'total'},
+                            'skipped': set(), 'plot': set()}
+
+    # A stage that writes an item waits for the earlier stages that read or write it:
+    stages = dict(STAGES, overwrite=stage(add_column, ('double', 4), [('sheet', 'x')], [('sheet', 'double')]))
+    assert stage_scheduler.stage_dependencies(stages)['overwrite'] == {'double', 'total'}
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_run_stages_merges_the_written_items(workers):
+    figures = []
+    trace = profiling.new_trace()
+    datasheet = stage_scheduler.run_stages(new_datasheet(figures), STAGES, workers, trace)
+
+    assert list(datasheet['sheet']['double']) == [2.0, 4.0, 6.0]
+    assert list(datasheet['sheet']['triple']) == [3.0, 6.0, 9.0]
+    assert datasheet['total'] == 30.0
+    assert datasheet['tables']['first'][1] == 30.0
+    assert 'second' not in datasheet['tables']
+    assert datasheet['plotted'] and figures == ['figure']
+    assert sorted(record['stage'] for record in trace['stages']) == sorted(STAGES)
+    if workers > 1:
+        assert datasheet['tables']['first'][0] != os.getpid()
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_records_count_the_files_of_their_stage(tmp_path, workers):
+    # The stages write to the same output folder at the same time:
+    stages = {name: stage(write_files, (name, count), [], [name]) for name, count in [('one', 1), ('two', 2),
+                                                                                       ('three', 3)]}
+    trace = profiling.new_trace()
+    datasheet = stage_scheduler.run_stages({'output_parameter': 'SPR', 'output': str(tmp_path)}, stages, workers,
+                                           trace)
+
+    assert len(os.listdir(tmp_path)) == 6 and 'written_files' not in datasheet
+    assert {record['stage']: record['files'] for record in trace['stages']} == {'one': 1, 'two': 2, 'three': 3}
+
+
+def test_sequential_and_concurrent_evaluation_give_the_same_results(calibration):
+    from utils import hlut_generation_and_evaluation
+
+    results = [hlut_generation_and_evaluation.evaluate(copy.deepcopy(calibration), 'SPR', 'regular',
+                                                       export_tables=False, workers=workers)
+               for workers in [1, 3]]
+    assert results[0]['accuracy'] == results[1]['accuracy']
+    assert results[0]['tables'] == results[1]['tables']
+    for hluttype, hlut in results[0]['HLUTs'].items():
+        assert list(hlut['ctn']) == list(results[1]['HLUTs'][hluttype]['ctn'])
+        assert list(hlut['SPR']) == list(results[1]['HLUTs'][hluttype]['SPR'])
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the trend analysis of the calibrations
+
+% SPDX-License-Identifier: MIT
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import trend_analysis
+
+
+def test_tolerances_are_completed_with_the_defaults():
+    tolerances = trend_analysis.check_tolerances({'hlut_deviation': 0.5})
+    assert tolerances == dict(trend_analysis.TOLERANCES, hlut_deviation=0.5)
+    assert trend_analysis.check_tolerances() == trend_analysis.TOLERANCES
+
+
+@pytest.mark.parametrize('tolerances', [{'hlut': 1.0}, {'MAE': -1.0}, {'ctn': np.nan}])
+def test_invalid_tolerances(tolerances):
+    with pytest.raises(ValueError):
+        trend_analysis.check_tolerances(tolerances)
+
+
+def test_ctn_tolerance_is_the_larger_of_absolute_and_relative():
+    tolerances = trend_analysis.check_tolerances({'ctn': 20, 'ctn_relative': 0.05})
+    assert np.array_equal(trend_analysis.ctn_tolerance(np.array([-1000, -50, 0, 200, 1200]), tolerances),
+                          [50, 20, 20, 20, 60])
+
+
+def test_drift_rates_match_polyfit_per_series():
+    # Two series with missing values, and a series with a single run:
+    rng = np.random.default_rng(0)
+    dates = pd.to_datetime('2022-01-01') + pd.to_timedelta(np.sort(rng.uniform(0, 900, 25)), unit='D')
+    frame = pd.DataFrame({'date': dates, 'series': rng.integers(0, 2, 25), 'insert': 'bone',
+                          'value': 0.5 + 0.01 * rng.normal(size=25), 'drift': rng.normal(size=25)})
+    frame.loc[[3, 7], 'value'] = np.nan
+    frame = pd.concat((frame, pd.DataFrame({'date': [dates[5]], 'series': [2], 'insert': ['bone'], 'value': [1.0],
+                                            'drift': [0.0]})), ignore_index=True)
+
+    rates = trend_analysis.drift_rates(frame, ['series', 'insert'], ['value', 'drift']).set_index('series')
+    years = (frame['date'] - frame['date'].min()).dt.total_seconds() / (365.25 * 24 * 3600)
+    for series in [0, 1]:
+        selection = frame['series'] == series
+        assert rates.loc[series, 'runs'] == selection.sum()
+        assert rates.loc[series, 'first'] == frame.loc[selection, 'date'].min()
+        for column in ['value', 'drift']:
+            valid = selection & frame[column].notna()
+            expected = np.polyfit(years[valid], frame.loc[valid, column], 1)[0]
+            assert np.isclose(rates.loc[series, column + '_per_year'], expected, rtol=1e-9, atol=1e-12)
+    assert np.isnan(rates.loc[2, ['value_per_year', 'drift_per_year']].to_numpy(dtype=float)).all()
+    assert rates.loc[2, 'runs'] == 1
+
+
+def test_drift_rate_of_a_linear_trend():
+    dates = pd.to_datetime(['2020-01-01', '2021-01-01', '2022-01-01', '2023-01-01'])
+    years = (dates - dates[0]).total_seconds() / (365.25 * 24 * 3600)
+    frame = pd.DataFrame({'date': dates, 'series': 0, 'value': 10 - 3.0 * years})
+    assert np.isclose(trend_analysis.drift_rates(frame, ['series'], ['value'])['value_per_year'][0], -3.0)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the conversion of CT volumes
+
+% SPDX-License-Identifier: MIT
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from utils import control_input
+from utils.calculation import hlut_table
+from utils.calculation import initialize_data
+
+
+def test_volume_conversion_stage_of_the_evaluation(tmp_path, calibration):
+    from utils import hlut_generation_and_evaluation
+
+    ctn = np.random.default_rng(0).integers(-1024, 2000, (20, 8, 8)).astype(np.int16)
+    np.save(tmp_path / 'patient.npy', ctn)
+    output = initialize_data.create_output_folder(str(tmp_path), 'RED')
+    result = hlut_generation_and_evaluation.evaluate(calibration, 'RED', 'regular', output, export_tables=False,
+                                                     analyses={'convert_volumes': [str(tmp_path / 'patient.npy')],
+                                                               'volume_hlut': 'head'})
+
+    hlut = result['HLUTs']['head']
+    converted = np.load(os.path.join(output, 'patient_RED_head.npy'))
+    table = hlut_table.compile_hlut(hlut['ctn'], hlut['RED'])
+    assert np.array_equal(converted, hlut_table.lookup(table, ctn, 'clip'))
+
+
+def test_volumes_are_checked(tmp_path):
+    with pytest.raises(ValueError):
+        control_input.check_analyses({'convert_volumes': [str(tmp_path / 'missing.npy')]})
+    with pytest.raises(ValueError):
+        control_input.check_analyses({'convert_volumes': [str(tmp_path)], 'volume_hlut': 'thorax'})
+    control_input.check_analyses({'convert_volumes': [str(tmp_path)], 'volume_hlut': 'avgdCT'})
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+
+Constancy checks of the HLUT calibrations: trends of the repeated phantom scans over time.
+
+HLUT calibration and evaluation code, Copyright (c) 2025, CT-in-RT working group.
+
+This software (any code and/or associated documentation: the “Software”)
+is distributed under the terms of the MIT license (the “License”).
+Refer to the License for more details. You should have received a copy of
+the License along with the code. If not, see
+https://choosealicense.com/licenses/mit/.
+SPDX-License-Identifier: MIT
+
+EXAMPLE:
+    python trends.py --scanner Siemens_goOpenPro --output_folder_name Results/Trends
+    python trends.py --files "Archive/*.xlsx" --workers 4 --baseline_end 2024-01-31
+    python trends.py --ctn_tolerance 10 --hlut_deviation_tolerance 1 --accuracy_tolerance 0.5 1 1.5
+
+"""
+
+from utils import trend_analysis
+import argparse
+import glob
+import os
+import sys
+
+
+if __name__ == "__main__":
+
+    #################################################
+    # PARAMETER DEFINITION ##########################
+    #################################################
+
+    # Results store, written by main.py and in batch mode:
+    store = 'Results/results.sqlite'
+
+    #################################################
+    # Run script ####################################
+    #################################################
+
+    parser = argparse.ArgumentParser(description='Constancy checks of the HLUT calibrations in the results store.')
+    parser.add_argument('--store', type=str, default=store,
+                        help='Results store with the calibrations.')
+    parser.add_argument('--files', type=str, default=[], nargs='+',
+                        help='Archived excel files (wildcards allowed), which are calibrated and added to the '
+                             'results store first. The date of a calibration is the modification time of its file.')
+    parser.add_argument('--output_parameter', type=str, default=None, nargs='+',
+                        help='Analyse only the HLUTs for these output parameters (MD, RED, SPR). '
+                             'The archived files are calibrated for each of them, default: SPR.')
+    parser.add_argument('--recon_type', type=str, default=None, nargs='+',
+                        help='Analyse only the HLUTs of these types (regular, DD). '
+                             'The archived files are calibrated for each of them, default: regular.')
+    parser.add_argument('--e_prot', type=float, default=100,
+                        help='Initial energy of the proton beam (MeV) for the archived files.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes for the calibration of the archived files.')
+    for column in ['scanner', 'phantom', 'protocol']:
+        parser.add_argument('--' + column, type=str, default=None, nargs='+',
+                            help='Analyse only the runs with this {}.'.format(column.replace('_', ' ')))
+    parser.add_argument('--start', type=str, default=None,
+                        help='Date of the first run to analyse (YYYY-MM-DD).')
+    parser.add_argument('--end', type=str, default=None,
+                        help='Date of the last run to analyse (YYYY-MM-DD).')
+    parser.add_argument('--baseline_end', type=str, default=None,
+                        help='The baseline is the mean of the runs up to this date (YYYY-MM-DD), '
+                             'default: the first run of each series.')
+    parser.add_argument('--output_folder_name', type=str, default=None,
+                        help='Folder for the tables of the trends (.csv).')
+
+    # Tolerances of the checks, above which a run is flagged (defaults: trend_analysis.TOLERANCES):
+    tolerances = trend_analysis.TOLERANCES
+    parser.add_argument('--ctn_tolerance', type=float, default=tolerances['ctn'],
+                        help='Tolerance of the CT number drift and of the difference between center and periphery '
+                             '(HU), default: {}.'.format(tolerances['ctn']))
+    parser.add_argument('--ctn_relative_tolerance', type=float, default=tolerances['ctn_relative'],
+                        help='Relative tolerance of the CT numbers (fraction of the CT number), used if larger '
+                             'than --ctn_tolerance, default: {}.'.format(tolerances['ctn_relative']))
+    parser.add_argument('--hlut_deviation_tolerance', type=float, default=tolerances['hlut_deviation'],
+                        help='Tolerance of the maximum deviation from the baseline HLUT at any CT number (%%), '
+                             'default: {}.'.format(tolerances['hlut_deviation']))
+    parser.add_argument('--accuracy_tolerance', type=float, nargs=3, metavar=('ME', 'MAE', 'RMSE'),
+                        default=[tolerances[i] for i in ['ME', 'MAE', 'RMSE']],
+                        help='Tolerances of the accuracy metrics of the HLUTs (%%, absolute value for the ME), '
+                             'default: {} {} {}.'.format(tolerances['ME'], tolerances['MAE'], tolerances['RMSE']))
+    args = parser.parse_args()
+
+    # Relative paths are interpreted relative to the location of this script:
+    base_folder = os.path.dirname(os.path.abspath(__file__))
+    store = os.path.join(base_folder, args.store)
+    output_folder_name = args.output_folder_name
+    if output_folder_name is not None:
+        output_folder_name = os.path.join(base_folder, output_folder_name)
+
+    files = sorted(i for pattern in args.files for i in glob.glob(os.path.join(base_folder, pattern)))
+    if len(files) > 0:
+        for output_parameter in args.output_parameter or ['SPR']:
+            for recon_type in args.recon_type or ['regular']:
+                trend_analysis.archive_workbooks(store, files, output_parameter, recon_type, args.e_prot,
+                                                 workers=args.workers)
+
+    # The end dates include the runs of that day:
+    end, baseline_end = [i + 'T23:59:59' if i is not None and len(i) == 10 else i
+                         for i in [args.end, args.baseline_end]]
+    filters = {column: getattr(args, column) for column in trend_analysis.SERIES}
+    tolerances = dict(zip(['ME', 'MAE', 'RMSE'], args.accuracy_tolerance), ctn=args.ctn_tolerance,
+                      ctn_relative=args.ctn_relative_tolerance, hlut_deviation=args.hlut_deviation_tolerance)
+    trends = trend_analysis.main(store, args.start, end, baseline_end, output_folder_name, tolerances, **filters)
+
+    if trends['runs']['flagged'].any():
+        sys.exit(1)
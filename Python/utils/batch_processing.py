@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Batch execution of the HLUT generation and evaluation in a process pool
+
+% SPDX-License-Identifier: MIT
+"""
+
+import os
+import copy
+import glob
+import time
+import itertools
+import traceback
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import control_input, profiling, report_queue, results_store
+
+# Relative paths are interpreted relative to the location of main.py:
+BASE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main(input_parameters):
+    """
+    Run the HLUT generation and evaluation for every combination of the input
+    parameters in a process pool. Jobs for the same workbook and recon_type share
+    the ingestion and the stoichiometric calibration: each workbook is calibrated
+    once, and as soon as its calibration is finished, the output-specific stages
+    (HLUT fit, evaluation and report) of its jobs are submitted to the pool, one
+    task per job.
+    Input:  input_parameters - Parsed (and checked) command line arguments
+    Output: results - list with one summary per job, in the order of the jobs
+    """
+
+    jobs = create_jobs(input_parameters)
+    options = (getattr(input_parameters, 'profile', None), getattr(input_parameters, 'trace_memory', False))
+    analyses = getattr(input_parameters, 'analyses', None)
+    groups = group_jobs(jobs)
+    workers = max(1, min(input_parameters.workers, len(jobs)))
+    print('\nBatch mode: {} HLUT jobs from {} calibrations on {} worker process(es).'.format(len(jobs), len(groups),
+                                                                                          workers))
+
+    results = [None] * len(jobs)
+    shared_traces = []
+    if workers == 1:
+        for group in groups:
+            shared = calibrate_group(jobs[group[0]], *options)
+            shared_traces.append(shared['trace'])
+            for i in group:
+                results[i] = evaluate_job(jobs[i], shared, *options, wait_report=False, analyses=analyses)
+        # The reports are created in the background, while the next job is evaluated:
+        report_queue.wait_all()
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            calibrations = {executor.submit(calibrate_group, jobs[group[0]], *options): group for group in groups}
+            evaluations = {}
+            for future in as_completed(calibrations):
+                group = calibrations[future]
+                try:
+                    shared = future.result()
+                except Exception as error:
+                    # Only reached if the worker process itself died:
+                    shared = {'calibration': None, 'error': error, 'runtime': 0, 'trace': None}
+                shared_traces.append(shared['trace'])
+                for i in group:
+                    evaluations[i] = (executor.submit(evaluate_job, jobs[i], shared, *options, analyses=analyses)
+                                      if shared['calibration'] is not None else None)
+                    if evaluations[i] is None:
+                        results[i] = failed_job(jobs[i], shared['error'], shared['runtime'])
+            for i, future in evaluations.items():
+                if future is None:
+                    continue
+                try:
+                    results[i] = future.result()
+                except Exception as error:
+                    results[i] = failed_job(jobs[i], error, 0)
+
+    # Print and save the summary table:
+    table = summary_table(results)
+    print('\n' + table)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_folder = os.path.join(BASE_FOLDER, input_parameters.output_folder_name[0])
+    summary_file = os.path.join(output_folder, 'batch_summary_{}.txt'.format(timestamp))
+    os.makedirs(output_folder, exist_ok=True)
+    with open(summary_file, 'w') as f:
+        f.write(table + '\n')
+
+    # Save the stage times of all jobs, the shared stages are recorded once per calibration:
+    shared_traces = [i for i in shared_traces if i is not None]
+    job_traces = [i['trace'] for i in results if i.get('trace') is not None]
+    profiling.write_json({'stages': profiling.aggregate(shared_traces + job_traces), 'shared': shared_traces,
+                          'jobs': job_traces},
+                         os.path.join(output_folder, 'batch_trace_{}.json'.format(timestamp)))
+
+    return results
+
+
+def create_jobs(input_parameters):
+    """
+    Create the list of jobs from all combinations of the input parameters.
+    Wildcards in the file names are expanded in the respective input folder
+    (templates starting with 'BLANK_' are skipped). For MD and RED HLUTs the
+    proton energy is not used, so these jobs are only created once.
+    Raises ValueError for an invalid output parameter or recon type.
+    Input:  input_parameters - Parsed (and checked) command line arguments
+    Output: jobs - list of dictionaries with the parameters of each job
+    """
+
+    files = []
+    for input_folder_name, file_name in itertools.product(input_parameters.input_folder_name,
+                                                          input_parameters.file_name):
+        if glob.has_magic(file_name):
+            matches = sorted(glob.glob(os.path.join(BASE_FOLDER, input_folder_name, file_name)))
+            matches = [os.path.basename(i) for i in matches]
+            matches = [i for i in matches if not i.startswith(('BLANK_', '~$'))]
+            if len(matches) == 0:
+                print('--- No files matching {} found in {}.'.format(file_name, input_folder_name))
+        else:
+            matches = [file_name]
+        for i in matches:
+            if (input_folder_name, i) not in files:
+                files.append((input_folder_name, i))
+
+    jobs = []
+    for (input_folder_name, file_name), output_parameter, recon_type, e_prot in itertools.product(
+            files, input_parameters.output_parameter, input_parameters.recon_type, input_parameters.e_prot):
+        # The parameters are checked once here, before any job is run:
+        control_input.check_parameters(output_parameter, recon_type)
+        if output_parameter != 'SPR':
+            e_prot = input_parameters.e_prot[0]
+        job = {'input_folder_name': input_folder_name,
+               'file_name': file_name,
+               'output_parameter': output_parameter,
+               'recon_type': recon_type,
+               'output_folder_name': input_parameters.output_folder_name[0],
+               'e_prot': e_prot}
+        if job not in jobs:
+            jobs.append(job)
+
+    return jobs
+
+
+def group_jobs(jobs):
+    """
+    Group the jobs that share the stoichiometric calibration, i.e. that only differ in the
+    output parameter or the proton energy (which only changes the SPR reference values,
+    see initialize_data.set_proton_energy)
+    Input:  jobs - list of jobs from create_jobs
+    Output: groups - list of lists with the indices of the jobs in each group
+    """
+
+    groups = {}
+    for i, job in enumerate(jobs):
+        key = (job['input_folder_name'], job['file_name'], job['recon_type'])
+        groups.setdefault(key, []).append(i)
+
+    return list(groups.values())
+
+
+def calibrate_group(job, profile=None, trace_memory=False):
+    """
+    Shared stages of a group of jobs: ingestion and stoichiometric calibration of the workbook.
+    Errors are caught, so that one failing workbook does not stop the other jobs of the batch.
+    Input:  job - first job of the group
+            profile, trace_memory - profiling options (see profiling.new_trace)
+    Output: shared - Dictionary with the calibration (None if it failed), the hash of the workbook,
+                     the error, the runtime and the trace of the shared stages
+    """
+
+    from utils import hlut_generation_and_evaluation
+    from utils.calculation import initialize_data
+
+    print('\nStart of HLUT generation for {} ({}).'.format(job['file_name'], job['recon_type']))
+
+    start = time.perf_counter()
+    trace = profiling.new_trace(trace_memory, profile, file_name=job['file_name'], recon_type=job['recon_type'],
+                                e_prot=job['e_prot'])
+    shared = {'calibration': None, 'input_hash': None, 'error': None, 'trace': trace}
+    try:
+        with profiling.stage(trace, 'Ingestion'):
+            excelfile = os.path.join(BASE_FOLDER, job['input_folder_name'], job['file_name'])
+            sheets = initialize_data.read_workbook(excelfile)
+            shared['input_hash'] = initialize_data.file_hash(excelfile)
+        shared['calibration'] = hlut_generation_and_evaluation.calibrate(sheets, job['recon_type'], job['e_prot'],
+                                                                         trace)
+    except Exception as error:
+        traceback.print_exc()
+        shared['error'] = error
+    shared['runtime'] = time.perf_counter() - start
+    profiling.finish_trace(trace)
+
+    return shared
+
+
+def evaluate_job(job, shared, profile=None, trace_memory=False, wait_report=True, analyses=None):
+    """
+    Output-specific stages of a job: HLUT fit, evaluation and report, from the shared calibration.
+    Errors are caught, so that one failing job does not stop the other jobs of the batch.
+    Input:  job - job from create_jobs
+            shared - result of calibrate_group for the group of the job
+            profile, trace_memory - profiling options (see profiling.new_trace)
+            wait_report - if False, the PDF report may still be in progress when the function returns
+                          (see report_queue), in a worker process the report is always waited for
+            analyses - settings of the optional analyses (see control_input.check_analyses)
+    Output: summary of the job, with the traces of the shared and the output-specific stages
+    """
+
+    # Figures are only written to files, no GUI backend is needed in the worker processes:
+    import matplotlib
+    matplotlib.use('Agg')
+    from utils import hlut_generation_and_evaluation
+    from utils.calculation import initialize_data
+
+    start = time.perf_counter()
+    trace = profiling.new_trace(trace_memory, profile, **job)
+    try:
+        calibration = shared['calibration']
+        if job['output_parameter'] == 'SPR' and job['e_prot'] != calibration['constants']['E_prot']:
+            calibration = copy.deepcopy(calibration)
+            initialize_data.set_proton_energy(calibration, job['e_prot'])
+        output = initialize_data.create_output_folder(os.path.join(BASE_FOLDER, job['output_folder_name']),
+                                                      job['output_parameter'])
+        result = hlut_generation_and_evaluation.evaluate(calibration, job['output_parameter'], job['recon_type'],
+                                                         output, create_report=True, file_name=job['file_name'],
+                                                         trace=trace, wait_report=False, analyses=analyses)
+    except Exception as error:
+        traceback.print_exc()
+        return failed_job(job, error, time.perf_counter() - start, shared['runtime'])
+
+    # Record the run in the results store of the Results folder, while the report is created:
+    try:
+        results_store.record_run(os.path.join(BASE_FOLDER, job['output_folder_name'], results_store.STORE_NAME),
+                                 result, job['file_name'], shared['input_hash'], job['recon_type'], job['e_prot'],
+                                 output)
+    except Exception:
+        traceback.print_exc()
+    if wait_report:
+        report_queue.wait_all()
+
+    summary = dict(job)
+    summary.update({'status': 'ok', 'error': '', 'runtime': time.perf_counter() - start,
+                    'shared_runtime': shared['runtime'], 'output': output, 'HLUTs': result['HLUTs'],
+                    'trace': trace})
+
+    return summary
+
+
+def failed_job(job, error, runtime, shared_runtime=0):
+    """
+    Summary of a job that raised an error
+    """
+
+    result = dict(job)
+    result.update({'status': 'failed', 'error': '{}: {}'.format(type(error).__name__, error),
+                   'runtime': runtime, 'shared_runtime': shared_runtime, 'output': '', 'HLUTs': {}})
+    return result
+
+
+def summary_table(results):
+    """
+    Format the summary of all jobs as a table
+    Input:  results - list with the summary of each job
+    Output: table - string with one line per job
+    """
+
+    header = ['#', 'File name', 'Output', 'Recon', 'E_prot (MeV)', 'Status', 'Shared (s)', 'Time (s)',
+              'Results / Error']
+    rows = []
+    for i, result in enumerate(results):
+        e_prot = '{:g}'.format(result['e_prot']) if result['output_parameter'] == 'SPR' else '-'
+        rows.append([str(i + 1), result['file_name'], result['output_parameter'], result['recon_type'], e_prot,
+                     result['status'], '{:.1f}'.format(result['shared_runtime']),
+                     '{:.1f}'.format(result['runtime']),
+                     result['output'] if result['status'] == 'ok' else result['error']])
+
+    widths = [max(len(row[j]) for row in [header] + rows) for j in range(len(header))]
+    lines = ['    '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+             for row in [header] + rows]
+    lines.insert(1, '-' * len(lines[0]))
+    n_failed = sum(result['status'] != 'ok' for result in results)
+    lines.append('{} of {} jobs finished successfully.'.format(len(results) - n_failed, len(results)))
+
+    return '\n'.join(lines)
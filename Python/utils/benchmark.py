@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the HLUT generation and evaluation with synthetic workbooks
+
+The synthetic workbooks are scaled copies of a shipped example: every phantom insert and
+every tabulated human tissue is repeated with slightly varied mass densities, and further
+CT number columns (e.g. repeated scans) can be added. Each workbook is written to an Excel
+file and run through all stages, from the ingestion to the report, with the stage times
+recorded by profiling. The stage times are compared over the data sizes (scaling exponent)
+and, optionally, with a previous benchmark to catch performance regressions. The cold-start
+time of the command line interface (import of its modules in a new interpreter) is
+measured as well.
+
+% SPDX-License-Identifier: MIT
+"""
+
+import os
+import io
+import sys
+import json
+import shutil
+import tempfile
+import contextlib
+import subprocess
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+from utils import profiling
+from utils.calculation import initialize_data
+
+# Relative spread of the mass densities of the repeated inserts and tissues:
+DENSITY_SPREAD = 0.01
+
+# Modules imported by main.py, and libraries that should only be loaded by the stages that use them:
+STARTUP_MODULES = ['utils.hlut_generation_and_evaluation', 'utils.control_input', 'utils.batch_processing']
+HEAVY_MODULES = ['pandas', 'matplotlib', 'scipy', 'sklearn', 'reportlab', 'pdfrw']
+
+
+def main(file_name, sizes, output_parameter='SPR', recon_type='regular', e_prot=100, repeats=3,
+         output_folder_name=None, create_report=True, baseline=None, tolerance=0.25, seed=0):
+    """
+    Run the benchmark for a list of data sizes
+    Input:  file_name - shipped example workbook the synthetic workbooks are created from
+            sizes - list of data sizes, each a tuple (insert factor, tissue factor, extra CT number columns)
+            output_parameter, recon_type, e_prot - see hlut_generation_and_evaluation.run
+            repeats - number of runs per size, the fastest run of each stage is kept
+            output_folder_name - folder for the benchmark results, or None to only print them
+            create_report - if False, the stages end with the evaluation
+            baseline - JSON file of a previous benchmark, to compare the stage times with
+            tolerance - relative increase of a stage time (compared with the baseline) reported as regression
+            seed - seed of the random variation of the densities
+    Output: benchmark - Dictionary with the cold-start time, the stage times per size, the scaling exponents
+                        and the regressions
+    """
+
+    template = initialize_data.parse_workbook(file_name)
+
+    startup = startup_time(repeats)
+    print('Cold start: {:.3f} s'.format(startup['wall']))
+
+    results = []
+    folder = tempfile.mkdtemp(prefix='hlut_benchmark_')
+    try:
+        for inserts, tissues, columns in sizes:
+            sheets = synthetic_sheets(template, inserts, tissues, columns, seed)
+            workbook = os.path.join(folder, 'benchmark_{}_{}_{}.xlsx'.format(inserts, tissues, columns))
+            write_workbook(sheets, workbook)
+            print('Benchmark: {} inserts, {} tissues, {} CT number columns'.format(
+                len(sheets['PhantomInserts']), len(sheets['TabulatedHumanTissues']), ctn_columns(sheets)))
+
+            traces = [run_case(workbook, output_parameter, recon_type, e_prot, folder, create_report)
+                      for _ in range(repeats)]
+            results.append({'inserts': len(sheets['PhantomInserts']),
+                            'tissues': len(sheets['TabulatedHumanTissues']),
+                            'ctn_columns': ctn_columns(sheets),
+                            'stages': fastest_stages(traces)})
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    benchmark = {'info': {'file_name': os.path.basename(file_name), 'output_parameter': output_parameter,
+                          'recon_type': recon_type, 'e_prot': e_prot, 'repeats': repeats,
+                          'date': datetime.now().isoformat(timespec='seconds')},
+                 'startup': startup,
+                 'results': results,
+                 'scaling': scaling_exponents(results)}
+    if baseline is not None:
+        with open(baseline) as f:
+            benchmark['regressions'] = regressions(json.load(f), benchmark, tolerance)
+
+    table = benchmark_table(benchmark)
+    print('\n' + table)
+    if output_folder_name is not None:
+        os.makedirs(output_folder_name, exist_ok=True)
+        name = os.path.join(output_folder_name, 'benchmark_{}'.format(datetime.now().strftime("%Y%m%d_%H%M%S")))
+        profiling.write_json(benchmark, name + '.json')
+        with open(name + '.txt', 'w') as f:
+            f.write(table + '\n')
+        plot_scaling(benchmark, name + '.svg')
+
+    return benchmark
+
+
+def startup_time(repeats=3):
+    """
+    Cold-start time of the command line interface: import of the modules of main.py in
+    a new interpreter, as for every start of the tool and every spawned worker process
+    Input:  repeats - number of interpreters started, the fastest import is kept
+    Output: startup - Dictionary with the import time (s) and the heavy libraries loaded on import
+    """
+
+    code = ('import sys, json, time\n'
+            'start = time.perf_counter()\n'
+            'import {}\n'
+            'wall = time.perf_counter() - start\n'
+            'print(json.dumps({{"wall": wall, "modules": [i for i in {} if i in sys.modules]}}))'
+            ).format(', '.join(STARTUP_MODULES), HEAVY_MODULES)
+    base_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', code], cwd=base_folder, capture_output=True, text=True,
+                                check=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    return min(runs, key=lambda i: i['wall'])
+
+
+def synthetic_sheets(sheets, inserts=1, tissues=1, columns=0, seed=0):
+    """
+    Scaled copy of the sheets of a workbook
+    Input:  sheets - Dictionary with one DataFrame per sheet (see initialize_data.read_workbook)
+            inserts - number of copies of every phantom insert (with its CT numbers)
+            tissues - number of copies of every tabulated human tissue
+            columns - number of additional CT number columns, copies of the head and body CT numbers
+            seed - seed of the random variation of the densities
+    Output: sheets - Dictionary with the scaled DataFrames. The copies of an insert or tissue follow
+                     each other, so the order of the tissue groups is kept.
+    """
+
+    rng = np.random.default_rng(seed)
+    sheets = {name: sheet.copy() for name, sheet in sheets.items()}
+
+    for name, factor, label in [('PhantomInserts', inserts, 'Insert name'),
+                                ('TabulatedHumanTissues', tissues, 'Tissue name')]:
+        sheet = sheets[name].loc[sheets[name].index.repeat(factor)].reset_index(drop=True)
+        if factor > 1:
+            copy = np.tile(np.arange(factor), len(sheet) // factor)
+            sheet[label] = [i if j == 0 else '{} #{}'.format(i, j + 1) for i, j in zip(sheet[label], copy)]
+            variation = 1 + DENSITY_SPREAD * rng.uniform(-1, 1, len(sheet))
+            variation[copy == 0] = 1
+            sheet['Density (g/cm3)'] = sheet['Density (g/cm3)'] * variation
+        sheets[name] = sheet
+
+    # The CT numbers belong to the inserts, so they are repeated in the same way:
+    ctn = sheets['CTnumbers'].loc[sheets['CTnumbers'].index.repeat(inserts)].reset_index(drop=True)
+    ctn['Insert name'] = sheets['PhantomInserts']['Insert name']
+    for j in range(columns):
+        ctn['CT number (scan {})'.format(j + 2)] = ctn['CT number (Head)' if j % 2 == 0 else 'CT number (Body)']
+    sheets['CTnumbers'] = ctn
+
+    return sheets
+
+
+def ctn_columns(sheets):
+    """
+    Number of CT number columns of a workbook
+    """
+
+    return sum(str(i).startswith('CT number') for i in sheets['CTnumbers'].columns)
+
+
+def write_workbook(sheets, file_name):
+    """
+    Write the sheets to an Excel file
+    Input:  sheets - Dictionary with one DataFrame per sheet
+            file_name - name of the Excel file
+    """
+
+    with pd.ExcelWriter(file_name) as writer:
+        for name, sheet in sheets.items():
+            sheet.to_excel(writer, sheet_name=name, index=False)
+
+
+def run_case(workbook, output_parameter, recon_type, e_prot, folder, create_report=True):
+    """
+    Run all stages for one workbook, without the cache of the parsed workbook
+    Input:  workbook - Excel file
+            output_parameter, recon_type, e_prot - see hlut_generation_and_evaluation.run
+            folder - folder for the results of the run, which are deleted afterwards
+            create_report - if False, the stages end with the evaluation
+    Output: trace - trace of the stages (see profiling.new_trace)
+    """
+
+    # Figures are only written to files:
+    import matplotlib
+    matplotlib.use('Agg')
+    from utils import hlut_generation_and_evaluation
+
+    trace = profiling.new_trace(file_name=os.path.basename(workbook), output_parameter=output_parameter,
+                                recon_type=recon_type, e_prot=e_prot)
+    output = initialize_data.create_output_folder(os.path.join(folder, 'Results'), output_parameter)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            with profiling.stage(trace, 'Ingestion'):
+                sheets = initialize_data.read_workbook(workbook, use_cache=False)
+            hlut_generation_and_evaluation.run(sheets, output_parameter, recon_type, e_prot, output=output,
+                                               create_report=create_report, file_name=os.path.basename(workbook),
+                                               trace=trace)
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+
+    return trace
+
+
+def fastest_stages(traces):
+    """
+    Fastest wall and CPU time of every stage over repeated runs
+    Input:  traces - traces of the repeated runs
+    Output: stages - Dictionary per stage with the wall and CPU time (s)
+    """
+
+    stages = {}
+    for trace in traces:
+        for record in trace['stages']:
+            times = stages.setdefault(record['stage'], {'wall': np.inf, 'cpu': np.inf})
+            times['wall'] = min(times['wall'], record['wall'])
+            times['cpu'] = min(times['cpu'], record['cpu'])
+    stages['Total'] = {key: sum(i[key] for i in list(stages.values())) for key in ['wall', 'cpu']}
+
+    return stages
+
+
+def scaling_exponents(results):
+    """
+    Scaling of the stage times with the data size: slope of log(time) over log(number of
+    inserts and tissues), about 1 for a linear and 2 for a quadratic stage
+    Input:  results - stage times per size (see main)
+    Output: exponents - Dictionary with the exponent per stage, None if it cannot be determined
+    """
+
+    size = np.array([i['inserts'] + i['tissues'] for i in results], dtype=float)
+    exponents = {}
+    for name in results[0]['stages']:
+        wall = np.array([i['stages'].get(name, {}).get('wall', np.nan) for i in results])
+        valid = (wall > 0) & np.isfinite(wall)
+        if len(np.unique(size[valid])) < 2:
+            exponents[name] = None
+        else:
+            exponents[name] = float(np.polyfit(np.log(size[valid]), np.log(wall[valid]), 1)[0])
+
+    return exponents
+
+
+def regressions(baseline, benchmark, tolerance=0.25):
+    """
+    Stages that are slower than in a previous benchmark with the same data sizes
+    Input:  baseline, benchmark - results of main
+            tolerance - relative increase of the wall time reported as regression
+    Output: regressions - list with the size, stage and wall times of the slower stages (size None for the
+                          cold start)
+    """
+
+    keys = ['inserts', 'tissues', 'ctn_columns']
+    reference = {tuple(i[key] for key in keys): i['stages'] for i in baseline['results']}
+    slower = []
+    if 'startup' in baseline and 'startup' in benchmark and \
+            benchmark['startup']['wall'] > (1 + tolerance) * baseline['startup']['wall']:
+        slower.append({'size': None, 'stage': 'Cold start', 'baseline': baseline['startup']['wall'],
+                       'wall': benchmark['startup']['wall']})
+    for result in benchmark['results']:
+        stages = reference.get(tuple(result[key] for key in keys))
+        if stages is None:
+            continue
+        for name, times in result['stages'].items():
+            if name in stages and times['wall'] > (1 + tolerance) * stages[name]['wall']:
+                slower.append({'size': [result[key] for key in keys], 'stage': name,
+                               'baseline': stages[name]['wall'], 'wall': times['wall']})
+
+    return slower
+
+
+def benchmark_table(benchmark):
+    """
+    Format the stage times as a table, with one column per size
+    Input:  benchmark - result of main
+    Output: table - string
+    """
+
+    results = benchmark['results']
+    header = ['Stage'] + ['{}/{}/{}'.format(i['inserts'], i['tissues'], i['ctn_columns']) for i in results] + \
+             ['Exponent']
+    rows = []
+    for name in results[0]['stages']:
+        exponent = benchmark['scaling'].get(name)
+        rows.append([name] + ['{:.3f}'.format(i['stages'][name]['wall']) if name in i['stages'] else '-'
+                              for i in results] + ['-' if exponent is None else '{:.2f}'.format(exponent)])
+
+    widths = [max(len(row[j]) for row in [header] + rows) for j in range(len(header))]
+    lines = ['Wall time (s) per stage for inserts/tissues/CT number columns:']
+    lines += ['    '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+              for row in [header] + rows]
+    lines.insert(2, '-' * len(lines[1]))
+
+    if 'startup' in benchmark:
+        lines.append('Cold start (import of the command line interface): {:.3f} s, heavy libraries loaded: {}'.format(
+            benchmark['startup']['wall'], ', '.join(benchmark['startup']['modules']) or 'none'))
+
+    if 'regressions' in benchmark:
+        if len(benchmark['regressions']) == 0:
+            lines.append('No stage is slower than in the baseline.')
+        for i in benchmark['regressions']:
+            size = '' if i['size'] is None else ' for {}/{}/{}'.format(*i['size'])
+            lines.append('--- Regression: {}{}: {:.3f} s (baseline {:.3f} s)'.format(
+                i['stage'], size, i['wall'], i['baseline']))
+
+    return '\n'.join(lines)
+
+
+def plot_scaling(benchmark, file_name):
+    """
+    Plot the stage times over the data size (log-log)
+    Input:  benchmark - result of main
+            file_name - name of the figure file
+    """
+
+    from matplotlib.figure import Figure
+
+    results = benchmark['results']
+    size = [i['inserts'] + i['tissues'] for i in results]
+    fig = Figure(figsize=(8, 5))
+    ax = fig.subplots()
+    for name in results[0]['stages']:
+        ax.plot(size, [i['stages'].get(name, {}).get('wall', np.nan) for i in results], 'o-', label=name)
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_xlabel('Number of inserts and tissues')
+    ax.set_ylabel('Wall time (s)')
+    ax.legend(fontsize=7, ncol=2)
+    fig.tight_layout()
+    fig.savefig(file_name)
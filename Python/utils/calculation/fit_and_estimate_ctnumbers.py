@@ -5,9 +5,20 @@ Fit and estimation of CT numbers
 % SPDX-License-Identifier: MIT
 """
 
-import pandas as pd
 import numpy as np
-from scipy.optimize import least_squares
+import itertools
+
+# The k value fit is invariant to the scale of the k values. They are reported with the
+# norm of the initial guess used by the former iterative fit (scipy least_squares):
+K_SCALE = np.array([10 ** (-5), 10 ** (-4), 0.5])
+
+# Subsets of k values which are not at their bound k = 0:
+K_SUBSETS = [list(free) for n in range(3, 0, -1) for free in itertools.combinations(range(3), n)]
+
+# CT number columns used for the fits and the corresponding HLUT types and estimated CT number columns:
+CTN_COLUMNS = ['CT number (Head)', 'CT number (Body)', 'CT number (averaged)']
+HLUT_TYPES = ['head', 'body', 'avgdCT']
+CTN_CALC_COLUMNS = ['ctn_calc_head', 'ctn_calc_body', 'ctn_calc_avgCT']
 
 
 def main(datasheet, recon_type):
@@ -32,161 +43,149 @@ def main(datasheet, recon_type):
         elif (datasheet['PhantomInserts']['Tissue group'] == 4).sum( ) <4:
             raise ValueError("At least 4 bone phantom inserts are needed to perform the needed fitting procedures.")
 
-    # Fit k values for stoichiometric calibration:
-    if recon_type == 'regular':
-        inserts = np.ones(len(datasheet['PhantomInserts']), dtype=bool)
-        k_head = k_value_fit(datasheet, 'CT number (Head)', inserts)
-        k_body = k_value_fit(datasheet, 'CT number (Body)', inserts)
-        k_avgCT = k_value_fit(datasheet, 'CT number (averaged)', inserts)
-    elif recon_type == 'DD':
-        soft_tissue = datasheet['PhantomInserts']['Tissue group'] < 4
-        bone_tissue = datasheet['PhantomInserts']['Tissue group'] == 4
-        k_soft_head = k_value_fit(datasheet, 'CT number (Head)', soft_tissue)
-        k_bone_head = k_value_fit(datasheet, 'CT number (Head)', bone_tissue)
-        k_soft_body = k_value_fit(datasheet, 'CT number (Body)', soft_tissue)
-        k_bone_body = k_value_fit(datasheet, 'CT number (Body)', bone_tissue)
-        k_soft_avgCT = k_value_fit(datasheet, 'CT number (averaged)', soft_tissue)
-        k_bone_avgCT = k_value_fit(datasheet, 'CT number (averaged)', bone_tissue)
-
-    # Estimate CT numbers for the phantom inserts (for quality check)
-    if recon_type == 'regular':
-        datasheet['PhantomInserts']['ctn_calc_head'] = (
-            ctn_calculation(datasheet, 'PhantomInserts', inserts, k_head))
-        datasheet['PhantomInserts']['ctn_calc_body'] = (
-            ctn_calculation(datasheet, 'PhantomInserts', inserts, k_body))
-        datasheet['PhantomInserts']['ctn_calc_avgCT'] = (
-            ctn_calculation(datasheet, 'PhantomInserts', inserts, k_avgCT))
-    elif recon_type == 'DD':
-        ctn_soft = (ctn_calculation(datasheet, 'PhantomInserts', soft_tissue, k_soft_head))
-        ctn_bone = (ctn_calculation(datasheet, 'PhantomInserts', bone_tissue, k_bone_head))
-        datasheet['PhantomInserts']['ctn_calc_head'] = np.concatenate((ctn_soft, ctn_bone))
-        ctn_soft = (ctn_calculation(datasheet, 'PhantomInserts', soft_tissue, k_soft_body))
-        ctn_bone = (ctn_calculation(datasheet, 'PhantomInserts', bone_tissue, k_bone_body))
-        datasheet['PhantomInserts']['ctn_calc_body'] = np.concatenate((ctn_soft, ctn_bone))
-        ctn_soft = (ctn_calculation(datasheet, 'PhantomInserts', soft_tissue, k_soft_avgCT))
-        ctn_bone = (ctn_calculation(datasheet, 'PhantomInserts', bone_tissue, k_bone_avgCT))
-        datasheet['PhantomInserts']['ctn_calc_avgCT'] = np.concatenate((ctn_soft, ctn_bone))
-
-    # Estimate CT numbers for the tabulated human tissues
-    if recon_type == 'regular':
-        inserts = np.ones(len(datasheet['TabulatedHumanTissues']), dtype=bool)
-        datasheet['TabulatedHumanTissues']['ctn_calc_head'] = (
-            ctn_calculation(datasheet, 'TabulatedHumanTissues', inserts, k_head))
-        datasheet['TabulatedHumanTissues']['ctn_calc_body'] = (
-            ctn_calculation(datasheet, 'TabulatedHumanTissues', inserts, k_body))
-        datasheet['TabulatedHumanTissues']['ctn_calc_avgCT'] = (
-            ctn_calculation(datasheet, 'TabulatedHumanTissues', inserts, k_avgCT))
-    elif recon_type == 'DD':
-        soft_tissue = datasheet['TabulatedHumanTissues']['Tissue group'] < 4
-        bone_tissue = datasheet['TabulatedHumanTissues']['Tissue group'] == 4
-        ctn_soft = (ctn_calculation(datasheet, 'TabulatedHumanTissues', soft_tissue, k_soft_head))
-        ctn_bone = (ctn_calculation(datasheet, 'TabulatedHumanTissues', bone_tissue, k_bone_head))
-        datasheet['TabulatedHumanTissues']['ctn_calc_head'] = np.concatenate((ctn_soft, ctn_bone))
-        ctn_soft = (ctn_calculation(datasheet, 'TabulatedHumanTissues', soft_tissue, k_soft_body))
-        ctn_bone = (ctn_calculation(datasheet, 'TabulatedHumanTissues', bone_tissue, k_bone_body))
-        datasheet['TabulatedHumanTissues']['ctn_calc_body'] = np.concatenate((ctn_soft, ctn_bone))
-        ctn_soft = (ctn_calculation(datasheet, 'TabulatedHumanTissues', soft_tissue, k_soft_avgCT))
-        ctn_bone = (ctn_calculation(datasheet, 'TabulatedHumanTissues', bone_tissue, k_bone_avgCT))
-        datasheet['TabulatedHumanTissues']['ctn_calc_avgCT'] = np.concatenate((ctn_soft, ctn_bone))
+    # Tissue selections of the fits:
+    selections = tissue_selections(datasheet['PhantomInserts'], recon_type)
+
+    # Fit k values for stoichiometric calibration, for all CT number columns and selections at once:
+    ctn = np.array(datasheet['CTnumbers'][CTN_COLUMNS], dtype=float)
+    k_values = k_value_fit_batch(datasheet, ctn, list(selections.values()))
+
+    # Store the k values per HLUT type and tissue selection:
+    datasheet['k_values'] = {hluttype: dict(zip(selections, k_values[i])) for i, hluttype in enumerate(HLUT_TYPES)}
+
+    # Estimate CT numbers for the phantom inserts (for quality check) and the tabulated human tissues,
+    # for every k set at once. With several selections, the estimates are concatenated in their order:
+    for dataset in ['PhantomInserts', 'TabulatedHumanTissues']:
+        ctn_calc = ctn_calculation_batch(datasheet, dataset, k_values)
+        masks = list(tissue_selections(datasheet[dataset], recon_type).values())
+        for i, column in enumerate(CTN_CALC_COLUMNS):
+            datasheet[dataset][column] = np.concatenate([ctn_calc[i, j][mask] for j, mask in enumerate(masks)])
 
     return datasheet
 
 
-def k_value_formulas(datasheet, wi_mat, zi, ai):
+def tissue_selections(table, recon_type):
     """
-    Formulas used in k_value_fit and ctn_calculation
-    Input:  wi_mat, zi, ai - elemental composition parameters of the material
-    Output: z_tilde, z_tilde_w, z_hat, z_hat_w, ng, ng_w - material parameters
+    Selection of the materials for the k value fits
+    Input:  table - PhantomInserts or TabulatedHumanTissues
+            recon_type - Reconstruction type
+    Output: dictionary of boolean masks, 'all' for regular, 'soft' and 'bone' for DD
     """
 
-    # Load relevant data from datasheet
-    wi_w = datasheet['Data_water']['wi_w']
-    zi_w = datasheet['Data_water']['zi_w']
-    ai_w = datasheet['Data_water']['ai_w']
+    if recon_type == 'DD':
+        return {'soft': np.asarray(table['Tissue group'] < 4), 'bone': np.asarray(table['Tissue group'] == 4)}
+    return {'all': np.ones(len(table), dtype=bool)}
+
 
-    # Calculate values of Eq. 9 and Eq 10 in source for tissues
-    z_tilde = np.matmul(wi_mat, zi ** (3.62 + 1) / ai) / np.matmul(wi_mat, (zi / ai))
-    z_hat = np.matmul(wi_mat, zi ** (1.86 + 1) / ai) / np.matmul(wi_mat, (zi / ai))
-    ng = np.matmul(wi_mat, (zi / ai))
+def k_value_terms(datasheet, dataset):
+    """
+    Terms of the stoichiometric attenuation model, taken from the material basis
+    (mu = rho * ng * (k[0] * z_tilde + k[1] * z_hat + k[2]), Eq. 9 and Eq. 10 in source)
+    Input:  datasheet - Dictionary containing data from excel sheets
+            dataset - Either PhantomInserts or TabulatedHumanTissues
+    Output: terms - rho * ng * (z_tilde, z_hat, 1) of the materials (materials x 3)
+            terms_w - the same for water (3)
+    """
 
-    # Calculate values of Eq. 9 and Eq 10 in source for water
-    z_tilde_w = (np.matmul(wi_w, zi_w ** (3.62 + 1) / ai_w) / np.matmul(wi_w, (zi_w / ai_w)))
-    z_hat_w = (np.matmul(wi_w, zi_w ** (1.86 + 1) / ai_w) / np.matmul(wi_w, (zi_w / ai_w)))
-    ng_w = np.matmul(wi_w, (zi_w / ai_w))
+    basis = datasheet['basis']
+    material = basis[dataset]
+    terms = ((material['density'] * material['ng'])[:, np.newaxis]
+             * np.stack((material['z_tilde'], material['z_hat'], np.ones(len(material['ng']))), axis=1))
+    terms_w = basis['rho_w'] * basis['ng_w'] * np.array([basis['z_tilde_w'], basis['z_hat_w'], 1])
 
-    return z_tilde, z_tilde_w, z_hat, z_hat_w, ng, ng_w
+    return terms, terms_w
 
 
-def k_value_fit(datasheet, phantom, inserts):
+def k_value_fit_batch(datasheet, ctn, masks):
     """
-    Performs the K value fit, following Schneider et al. 1996 (DOI: 10.1088/0031-9155/41/1/009)
+    K value fits for several sets of CT numbers and selections of phantom inserts at once
     Input:  datasheet - Dictionary containing data from excel sheets
-            phantom - Selection from which phantom type, the CT numbers are to be used
-    Output: k_values - fitted k values
+            ctn - CT numbers of the phantom inserts (inserts, or inserts x columns)
+            masks - boolean selections of the phantom inserts (selections x inserts)
+    Output: k_values - fitted k values (columns x selections x 3)
     """
 
-    # Load relevant data from datasheet
-    density_mat = np.array(datasheet['PhantomInserts']['Density (g/cm3)'])
-    zi = np.array(datasheet['ElementParameters']['Zi'])
-    ai = np.array(datasheet['ElementParameters']['Ai'])
-    ctn = np.array(datasheet['CTnumbers'][phantom])
-    wi_mat = np.array(pd.DataFrame(datasheet['PhantomInserts'], columns=datasheet['elements']))
-    rho_w = datasheet['Data_water']['rho_w']
-
-    # Calculate values for K fit from fit formulas
-    z_tilde, z_tilde_w, z_hat, z_hat_w, ng, ng_w = (k_value_formulas(datasheet, wi_mat[inserts, :], zi, ai))
+    ctn = np.asarray(ctn, dtype=float)
+    if ctn.ndim == 1:
+        ctn = ctn[:, np.newaxis]
+    masks = np.asarray(masks, dtype=bool).reshape(-1, len(ctn))
 
-    # Initiate K-value guesses for the linear least square approach
-    k_0 = [10 ** (-5), 10 ** (-4), 0.5]
+    terms, terms_w = k_value_terms(datasheet, 'PhantomInserts')
 
-    # Set Upper and lower bound on the K-values
-    lb_k = np.zeros(3)
-    ub_k = 10 * np.ones(3)
+    # Linear model with mu_w = 1:  ctn + 1000 = 1000 * terms @ k, for the selected inserts
+    return k_value_solve(1000 * terms, ctn.T + 1000, terms_w, masks)
 
-    k_values = least_squares(k_fit_function, k_0, bounds=[lb_k, ub_k],
-                             args=[density_mat[inserts], ng, z_tilde, z_hat, rho_w, ng_w, z_tilde_w, z_hat_w,
-                                   ctn[inserts]],
-                             ftol=1e-8, xtol=1e-8, gtol=1e-8)
-    return k_values.x
 
-
-def k_fit_function(k, density_mat, ng, z_tilde, z_hat, rho_w, ng_w, z_tilde_w, z_hat_w, ctn):
+def k_value_solve(a, b, c, masks):
     """
-    Function for the k fit, to be used in k_value_fit
-    Input:  k - value to be fitted
-            Rest: material parameters from k_value_formulas
-    Output: F - fit function
+    Closed-form solution of the k value fits (least squares with k >= 0).
+    The CT numbers only depend on the ratio mu / mu_w, so the scale of the k values is free.
+    With the scale fixed by mu_w = 1, the residuals are linear in k and the fit becomes
+    an equality-constrained linear least-squares problem. The bounds k >= 0 are handled
+    by solving it for every subset of non-zero k values and taking the best feasible solution.
+    All fits are solved together as stacked KKT systems.
+    Input:  a - model matrix, 1000 * mu / k of the phantom inserts (inserts x 3)
+            b - CT numbers + 1000 (columns x inserts)
+            c - mu_w / k (3)
+            masks - boolean selections of the phantom inserts (selections x inserts)
+    Output: k_values - fitted k values (columns x selections x 3), scaled to the norm of K_SCALE
     """
 
-    mu = density_mat * ng * (k[0] * z_tilde + k[1] * z_hat + k[2])
-    mu_w = rho_w * ng_w * (k[0] * z_tilde_w + k[1] * z_hat_w + k[2])
-
-    return ctn - 1000 * (mu / mu_w - 1)
-
-
-def ctn_calculation(datasheet, dataset, inserts, k_set):
+    # Scale the columns for well-conditioned systems (z_tilde is orders of magnitude larger than 1)
+    col_scale = np.linalg.norm(a, axis=0)
+    col_scale[col_scale == 0] = 1
+    a = a / col_scale
+    c = c / col_scale
+
+    # Normal equations of all selections, unselected inserts are excluded:
+    b_masked = np.where(masks, b[:, np.newaxis, :], 0)
+    gram = np.einsum('mi,ij,ik->mjk', masks.astype(float), a, a)
+    atb = b_masked @ a
+
+    n_col, n_sel = b_masked.shape[:2]
+    k_best = np.full((n_col, n_sel, 3), np.nan)
+    cost_best = np.full((n_col, n_sel), np.inf)
+    for free in K_SUBSETS:
+        n = len(free)
+        # KKT systems of min |b - a k|^2 subject to c @ k = 1, with k = 0 outside of the subset:
+        kkt = np.zeros((n_sel, n + 1, n + 1))
+        kkt[:, :n, :n] = gram[:, free][:, :, free]
+        kkt[:, :n, n] = c[free]
+        kkt[:, n, :n] = c[free]
+        singular = np.linalg.cond(kkt) > 1 / np.finfo(float).eps
+        kkt[singular] = np.eye(n + 1)
+        rhs = np.concatenate((atb[..., free], np.ones((n_col, n_sel, 1))), axis=-1)
+        solution = np.linalg.solve(kkt, rhs[..., np.newaxis])[..., 0]
+
+        k = np.zeros((n_col, n_sel, 3))
+        k[..., free] = solution[..., :n]
+        cost = np.sum((b_masked - np.where(masks, k @ a.T, 0)) ** 2, axis=-1)
+        better = ~singular & np.all(k >= 0, axis=-1) & (cost < cost_best)
+        k_best[better] = k[better]
+        cost_best[better] = cost[better]
+
+    if np.isinf(cost_best).any():
+        raise ValueError('The k value fit did not find a valid solution. Please revise your input data.')
+
+    k_best = k_best / col_scale
+    return k_best * np.linalg.norm(K_SCALE) / np.linalg.norm(k_best, axis=-1, keepdims=True)
+
+
+def ctn_calculation_batch(datasheet, dataset, k_sets):
     """
-    Calculate CT numbers for tabulated human tissues
+    Calculate CT numbers of all materials of a dataset for any number of k sets
     Input:  datasheet - Dictionary containing data from excel sheets
-            dataset - Either TabulatedHumanTissues or phantom data
-            k_set - fitted k values for head/body/avg from main script
-    Returns ctn_calc - calculated CT number for the material
+            dataset - Either TabulatedHumanTissues or PhantomInserts
+            k_sets - k values (..., 3)
+    Returns ctn_calc - calculated CT numbers (..., materials)
     """
 
-    # Load relevant data from datasheet
-    density_mat = np.array(datasheet[dataset]['Density (g/cm3)'])
-    zi = np.array(datasheet['ElementParameters']['Zi'])
-    ai = np.array(datasheet['ElementParameters']['Ai'])
-    wi_mat = np.array(pd.DataFrame(datasheet[dataset], columns=datasheet['elements']))
-    rho_w = datasheet['Data_water']['rho_w']
-
-    # Calculate values for CT number fit from fit formulas
-    z_tilde, z_tilde_w, z_hat, z_hat_w, ng, ng_w = (k_value_formulas(datasheet, wi_mat[inserts, :], zi, ai))
-
-    # Calculate mu from CTN-specific k set
-    k = k_set
-    mu = density_mat[inserts] * ng * (k[0] * z_tilde + k[1] * z_hat + k[2])
-    mu_w = rho_w * ng_w * (k[0] * z_tilde_w + k[1] * z_hat_w + k[2])
-    ctn_calc = 1000 * (mu / mu_w - 1)
+    terms, terms_w = k_value_terms(datasheet, dataset)
+
+    # Calculate mu relative to water from the k sets
+    k_sets = np.asarray(k_sets, dtype=float)
+    mu = k_sets @ terms.T
+    mu_w = k_sets @ terms_w
+    ctn_calc = 1000 * (mu / mu_w[..., np.newaxis] - 1)
 
     return ctn_calc
\ No newline at end of file
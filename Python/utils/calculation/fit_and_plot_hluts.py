@@ -6,8 +6,11 @@ Fit and plot of HLUTs
 """
 
 import numpy as np
-import math
-import matplotlib.pyplot as plt
+
+from utils import figures
+from utils import profiling
+from utils.calculation import hlut_table
+from utils.calculation import initialize_data
 
 
 def main(datasheet, recon_type):
@@ -25,33 +28,220 @@ def main(datasheet, recon_type):
         (datasheet['HLUTs'][hluttype[i]]['ctn'], datasheet['HLUTs'][hluttype[i]][datasheet['output_parameter']]) = (
             hlut_fit(datasheet, phantomtype[i], ctnumbertype[i]))
 
+    # Compile the HLUTs to dense tables for the evaluation boxes (see hlut_table.hlut_evaluator)
+    hlut_table.compile_hluts(datasheet)
+
     # Export HLUTs to txt files, saved in output folder
-    hlut_export(datasheet, hluttype, recon_type)
+    if datasheet['output'] is not None:
+        hlut_export(datasheet, hluttype, recon_type)
 
     # Plot results, saved in output folder for SPR HLUT
-    plot_hlut(datasheet, hluttype, recon_type)
+    if figures.create_figures(datasheet):
+        plot_hlut(datasheet, hluttype, recon_type)
 
 
-def hlut_fit(datasheet, phantom_ctn, tabul_ctn):
+def hlut_fit(datasheet, phantom_ctn, tabul_ctn, par_values=None, verbose=True):
     """
     Fit CT numbers and determine connection points
     Input:  datasheet  - Dictionary containing data from excel sheets
-            phantom_ctn - CT numbers from head/body/avgd
-            tabul_ctn - tabulated tissue CT numbers from head/body/avgd
+            phantom_ctn - CT numbers from head/body/avgd (column name or array)
+            tabul_ctn - tabulated tissue CT numbers from head/body/avgd (column name or array)
+            par_values - reference values (par_phantom, par_tiss, par_air) to be used instead of
+                         the ones given by reference_values(datasheet)
+            verbose - print notes on adjusted connection points
     Output: cp_ctn, cp_spr - connection points (CTN, SPR)
     """
 
+    # Load the reference values of the output parameter
+    if par_values is None:
+        par_values = reference_values(datasheet)
+
+    # Load the CT numbers, if given by the column names
+    if isinstance(phantom_ctn, str):
+        phantom_ctn = datasheet['CTnumbers'][phantom_ctn]
+    if isinstance(tabul_ctn, str):
+        tabul_ctn = datasheet['TabulatedHumanTissues'][tabul_ctn]
+
+    cp_ctn, cp_par, notes = hlut_fit_batch(datasheet, np.asarray(phantom_ctn, dtype=float),
+                                           np.asarray(tabul_ctn, dtype=float), par_values)
+    cp_ctn, cp_par = list(cp_ctn[0]), list(cp_par[0])
+
+    if verbose:
+        if notes['air_lung'][0]:
+            print("{} {} {} HU".format('--- The slope between air and lung tissue is negative or zero.',
+                                       'The CT number for the lower end of the lung tissue curve is increased to',
+                                       round(cp_ctn[2])))
+        if notes['lung_adipose'][0]:
+            print('--- The slope between lung and adipose is negative or zero. '
+                  'This should not happen. Please revise your input data.')
+        if notes['adipose_soft'][0]:
+            print("{} {} {} HU".format('--- The slope between adipose and soft tissue is negative or zero.',
+                                       'The CT number for the upper end of the adipose curve is thus lowered to',
+                                       round(cp_ctn[5])))
+        if notes['soft_bone'][0]:
+            print("{} {} {} HU".format('--- The slope between soft tissue and bone is negative.',
+                                       'The CT number for the lower end of the bone curve is increased to',
+                                       round(cp_ctn[8])))
+
+    return cp_ctn, cp_par
+
+
+def hlut_fit_batch(datasheet, phantom_ctn, tabul_ctn, par_values, phantom_keep=None, tabul_keep=None):
+    """
+    HLUT fits for a batch of data sets at once (e.g. realizations, proton energies or
+    cross-validation folds). The tissue groups are selected with boolean masks and the
+    linear fits of all data sets are solved in closed form.
+    Input:  datasheet  - Dictionary containing data from excel sheets
+            phantom_ctn - CT numbers of the phantom inserts (inserts, or batch x inserts)
+            tabul_ctn - CT numbers of the tabulated human tissues (tissues, or batch x tissues)
+            par_values - reference values (par_phantom, par_tiss, par_air), each with or without
+                         the batch dimension
+            phantom_keep, tabul_keep - optional masks of the materials used in each data set
+                                       (materials, or batch x materials)
+    Output: cp_ctn, cp_par - connection points (batch x connection points)
+            notes - per check of the slopes between the segments, a boolean array (batch)
+                    which is True if the slope was negative or zero
+    """
+
+    par_phantom, par_tiss, par_air = par_values
+    groups_phantom = np.asarray(datasheet['PhantomInserts']['Tissue group'])
+    groups_tiss = np.asarray(datasheet['TabulatedHumanTissues']['Tissue group'])
+    n_phantom, n_tiss = len(groups_phantom), len(groups_tiss)
+
+    # Bring all data to batch x materials:
+    data = [np.atleast_2d(np.asarray(i, dtype=float)) for i in (phantom_ctn, tabul_ctn, par_phantom, par_tiss)]
+    par_air = np.atleast_1d(np.asarray(par_air, dtype=float))
+    if phantom_keep is None:
+        phantom_keep = np.ones(n_phantom, dtype=bool)
+    if tabul_keep is None:
+        tabul_keep = np.ones(n_tiss, dtype=bool)
+    phantom_keep, tabul_keep = np.atleast_2d(phantom_keep), np.atleast_2d(tabul_keep)
+    n_batch = max([len(i) for i in data] + [len(par_air), len(phantom_keep), len(tabul_keep)])
+
+    ctn = np.concatenate((np.broadcast_to(data[0], (n_batch, n_phantom)),
+                          np.broadcast_to(data[1], (n_batch, n_tiss))), axis=1)
+    par = np.concatenate((np.broadcast_to(data[2], (n_batch, n_phantom)),
+                          np.broadcast_to(data[3], (n_batch, n_tiss))), axis=1)
+    par_air = np.broadcast_to(par_air, n_batch)
+
+    # Materials used for the fits (the phantom inserts are not used for MD) and the tissue groups:
+    used = np.concatenate((np.broadcast_to(phantom_keep & (datasheet['output_parameter'] != 'MD'),
+                                           (n_batch, n_phantom)),
+                           np.broadcast_to(tabul_keep, (n_batch, n_tiss))), axis=1)
+    tabulated = np.concatenate((np.zeros(n_phantom, dtype=bool), np.ones(n_tiss, dtype=bool)))
+    groups = np.concatenate((groups_phantom, groups_tiss))
+    lung, fat, soft, bone = [used & (groups == i) for i in (1, 2, 3, 4)]
+    for mask, name in [(fat & tabulated, 'adipose'), (soft & tabulated, 'soft'), (bone & tabulated, 'bone')]:
+        if not mask.any(axis=1).all():
+            raise ValueError('At least one tabulated human tissue of the {} tissue group is needed to fit '
+                             'the HLUT.'.format(name))
+
+    # Each straight line needs two points, without missing values:
+    for mask, name in [(lung | soft, 'lung and soft tissue'), (fat, 'adipose'), (bone, 'bone')]:
+        if (mask.sum(axis=1) < 2).any():
+            raise ValueError('At least two materials of the {} tissue group are needed to fit the HLUT.'.format(name))
+        if np.isnan(ctn[mask]).any() or np.isnan(par[mask]).any():
+            raise ValueError('The CT numbers or the reference values of the {} tissue group contain missing values, '
+                             'the HLUT cannot be fitted.'.format(name))
+
+    # Perform fit for each tissue group
+    p_lung_soft = linear_fit(ctn, par, lung | soft)
+    p_fat = linear_fit(ctn, par, fat)
+    p_bone = linear_fit(ctn, par, bone)
+
+    # Define connection points, following Table S1.4
+    min_tiss_fat = np.min(np.where(fat & tabulated, ctn, np.inf), axis=1)
+    max_tiss_soft = np.max(np.where(soft & tabulated, ctn, -np.inf), axis=1)
+    min_tiss_bone = np.min(np.where(bone & tabulated, ctn, np.inf), axis=1)
+    max_bone = np.max(np.where(bone, ctn, -np.inf), axis=1)
+
+    cp_ctn = np.empty((n_batch, 10))
+    cp_ctn[:, 0:3] = [-1024, -999, -950]  # lung, contains air
+    cp_ctn[:, 3] = np.round(min_tiss_fat - 60)
+    cp_ctn[:, 4] = np.round(min_tiss_fat - 40)  # adipose
+    cp_ctn[:, 5] = -30
+    cp_ctn[:, 6] = 0  # soft tissue
+    cp_ctn[:, 7] = np.round(max_tiss_soft) + 10
+    cp_ctn[:, 8] = np.round(min_tiss_bone + 50)  # bone
+    cp_ctn[:, 9] = np.where(max_bone > 2000, np.ceil((max_bone + 100) / 100) * 100, 2000)
+
+    # Calculate parameter value for connection points with the fit of the respective segment
+    segments = [p_lung_soft] * 4 + [p_fat] * 2 + [p_lung_soft] * 2 + [p_bone] * 2
+    slope = np.stack([i[0] for i in segments], axis=1)
+    intercept = np.stack([i[1] for i in segments], axis=1)
+    cp_par = slope * cp_ctn + intercept
+
+    # Adjust lowest parameter value for lung to value of air
+    cp_par[:, 0] = par_air
+    cp_par[:, 1] = par_air
+
+    # Define relevant digits in parameter
+    par_digits = 4  # number of digits to which to round the parameter
+    offs = 1 * 10 ** (-par_digits)  # parameter offset in case connecting points have the same value
+
+    # Check to see if slope of the segment connections are always positive
+    notes = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Check slope between air and lung
+        notes['air_lung'] = cp_par[:, 1] >= cp_par[:, 2]
+        cp_ctn[:, 2] = np.where(notes['air_lung'],
+                                np.ceil((cp_par[:, 1] + offs - p_lung_soft[1]) / p_lung_soft[0]), cp_ctn[:, 2])
+        cp_par[:, 2] = p_lung_soft[0] * cp_ctn[:, 2] + p_lung_soft[1]
+
+        # Check slope between lung and adipose
+        notes['lung_adipose'] = cp_par[:, 3] >= cp_par[:, 4]
+
+        # Check slope between Adipose and Soft Tissue
+        notes['adipose_soft'] = cp_par[:, 5] >= cp_par[:, 6]
+        cp_ctn[:, 5] = np.where(notes['adipose_soft'],
+                                np.floor((cp_par[:, 6] - offs - p_fat[1]) / p_fat[0]), cp_ctn[:, 5])
+        cp_par[:, 5] = p_fat[0] * cp_ctn[:, 5] + p_fat[1]
+
+        # Slope between Soft Tissue and Bone
+        notes['soft_bone'] = cp_par[:, 7] >= cp_par[:, 8]
+        cp_ctn[:, 8] = np.where(notes['soft_bone'],
+                                np.ceil((cp_par[:, 7] + offs - p_bone[1]) / p_bone[0]), cp_ctn[:, 8])
+        cp_par[:, 8] = p_bone[0] * cp_ctn[:, 8] + p_bone[1]
+
+    return cp_ctn, cp_par, notes
+
+
+def linear_fit(x, y, mask):
+    """
+    Least-squares straight lines through the selected points of each data set (as np.polyfit with degree 1)
+    Input:  x, y - data (batch x points)
+            mask - selection of the points (batch x points)
+    Output: slope, intercept - fitted lines (batch)
+    """
+
+    n = mask.sum(axis=1)
+    x = np.where(mask, x, 0)
+    y = np.where(mask, y, 0)
+    x_mean = x.sum(axis=1) / n
+    y_mean = y.sum(axis=1) / n
+    dx = np.where(mask, x - x_mean[:, np.newaxis], 0)
+    slope = np.sum(dx * (y - y_mean[:, np.newaxis]), axis=1) / np.sum(dx ** 2, axis=1)
+
+    return slope, y_mean - slope * x_mean
+
+
+def reference_values(datasheet, e_kin=None):
+    """
+    Reference values of the output parameter for the phantom inserts, the tabulated
+    human tissues and air
+    Input:  datasheet  - Dictionary containing data from excel sheets
+            e_kin - kinetic energy of the protons (MeV) as scalar or array, only for SPR.
+                    Default: E_prot of the datasheet. For other energies, the calculated SPR
+                    is used for the phantom inserts as well.
+    Output: par_phantom, par_tiss, par_air - reference values (one column per energy, if e_kin is an array)
+    """
+
     # Load relevant data from datasheet
     rho_w = datasheet['Data_water']['rho_w']
     wi_w = datasheet['Data_water']['wi_w']
     zi_w = datasheet['Data_water']['zi_w']
     ai_w = datasheet['Data_water']['ai_w']
 
-    # Initiate CT number and parameter (par) lists for each tissue group
-    ctn_tiss_fat, ctn_tiss_soft, ctn_tiss_bone = [], [], []
-    ctn_lung, ctn_fat, ctn_soft, ctn_bone = [], [], [], []
-    par_lung, par_fat, par_soft, par_bone = [], [], [], []
-
     # Load data based on the output_parameter
     if datasheet['output_parameter'] == 'SPR':
         # Check if measured SPR data exists for phantom
@@ -68,71 +258,7 @@ def hlut_fit(datasheet, phantom_ctn, tabul_ctn):
         par_type_phantom = 'Density (g/cm3)'
         par_type_tiss = 'Density (g/cm3)'
 
-    # Add CT numbers and parameters from phantom
-    if not (datasheet['output_parameter'] == 'MD'):
-        indexlist = datasheet['PhantomInserts']['Tissue group']  # tissue grouping
-        for i in range(len(indexlist)):
-            if indexlist[i] == 1:
-                ctn_lung.append(datasheet['CTnumbers'][phantom_ctn][i])
-                par_lung.append(datasheet['PhantomInserts'][par_type_phantom][i])
-            elif indexlist[i] == 2:
-                ctn_fat.append(datasheet['CTnumbers'][phantom_ctn][i])
-                par_fat.append(datasheet['PhantomInserts'][par_type_phantom][i])
-            elif indexlist[i] == 3:
-                ctn_soft.append(datasheet['CTnumbers'][phantom_ctn][i])
-                par_soft.append(datasheet['PhantomInserts'][par_type_phantom][i])
-            elif indexlist[i] == 4:
-                ctn_bone.append(datasheet['CTnumbers'][phantom_ctn][i])
-                par_bone.append(datasheet['PhantomInserts'][par_type_phantom][i])
-
-    # Add calculated CT numbers from tabulated human tissues
-    indexlist = datasheet['TabulatedHumanTissues']['Tissue group']  # tissue grouping
-    for i in range(len(indexlist)):
-        if indexlist[i] == 1:
-            ctn_lung.append(datasheet['TabulatedHumanTissues'][tabul_ctn][i])
-            par_lung.append(datasheet['TabulatedHumanTissues'][par_type_tiss][i])
-        elif indexlist[i] == 2:
-            ctn_tiss_fat.append(datasheet['TabulatedHumanTissues'][tabul_ctn][i])
-            ctn_fat.append(datasheet['TabulatedHumanTissues'][tabul_ctn][i])
-            par_fat.append(datasheet['TabulatedHumanTissues'][par_type_tiss][i])
-        elif indexlist[i] == 3:
-            ctn_tiss_soft.append(datasheet['TabulatedHumanTissues'][tabul_ctn][i])
-            ctn_soft.append(datasheet['TabulatedHumanTissues'][tabul_ctn][i])
-            par_soft.append(datasheet['TabulatedHumanTissues'][par_type_tiss][i])
-        elif indexlist[i] == 4:
-            ctn_tiss_bone.append(datasheet['TabulatedHumanTissues'][tabul_ctn][i])
-            ctn_bone.append(datasheet['TabulatedHumanTissues'][tabul_ctn][i])
-            par_bone.append(datasheet['TabulatedHumanTissues'][par_type_tiss][i])
-
-    # Perform fit for each tissue group
-    p_lung_soft = np.polyfit(ctn_lung + ctn_soft, par_lung + par_soft, 1)
-    p_fat = np.polyfit(ctn_fat, par_fat, 1)
-    p_bone = np.polyfit(ctn_bone, par_bone, 1)
-
-    # Define connection points, following Table S1.4
-    cp_ctn_lung = [-1024, -999, -950, np.round(min(ctn_tiss_fat) - 60)]  # contains air
-    cp_ctn_fat = [np.round(min(ctn_tiss_fat) - 40), -30]
-    cp_ctn_soft = [0, np.round(max(ctn_tiss_soft)) + 10]
-    if max(ctn_bone) > 2000:
-        cp_ctn_bone = [np.round(min(ctn_tiss_bone) + 50),
-                       np.ceil((max(ctn_bone) + 100)/100)*100]
-    else:
-        cp_ctn_bone = [np.round(min(ctn_tiss_bone) + 50), 2000]
-
-        # Initialize array for the matching parameter values
-    cp_par_lung, cp_par_fat, cp_par_soft, cp_par_bone = [], [], [], []
-
-    # Calculate parameter value for connection points
-    for i in cp_ctn_lung:
-        cp_par_lung.append(np.polyval(p_lung_soft, i))
-    for i in cp_ctn_fat:
-        cp_par_fat.append(np.polyval(p_fat, i))
-    for i in cp_ctn_soft:
-        cp_par_soft.append(np.polyval(p_lung_soft, i))
-    for i in cp_ctn_bone:
-        cp_par_bone.append(np.polyval(p_bone, i))
-
-    # Adjust lowest parameter value for lung to value of air, following NIST data
+    # Parameter value of air, following NIST data
     # from https://physics.nist.gov/cgi-bin/Star/compos.pl?matno=104
     rho_air = 1.20479E-03  # mass density
     zi_air = np.array([6, 7, 8, 18])  # atomic number of components
@@ -140,61 +266,90 @@ def hlut_fit(datasheet, phantom_ctn, tabul_ctn):
     wi_air = np.array([0.000124, 0.755267, 0.231781, 0.012827])  # weight fractions
     i_air = 85.7  # mean excitation energy
     rho_e_air = (rho_air * np.matmul(wi_air, (zi_air / ai_air)) / (rho_w * np.matmul(wi_w, zi_w / ai_w)))
-    spr_air = rho_e_air * (datasheet['constants']['spr_num'] - np.log(i_air)) / datasheet['constants']['spr_den']
 
-    # lowest value adjusted based on inputed ouput_parameter
-    if datasheet['output_parameter'] == 'SPR':
-        cp_par_lung[0], cp_par_lung[1] = spr_air, spr_air
-    elif datasheet['output_parameter'] == 'MD':
-        cp_par_lung[0], cp_par_lung[1] = rho_air, rho_air
-    elif datasheet['output_parameter'] == 'RED':
-        cp_par_lung[0], cp_par_lung[1] = rho_e_air, rho_e_air
+    if datasheet['output_parameter'] == 'SPR' and e_kin is not None:
+        # SPR for the requested energies, computed for all materials at once:
+        par_phantom = initialize_data.parameter_calculation(datasheet, 'PhantomInserts', e_kin)[0]
+        par_tiss = initialize_data.parameter_calculation(datasheet, 'TabulatedHumanTissues', e_kin)[0]
+        spr_num, spr_den = initialize_data.stopping_power_terms(datasheet, e_kin)
+        par_air = rho_e_air * (spr_num - np.log(i_air)) / spr_den
+    else:
+        par_phantom = np.array(datasheet['PhantomInserts'][par_type_phantom])
+        par_tiss = np.array(datasheet['TabulatedHumanTissues'][par_type_tiss])
+        if datasheet['output_parameter'] == 'SPR':
+            par_air = (rho_e_air * (datasheet['constants']['spr_num'] - np.log(i_air)) /
+                       datasheet['constants']['spr_den'])
+        elif datasheet['output_parameter'] == 'MD':
+            par_air = rho_air
+        elif datasheet['output_parameter'] == 'RED':
+            par_air = rho_e_air
 
-    # Define relevant digits in parameter
-    par_digits = 4  # number of digits to which to round the parameter
-    offs = 1 * 10 ** (-par_digits)  # parameter offset in case connecting points have the same value
+    return par_phantom, par_tiss, par_air
 
-    # Check to see if slope of the segment connections are always positive
 
-    # Check slope between air and lung
-    if cp_par_lung[1] >= cp_par_lung[2]:
-        cp_ctn_lung[2] = math.ceil((cp_par_lung[1] + offs - p_lung_soft[1]) / p_lung_soft[0])
-        cp_par_lung[2] = np.polyval(p_lung_soft, cp_ctn_lung[2])
+def hlut_family(datasheet, energies):
+    """
+    Fit an energy family of SPR HLUTs. The SPR of all materials is computed for all
+    energies at once, and the HLUTs of all energies are fitted in one batch.
+    Input:  datasheet  - Dictionary containing data from excel sheets, with estimated CT numbers
+            energies - kinetic energies of the protons (MeV), e.g. np.arange(70, 251)
+    Output: family - Dictionary with the energies and, per HLUT type, the connection points
+                     as arrays (energies x connection points)
+    """
 
-        note = "{} {} {} HU".format('--- The slope between air and lung tissue is negative or zero.',
-                                    'The CT number for the lower end of the lung tissue curve is increased to',
-                                    cp_ctn_lung[2])
-        print(note)
+    # Initiate loop parameters for HLUT generation
+    hluttype = ['head', 'body', 'avgdCT']  # the three parameter sets
+    phantomtype = ['CT number (Head)', 'CT number (Body)', 'CT number (averaged)']  # respective phantom CT numbers
+    ctnumbertype = ['ctn_calc_head', 'ctn_calc_body', 'ctn_calc_avgCT']  # respective calculated CT numbers
 
-    # Check slope between lung and adipose
-    if np.polyval(p_lung_soft, cp_ctn_lung[-1]) >= np.polyval(p_fat, cp_ctn_fat[0]):
-        print('--- The slope between lung and adipose is negative or zero. '
-              'This should not happen. Please revise your input data.')
+    energies = np.atleast_1d(np.asarray(energies, dtype=float))
+    datasheet_spr = dict(datasheet, output_parameter='SPR')
+    par_phantom, par_tiss, par_air = reference_values(datasheet_spr, energies)
 
-    # Check slope between Adipose and Soft Tissue
-    if cp_par_fat[-1] >= cp_par_soft[0]:
-        cp_ctn_fat[-1] = math.floor((cp_par_soft[0] - offs - p_fat[1]) / p_fat[0])
-        cp_par_fat[-1] = np.polyval(p_fat, cp_ctn_fat[-1])
+    family = {'energies': energies}
+    for i in range(0, len(hluttype)):
+        cp_ctn, cp_spr, notes = hlut_fit_batch(datasheet_spr, np.asarray(datasheet['CTnumbers'][phantomtype[i]]),
+                                               np.asarray(datasheet['TabulatedHumanTissues'][ctnumbertype[i]]),
+                                               (par_phantom.T, par_tiss.T, par_air))
+        family[hluttype[i]] = {'ctn': cp_ctn, 'SPR': cp_spr}
 
-        note = "{} {} {} HU".format('--- The slope between adipose and soft tissue is negative or zero.',
-                                    'The CT number for the upper end of the adipose curve is thus lowered to',
-                                    cp_ctn_fat[-1])
-        print(note)
+    return family
 
-    # Slope between Soft Tissue and Bone
-    if cp_par_soft[-1] >= cp_par_bone[0]:
-        cp_ctn_bone[0] = math.ceil((cp_par_soft[-1] + offs - p_bone[1]) / p_bone[0])
-        cp_par_bone[0] = np.polyval(p_bone, cp_ctn_bone[0])
 
-        note = "{} {} {} HU".format('--- The slope between soft tissue and bone is negative.',
-                                    'The CT number for the lower end of the bone curve is increased to', cp_ctn_bone[0])
-        print(note)
+def family_main(datasheet, energies):
+    """
+    Energy family of SPR HLUTs for the evaluation (see hlut_family)
+    Input:  datasheet  - Dictionary containing all calculated and measured data, with estimated CT numbers
+            energies - kinetic energies of the protons (MeV)
+    Output: datasheet, addended with the HLUT family, which is also written to a text file in the output folder
+    """
 
-    # Create overall list containing all numbers
-    cp_ctn = cp_ctn_lung + cp_ctn_fat + cp_ctn_soft + cp_ctn_bone
-    cp_par = cp_par_lung + cp_par_fat + cp_par_soft + cp_par_bone
+    datasheet['hlut_family'] = hlut_family(datasheet, energies)
 
-    return cp_ctn, cp_par
+    if datasheet['output'] is not None:
+        write_family(datasheet)
+
+    return datasheet
+
+
+def write_family(datasheet):
+    """
+    Write the connection points of the energy family of SPR HLUTs to a text file
+    Input:  datasheet - Dictionary containing all calculated and measured data
+    """
+
+    family = datasheet['hlut_family']
+
+    file_name = '{}/SPR_HLUT_family.txt'.format(datasheet['output'])
+    profiling.record_file(datasheet, file_name)
+    with open(file_name, 'w') as f:
+        f.write('SPR HLUTs for {} proton energies\n'.format(len(family['energies'])))
+        for hluttype in ['head', 'body', 'avgdCT']:
+            f.write('\nHLUT {}\n'.format(hluttype))
+            f.write('\t'.join(['E_prot (MeV)', 'CT number', 'SPR']) + '\n')
+            for energy, cp_ctn, cp_spr in zip(family['energies'], family[hluttype]['ctn'], family[hluttype]['SPR']):
+                for ctn, spr in zip(cp_ctn, cp_spr):
+                    f.write('{:g}\t{}\t{}\n'.format(energy, round(ctn), np.round(spr, decimals=4)))
 
 
 def hlut_export(datasheet, hluttype, recon_type):
@@ -207,28 +362,18 @@ def hlut_export(datasheet, hluttype, recon_type):
 
     # Export of .txt file
     for i in hluttype:
-        filename = '{}_HLUT_{}'.format(datasheet['output_parameter'], i)
-        with open('{}/{}.txt'.format(datasheet['output'], filename), 'w') as f:
-            ctn = datasheet['HLUTs'][i]['ctn']
-            par = datasheet['HLUTs'][i][datasheet['output_parameter']]
-            if recon_type == 'regular':
-                if datasheet['output_parameter'] == 'MD':
-                    f.write('CT number\t{} (g/cm3)\n'.format(datasheet['output_parameter']))
-                else:
-                    f.write('CT number\t{}\n'.format(datasheet['output_parameter']))
-            elif recon_type == 'DD':
-                if datasheet['output_parameter'] == 'MD':
-                    f.write('DD CT number\t{} (g/cm3)\n'.format(datasheet['output_parameter']))
-                else:
-                    f.write('DD CT number\t{}\n'.format(datasheet['output_parameter']))
-            for line in range(0, len(ctn)):
-                f.write(f'{round(ctn[line])}\t' + f'{np.round(par[line], decimals=4)}\n')
+        filename = '{}/{}_HLUT_{}.txt'.format(datasheet['output'], datasheet['output_parameter'], i)
+        profiling.record_file(datasheet, filename)
+        with open(filename, 'w') as f:
+            for row in hlut_rows(datasheet, i, recon_type):
+                f.write('\t'.join(row) + '\n')
 
     # Export of .csv file
     # CT number in first line set to -1000 instead of -1024 for use in RayStation
     for i in hluttype:
-        filename = '{}_HLUT_{}'.format(datasheet['output_parameter'], i)
-        with open('{}/{}.csv'.format(datasheet['output'], filename), 'w') as f:
+        filename = '{}/{}_HLUT_{}.csv'.format(datasheet['output'], datasheet['output_parameter'], i)
+        profiling.record_file(datasheet, filename)
+        with open(filename, 'w') as f:
             ctn = datasheet['HLUTs'][i]['ctn']
             par = datasheet['HLUTs'][i][datasheet['output_parameter']]
             f.write('-1000, ' + f'{np.round(par[0], decimals=4)} \n')
@@ -236,20 +381,44 @@ def hlut_export(datasheet, hluttype, recon_type):
                 f.write(f'{round(ctn[line])}, ' + f'{np.round(par[line], decimals=4)} \n')
 
 
+def hlut_rows(datasheet, hluttype, recon_type):
+    """
+    Table of the connection points of a HLUT, as written to the .txt file and the PDF report
+    Input:  datasheet - Dictionary containing all calculated and measured data
+            hluttype - 'head', 'body' or 'avgdCT'
+            recon_type - Reconstruction type (regular or DD)
+    Output: rows of the table (strings), starting with the header
+    """
+
+    ctn = datasheet['HLUTs'][hluttype]['ctn']
+    par = datasheet['HLUTs'][hluttype][datasheet['output_parameter']]
+    header = 'CT number' if recon_type == 'regular' else 'DD CT number'
+    unit = ' (g/cm3)' if datasheet['output_parameter'] == 'MD' else ''
+
+    rows = [[header, datasheet['output_parameter'] + unit]]
+    for line in range(0, len(ctn)):
+        rows.append([f'{round(ctn[line])}', f'{np.round(par[line], decimals=4)}'])
+
+    return rows
+
+
 def plot_hlut(datasheet, hluttype, recon_type):
     """
     Export of plots of the three different HLUTs
     Input:  datasheet - Dictionary containing all calculated and measured data
             hluttype - HLUT to be exported
-    Output: Plots of the HLUTs as .pdf and .svg
+    Output: Plots of the HLUTs as .pdf
     """
 
+    from matplotlib.figure import Figure
+
     # Define colors for plot
     c_con, c_lung, c_fat, c_soft, c_bone = ('black', 'gold', 'darkorange', 'green', 'steelblue')
 
     # Initialize plot data
     for i in hluttype:
-        fig, ax = plt.subplots(figsize=(10, 4))
+        fig = Figure(figsize=(10, 4))
+        ax = fig.subplots()
 
         ## Uniform for all output parameters
         x = datasheet['HLUTs'][i]['ctn']
@@ -289,42 +458,42 @@ def plot_hlut(datasheet, hluttype, recon_type):
         if not (datasheet['output_parameter'] == 'MD'):
             for j in range(0, len(datasheet['PhantomInserts']['Tissue group'])):
                 if datasheet['PhantomInserts']['Tissue group'][j] == 1:
-                    plt.plot(ht_x[j], ht_y[j], 'o', color=c_lung, markersize=ms)
+                    ax.plot(ht_x[j], ht_y[j], 'o', color=c_lung, markersize=ms)
                 elif datasheet['PhantomInserts']['Tissue group'][j] == 2:
-                    plt.plot(ht_x[j], ht_y[j], 'o', color=c_fat, markersize=ms)
+                    ax.plot(ht_x[j], ht_y[j], 'o', color=c_fat, markersize=ms)
                 elif datasheet['PhantomInserts']['Tissue group'][j] == 3:
-                    plt.plot(ht_x[j], ht_y[j], 'o', color=c_soft, markersize=ms)
+                    ax.plot(ht_x[j], ht_y[j], 'o', color=c_soft, markersize=ms)
                 elif datasheet['PhantomInserts']['Tissue group'][j] == 4:
-                    plt.plot(ht_x[j], ht_y[j], 'o', color=c_bone, markersize=ms)
+                    ax.plot(ht_x[j], ht_y[j], 'o', color=c_bone, markersize=ms)
 
         # Plot tabulated tissue datapoints according to their tissue group
         for j in range(0, len(datasheet['TabulatedHumanTissues']['Tissue group'])):
             if datasheet['TabulatedHumanTissues']['Tissue group'][j] == 1:
-                plt.plot(ins_x[j], ins_y[j], 'o', color=c_lung, markersize=ms)
+                ax.plot(ins_x[j], ins_y[j], 'o', color=c_lung, markersize=ms)
             elif datasheet['TabulatedHumanTissues']['Tissue group'][j] == 2:
-                plt.plot(ins_x[j], ins_y[j], 'o', color=c_fat, markersize=ms)
+                ax.plot(ins_x[j], ins_y[j], 'o', color=c_fat, markersize=ms)
             elif datasheet['TabulatedHumanTissues']['Tissue group'][j] == 3:
-                plt.plot(ins_x[j], ins_y[j], 'o', color=c_soft, markersize=ms)
+                ax.plot(ins_x[j], ins_y[j], 'o', color=c_soft, markersize=ms)
             elif datasheet['TabulatedHumanTissues']['Tissue group'][j] == 4:
-                plt.plot(ins_x[j], ins_y[j], 'o', color=c_bone, markersize=ms)
+                ax.plot(ins_x[j], ins_y[j], 'o', color=c_bone, markersize=ms)
 
         # Plot the HLUT
-        plt.plot([], [], color=c_lung, label='Lung tissues')  # just for legend
-
-        plt.plot(x[0:2], y[0:2], color=c_con, ls=ls)  # Horizontal part
-        plt.plot(x[1:3], y[1:3], color=c_con, ls=ls)  # Connection within lung
-        plt.plot(x[2:4], y[2:4], color=c_soft)  # Lung
-        plt.plot(x[2:4], y[2:4], color=c_lung, ls=(2, (2, 2)))  # Lung
-        plt.plot(x[3:5], y[3:5], color=c_con, ls=ls)  # Connection lung to fat
-        plt.plot(x[4:6], y[4:6], color=c_fat, label='Adipose tissues')  # Fat
-        plt.plot(x[5:7], y[5:7], color=c_con, ls=ls)  # Connection fat to soft
-        plt.plot(x[6:8], y[6:8], color=c_soft, label='Soft tissues')  # Soft
-        plt.plot(x[6:8], y[6:8], color=c_lung, ls=(2, (2, 2)))  # Soft
-        plt.plot(x[7:9], y[7:9], color=c_con, ls=ls)  # Connection soft to bone
-        plt.plot(x[8:10], y[8:10], color=c_bone, label='Bone tissues')  # Bone
-        plt.plot(x[9:11], y[9:11], color=c_bone)  # End of bone
-
-        plt.plot([], [], color=c_con, ls=ls, label='Connection lines')  # just for legend
+        ax.plot([], [], color=c_lung, label='Lung tissues')  # just for legend
+
+        ax.plot(x[0:2], y[0:2], color=c_con, ls=ls)  # Horizontal part
+        ax.plot(x[1:3], y[1:3], color=c_con, ls=ls)  # Connection within lung
+        ax.plot(x[2:4], y[2:4], color=c_soft)  # Lung
+        ax.plot(x[2:4], y[2:4], color=c_lung, ls=(2, (2, 2)))  # Lung
+        ax.plot(x[3:5], y[3:5], color=c_con, ls=ls)  # Connection lung to fat
+        ax.plot(x[4:6], y[4:6], color=c_fat, label='Adipose tissues')  # Fat
+        ax.plot(x[5:7], y[5:7], color=c_con, ls=ls)  # Connection fat to soft
+        ax.plot(x[6:8], y[6:8], color=c_soft, label='Soft tissues')  # Soft
+        ax.plot(x[6:8], y[6:8], color=c_lung, ls=(2, (2, 2)))  # Soft
+        ax.plot(x[7:9], y[7:9], color=c_con, ls=ls)  # Connection soft to bone
+        ax.plot(x[8:10], y[8:10], color=c_bone, label='Bone tissues')  # Bone
+        ax.plot(x[9:11], y[9:11], color=c_bone)  # End of bone
+
+        ax.plot([], [], color=c_con, ls=ls, label='Connection lines')  # just for legend
 
         if recon_type == 'regular':
             ax.set_title('{} HLUT for {} CT numbers'.format(datasheet['output_parameter'], i))
@@ -355,7 +524,7 @@ def plot_hlut(datasheet, hluttype, recon_type):
         ax.set_ylim([0, y_max])
         ax.yaxis.grid(which='major', color='gray', linestyle='-', alpha=0.3)  # vertical lines (major)
 
-        plt.legend()
+        ax.legend()
 
         # Plot inset
         axins = ax.inset_axes([0.55, 0.1, 0.4, 0.4])
@@ -397,9 +566,4 @@ def plot_hlut(datasheet, hluttype, recon_type):
         axins.set_ylim(0.8, 1.2)
         ax.indicate_inset_zoom(axins, edgecolor="black")
 
-        plt.savefig('{}/for_report/svg/hlut_{}.svg'.format(datasheet['output'], i))
-        plt.savefig('{}/for_report/svg/hlut_{}.pdf'.format(datasheet['output'], i), bbox_inches="tight", dpi=300)
-        
-        plt.clf()
-        plt.cla()
-        plt.close()
\ No newline at end of file
+        figures.save_figure(datasheet, fig, 'hlut_{}'.format(i))
\ No newline at end of file
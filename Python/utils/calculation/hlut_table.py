@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Compiled HLUT tables
+
+A fitted HLUT is given by its connection points. For the evaluation and the conversion
+of CT images, it is compiled to a dense table with one value per integer CT number,
+from the first to the last connection point (-1024 HU to the end of the bone curve).
+The tables of the fitted HLUTs of a run are compiled once after the HLUT fit and kept
+in datasheet['hlut_tables'], from where they are shared by all evaluation boxes.
+
+% SPDX-License-Identifier: MIT
+"""
+
+import numpy as np
+
+# Policies for CT numbers outside of the HLUT:
+OUT_OF_RANGE = ['raise', 'clip', 'nan', 'extrapolate']
+
+
+def compile_hlut(cp_ctn, cp_par, dtype=np.float64, out_of_range='raise'):
+    """
+    Compile a HLUT to a dense table over integer CT numbers. The HLUT is linear between
+    the connection points, so the table is exact for connection points at integer CT numbers.
+    Input:  cp_ctn, cp_par - connection points (CTN, parameter)
+            dtype - storage type of the table values, np.float32 or np.float64
+            out_of_range - default policy of lookup for CT numbers outside of the HLUT:
+                           'raise' (ValueError), 'clip' (value at the closest end of the HLUT),
+                           'nan' or 'extrapolate' (first and last HLUT segment)
+    Output: table - Dictionary with the dense values, the CT number of the first value (offset),
+                    the sorted connection points and the out-of-range policy
+    """
+
+    check_policy(out_of_range)
+    if np.dtype(dtype) not in (np.float32, np.float64):
+        raise ValueError('Invalid dtype {}. It should be float32 or float64.'.format(np.dtype(dtype)))
+
+    # Connection points in increasing order of the CT numbers:
+    cp_ctn = np.asarray(cp_ctn, dtype=float)
+    cp_par = np.asarray(cp_par, dtype=float)
+    order = np.argsort(cp_ctn, kind='stable')
+    cp_ctn, cp_par = cp_ctn[order], cp_par[order]
+
+    # Dense values for all integer CT numbers of the HLUT:
+    offset = int(np.floor(cp_ctn[0]))
+    values = np.interp(np.arange(offset, int(np.ceil(cp_ctn[-1])) + 1), cp_ctn, cp_par).astype(dtype)
+
+    return {'values': values, 'offset': offset, 'ctn': cp_ctn, 'par': cp_par, 'out_of_range': out_of_range}
+
+
+def lookup(table, ctn, out_of_range=None):
+    """
+    Output parameter for CT numbers from a compiled HLUT table. Integer CT numbers
+    (e.g. int16 images) are looked up directly, other CT numbers are interpolated
+    linearly between the neighbouring table values. NaN gives NaN.
+    Input:  table - compiled HLUT from compile_hlut
+            ctn - CT numbers (scalar or array of any shape)
+            out_of_range - policy for CT numbers outside of the HLUT, default: policy of the table
+    Output: par - output parameter (array with the shape of ctn, in the storage type of the table)
+    """
+
+    out_of_range = table['out_of_range'] if out_of_range is None else out_of_range
+    check_policy(out_of_range)
+
+    values = table['values']
+    first = table['offset']
+    last = first + len(values) - 1
+    ctn = np.asarray(ctn)
+    integer = np.issubdtype(ctn.dtype, np.integer)
+    if not integer:
+        ctn = ctn.astype(np.float64, copy=False)
+
+    # Check the range first with reductions, the mask is only needed for CT numbers outside of the HLUT:
+    outside = None
+    if ctn.size > 0:
+        if integer:
+            low, high = ctn.min(), ctn.max()
+        else:
+            low, high = np.nanmin(ctn, initial=first), np.nanmax(ctn, initial=last)
+        if low < first or high > last:
+            outside = (ctn < first) | (ctn > last)
+            if out_of_range == 'raise':
+                raise ValueError('{} CT numbers between {} HU and {} HU are outside of the HLUT ({} HU to {} HU).'
+                                 .format(np.count_nonzero(outside), ctn[outside].min(), ctn[outside].max(), first,
+                                         last))
+
+    if integer:
+        if outside is None:
+            index = np.subtract(ctn, first, dtype=np.intp)
+        else:
+            index = np.clip(ctn, first, last).astype(np.intp) - first
+        par = np.array(values[index])
+    else:
+        position = np.array(np.clip(ctn, first, last) - first)
+        missing = np.isnan(position)
+        position[missing] = 0
+        lower = np.minimum(position.astype(np.intp), max(len(values) - 2, 0))
+        upper = np.minimum(lower + 1, len(values) - 1)
+        par = np.array(values[lower] + (position - lower) * (values[upper] - values[lower]), dtype=values.dtype)
+        par[missing] = np.nan
+
+    if outside is not None:
+        if out_of_range == 'nan':
+            par[outside] = np.nan
+        elif out_of_range == 'extrapolate':
+            below, above = ctn < first, ctn > last
+            slope_first = (table['par'][1] - table['par'][0]) / (table['ctn'][1] - table['ctn'][0])
+            slope_last = (table['par'][-1] - table['par'][-2]) / (table['ctn'][-1] - table['ctn'][-2])
+            par[below] = table['par'][0] + (ctn[below] - table['ctn'][0]) * slope_first
+            par[above] = table['par'][-1] + (ctn[above] - table['ctn'][-1]) * slope_last
+
+    return par
+
+
+def compile_hluts(datasheet):
+    """
+    Compile the tables of all fitted HLUTs of the run
+    Input:  datasheet - Dictionary containing all calculated and measured data, with fitted HLUTs
+    Output: datasheet, addended with the compiled tables per HLUT type (datasheet['hlut_tables'])
+    """
+
+    datasheet['hlut_tables'] = {}
+    for hluttype, hlut in datasheet['HLUTs'].items():
+        source = (list(hlut['ctn']), list(hlut[datasheet['output_parameter']]))
+        datasheet['hlut_tables'][hluttype] = dict(compile_hlut(*source), source=source)
+
+    return datasheet
+
+
+def hlut_evaluator(datasheet, hluttype):
+    """
+    Compiled table of a fitted HLUT of the run, from datasheet['hlut_tables'] (see compile_hluts).
+    If the table is missing or the connection points have changed, it is compiled, but not stored.
+    Input:  datasheet - Dictionary containing all calculated and measured data, with fitted HLUTs
+            hluttype - 'head', 'body' or 'avgdCT'
+    Output: table - compiled HLUT (see compile_hlut)
+    """
+
+    hlut = datasheet['HLUTs'][hluttype]
+    source = (list(hlut['ctn']), list(hlut[datasheet['output_parameter']]))
+    table = datasheet.get('hlut_tables', {}).get(hluttype)
+    if table is None or table.get('source') != source:
+        table = compile_hlut(*source)
+
+    return table
+
+
+def evaluate_hluts(datasheet, hluttypes, ctn, out_of_range=None):
+    """
+    Batched evaluation of fitted HLUTs of the run, with the compiled tables of hlut_evaluator
+    Input:  datasheet - Dictionary containing all calculated and measured data, with fitted HLUTs
+            hluttypes - HLUT type, or list of HLUT types evaluated for the same CT numbers
+            ctn - CT numbers (scalar or array of any shape)
+            out_of_range - see lookup
+    Output: par - output parameter with the shape of ctn, for a list of HLUT types stacked along
+                  the first axis (HLUT types x shape of ctn)
+    """
+
+    if isinstance(hluttypes, str):
+        return lookup(hlut_evaluator(datasheet, hluttypes), ctn, out_of_range)
+
+    ctn = np.asarray(ctn)
+    return np.stack([lookup(hlut_evaluator(datasheet, i), ctn, out_of_range) for i in hluttypes])
+
+
+def check_policy(out_of_range):
+    """
+    Check that the out-of-range policy is valid
+    Input:  out_of_range - policy to be checked
+    """
+
+    if out_of_range not in OUT_OF_RANGE:
+        raise ValueError("Invalid out-of-range policy '{}'. It should be one of {}.".format(out_of_range,
+                                                                                          OUT_OF_RANGE))
@@ -8,43 +8,78 @@ Initialize data for the HLUT definition
 import pandas as pd
 import numpy as np
 import os
+import hashlib
+import pickle
 from datetime import datetime
 
+# Version of the cache file format. Increase when the content of the cached sheets changes:
+CACHE_VERSION = 1
+
+
+def main(output_folder_name, output_parameter, input_folder_name, file_name, e_prot, use_cache=True):
+    # Create Results folder with a dedicated subfolder for this specific run of the code:
+    output = create_output_folder(output_folder_name, output_parameter)
+
+    # Load data from excel file
+    excelfile = input_folder_name + '/' + file_name
+    del input_folder_name
+    sheets = read_workbook(excelfile, use_cache)
+
+    return initialize(sheets, output_parameter, e_prot, output)
+
+
+def create_output_folder(output_folder_name, output_parameter):
+    """
+    Create the Results folder and a dedicated subfolder for this specific run of the code
+    Input:  output_folder_name - name of the Results folder
+            output_parameter - MD, RED or SPR
+    Output: output - path of the subfolder
+    """
 
-def main(output_folder_name, output_parameter, input_folder_name, file_name, e_prot):
     # Create Results folder:
-    if not os.path.exists(f'{output_folder_name}'):
-        os.makedirs(f'{output_folder_name}')
+    os.makedirs(f'{output_folder_name}', exist_ok=True)
     # Make dedicated subfolder for this sepcific run of the code:
     output_folder_name_subfolder = 'Results_' + output_parameter + '_' + datetime.now().strftime("%Y%m%d_%H%M%S")
-    # If this subfolder already exists, then add a number:
+    # If this subfolder already exists (e.g. created by a parallel run), then add a number:
     output_folder_name_subfolder_i = output_folder_name_subfolder
-    diffname = 0
     ii = 0
-    while diffname == 0:
-        diffname = 1
-        if os.path.exists(output_folder_name + '/' + output_folder_name_subfolder_i):
+    while True:
+        try:
+            os.makedirs(output_folder_name + '/' + output_folder_name_subfolder_i)
+            break
+        except FileExistsError:
             ii += 1
             output_folder_name_subfolder_i = output_folder_name_subfolder + '_' + str(ii)
-            diffname = 0
     output_folder_name_subfolder = output_folder_name_subfolder_i
-    os.makedirs(output_folder_name + '/' + output_folder_name_subfolder + '/for_report/svg')
-    del output_folder_name_subfolder_i, diffname, ii
+    os.makedirs(output_folder_name + '/' + output_folder_name_subfolder + '/for_report')
+
+    return output_folder_name + '/' + output_folder_name_subfolder
+
+
+def initialize(sheets, output_parameter, e_prot, output=None):
+    """
+    Set up the datasheet from the sheets of the Excel file. The sheets are
+    copied, so the DataFrames passed in are not modified.
+    Input:  sheets - Dictionary with one DataFrame per sheet of the Excel file
+            output_parameter - MD, RED or SPR
+            e_prot - initial energy of the proton beam (MeV)
+            output - folder to write results to, or None to write no files
+    Output: datasheet - Dictionary containing data from excel sheets and the reference values
+    """
 
-    # Load data from excel file
     datasheet = {}
     datasheet['output_parameter'] = output_parameter
-    datasheet['output'] = output_folder_name + '/' + output_folder_name_subfolder
-    excelfile = input_folder_name + '/' + file_name
-    del input_folder_name
-    xls = pd.ExcelFile(excelfile)
-    for sheet_name in xls.sheet_names:
-        datasheet[sheet_name] = xls.parse(sheet_name)
+    datasheet['output'] = output
+    for sheet_name in sheets:
+        datasheet[sheet_name] = sheets[sheet_name].copy()
 
     # Import parameters for water, elemental composition and constant values
     import_initialdata(datasheet)
     datasheet['constants'].update({'E_prot': e_prot})
 
+    # Compile the element and material terms shared by all physics kernels:
+    datasheet['basis'] = material_basis(datasheet)
+
     # Calculate reference values for phantom inserts and tabulated human tissues:
     (datasheet['TabulatedHumanTissues']['SPR_calc'], datasheet['TabulatedHumanTissues']['rhoe_calc'],
      datasheet['TabulatedHumanTissues']['Zeff_calc'], datasheet['TabulatedHumanTissues']['I_calc']) = (
@@ -63,6 +98,85 @@ def main(output_folder_name, output_parameter, input_folder_name, file_name, e_p
     return datasheet
 
 
+def set_proton_energy(datasheet, e_prot):
+    """
+    Recalculate the SPR reference values for another initial energy of the proton beam.
+    The stoichiometric calibration does not depend on the energy, so one calibration
+    can be shared by the SPR HLUTs for several energies.
+    Input:  datasheet - Dictionary containing all calculated and measured data (modified)
+            e_prot - initial energy of the proton beam (MeV)
+    """
+
+    datasheet['constants'].update({'E_prot': e_prot})
+    for dataset in ['TabulatedHumanTissues', 'PhantomInserts']:
+        datasheet[dataset]['SPR_calc'] = parameter_calculation(datasheet, dataset)[0]
+
+
+def read_workbook(excelfile, use_cache=True):
+    """
+    Load all sheets of the Excel file. The parsed sheets are cached in binary
+    form in the folder '.cache' next to the Excel file. The cache is keyed by
+    the SHA-256 hash of the file content, so a changed workbook is parsed again.
+    Input:  excelfile - path to the Excel file
+            use_cache - if False, the Excel file is always parsed and no cache is written
+    Output: sheets - Dictionary with one DataFrame per sheet
+    """
+
+    if not use_cache:
+        return parse_workbook(excelfile)
+
+    cache_folder = os.path.join(os.path.dirname(excelfile), '.cache')
+    cache_file = os.path.join(cache_folder, '{}_v{}.pkl'.format(file_hash(excelfile), CACHE_VERSION))
+
+    # Reload the parsed sheets, if this workbook has been parsed before:
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            print('--- The cache file {} could not be read. The Excel file is parsed again.'.format(cache_file))
+
+    sheets = parse_workbook(excelfile)
+
+    # Write to a temporary file first, so that parallel runs never read a partially written cache:
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        cache_file_tmp = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(cache_file_tmp, 'wb') as f:
+            pickle.dump(sheets, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file_tmp, cache_file)
+    except OSError:
+        print('--- The parsed Excel file could not be cached in {}.'.format(cache_folder))
+
+    return sheets
+
+
+def file_hash(excelfile):
+    """
+    SHA-256 hash of the content of the Excel file
+    Input:  excelfile - path to the Excel file
+    Output: hexadecimal hash
+    """
+
+    with open(excelfile, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def parse_workbook(excelfile):
+    """
+    Parse all sheets of the Excel file
+    Input:  excelfile - path to the Excel file
+    Output: sheets - Dictionary with one DataFrame per sheet
+    """
+
+    sheets = {}
+    with pd.ExcelFile(excelfile) as xls:
+        for sheet_name in xls.sheet_names:
+            sheets[sheet_name] = xls.parse(sheet_name)
+
+    return sheets
+
+
 def import_initialdata(datasheet):
     """
     Initialize phantom-independent parameters and load elements
@@ -90,51 +204,119 @@ def import_initialdata(datasheet):
     return datasheet
 
 
-def parameter_calculation(datasheet, dataset):
+def material_basis(datasheet, datasets=('PhantomInserts', 'TabulatedHumanTissues')):
     """
-    Calculate the SPR, RED and EAN for materials in the excel sheet
+    Compile the element and material terms used by parameter_calculation,
+    k_value_fit_batch and ctn_calculation_batch once per run: the element vectors, the
+    power terms of the stoichiometric model, the water terms and, per dataset,
+    a contiguous float64 weight-fraction matrix with the derived material terms.
     Input:  datasheet  - Dictionary containing data from excel sheets
-            dataset - either PhantomInserts or TabulatedHumanTissues
-    Output: spr_theor, rho_e_mat, zeff_mat, i_mat array - parameters for the respective materials
+            datasets - sheets with materials (mass density and elemental composition)
+    Output: basis - Dictionary with the precomputed terms
     """
 
     # Load relevant data from datasheet
-    density_mat = np.array(datasheet[dataset]['Density (g/cm3)'])  # mass density
-    zi = np.array(datasheet['ElementParameters']['Zi'])  # atomic numbers
-    ai = np.array(datasheet['ElementParameters']['Ai'])  # atomic mass
-    ii = np.array(datasheet['ElementParameters']['Ii'])  # mean excitation energy
-    wi_mat = np.array(pd.DataFrame(datasheet[dataset], columns=datasheet['elements']))  # weight fraction
+    zi = np.array(datasheet['ElementParameters']['Zi'], dtype=np.float64)  # atomic numbers
+    ai = np.array(datasheet['ElementParameters']['Ai'], dtype=np.float64)  # atomic mass
+    ii = np.array(datasheet['ElementParameters']['Ii'], dtype=np.float64)  # mean excitation energy
     rho_w = datasheet['Data_water']['rho_w']
     wi_w = datasheet['Data_water']['wi_w']
     zi_w = datasheet['Data_water']['zi_w']
     ai_w = datasheet['Data_water']['ai_w']
     ii_w = datasheet['Data_water']['ii_w']
-    e_0 = datasheet['constants']['e_0']
-    m_e = datasheet['constants']['m_e']
-    e_kin = datasheet['constants']['E_prot']
+
+    # Element terms: electrons per mass, Eq. 9 and Eq. 10 in Schneider et al. 1996, EAN and ln(I)
+    basis = {'zi': zi, 'ai': ai, 'ii': ii}
+    basis['zi_ai'] = zi / ai
+    basis['z_tilde_i'] = zi ** (3.62 + 1) / ai
+    basis['z_hat_i'] = zi ** (1.86 + 1) / ai
+    basis['zeff_i'] = zi ** (3.1 + 1) / ai
+    basis['ln_i_i'] = (zi / ai) * np.log(ii)
+
+    # Water terms
+    basis['rho_w'] = rho_w
+    basis['ng_w'] = np.matmul(wi_w, (zi_w / ai_w))
+    basis['z_tilde_w'] = np.matmul(wi_w, zi_w ** (3.62 + 1) / ai_w) / basis['ng_w']
+    basis['z_hat_w'] = np.matmul(wi_w, zi_w ** (1.86 + 1) / ai_w) / basis['ng_w']
+    basis['ln_i_w'] = np.matmul(wi_w, ((zi_w / ai_w) * np.log(ii_w))) / basis['ng_w']
+
+    # Material terms for each dataset
+    for dataset in datasets:
+        wi_mat = np.ascontiguousarray(
+            datasheet[dataset].reindex(columns=datasheet['elements']).to_numpy(dtype=np.float64))
+        ng = np.matmul(wi_mat, basis['zi_ai'])
+        basis[dataset] = {'density': np.array(datasheet[dataset]['Density (g/cm3)'], dtype=np.float64),
+                          'wi': wi_mat,
+                          'ng': ng,
+                          'z_tilde': np.matmul(wi_mat, basis['z_tilde_i']) / ng,
+                          'z_hat': np.matmul(wi_mat, basis['z_hat_i']) / ng}
+
+    return basis
+
+
+def parameter_calculation(datasheet, dataset, e_kin=None):
+    """
+    Calculate the SPR, RED and EAN for materials in the excel sheet
+    Input:  datasheet  - Dictionary containing data from excel sheets
+            dataset - either PhantomInserts or TabulatedHumanTissues
+            e_kin - kinetic energy of the protons (MeV), scalar or array. Default: E_prot of the datasheet.
+                    For an array of energies, the SPR of all materials and energies is computed in one
+                    broadcasted computation.
+    Output: spr_theor, rho_e_mat, zeff_mat, i_mat array - parameters for the respective materials
+            (spr_theor has the shape materials x energies, if e_kin is an array)
+    """
+
+    # Load relevant data from the material basis
+    basis = datasheet['basis']
+    material = basis[dataset]
 
     # Calculate relative electron density for materials
-    rho_e_mat = (density_mat * np.matmul(wi_mat, (zi / ai)) / (rho_w * np.matmul(wi_w, zi_w / ai_w)))
+    rho_e_mat = material['density'] * material['ng'] / (basis['rho_w'] * basis['ng_w'])
 
     # Calculate effective atomic number
     beta_zeff = 3.1  # Parameter for the power equation
-    zeff_mat = (np.matmul(wi_mat, zi ** (beta_zeff + 1) / ai) / np.matmul(wi_mat, zi / ai)) ** (1 / beta_zeff)
+    zeff_mat = (np.matmul(material['wi'], basis['zeff_i']) / material['ng']) ** (1 / beta_zeff)
 
-    # Calculate ln(I) for materials and for water
-    ln_i_mat = (np.matmul(wi_mat, ((zi / ai) * np.log(ii))) / np.matmul(wi_mat, (zi / ai)))
-    ln_i_w = (np.matmul(wi_w, ((zi_w / ai_w) * np.log(ii_w))) / np.matmul(wi_w, (zi_w / ai_w)))
+    # Calculate ln(I) for materials
+    ln_i_mat = np.matmul(material['wi'], basis['ln_i_i']) / material['ng']
 
     # Calculate mean excitation energy I following Bragg rule
     i_mat = np.exp(ln_i_mat)
 
+    # Calculate SPR values (materials in rows, energies in columns)
+    if e_kin is None:
+        e_kin = datasheet['constants']['E_prot']
+        spr_num, spr_den = stopping_power_terms(datasheet, e_kin)
+        datasheet['constants'].update({'spr_num': spr_num, 'spr_den': spr_den})
+    else:
+        spr_num, spr_den = stopping_power_terms(datasheet, e_kin)
+    spr_theor = rho_e_mat[:, np.newaxis] * (spr_num - ln_i_mat[:, np.newaxis]) / spr_den
+    if np.ndim(e_kin) == 0:
+        spr_theor = spr_theor[:, 0]
+
+    return spr_theor, rho_e_mat, zeff_mat, i_mat
+
+
+def stopping_power_terms(datasheet, e_kin):
+    """
+    Energy-dependent terms of the Bethe-Bloch equation, relative to water
+    Input:  datasheet  - Dictionary containing data from excel sheets
+            e_kin - kinetic energy of the protons (MeV), scalar or array
+    Output: spr_num, spr_den - numerator (without ln(I) of the material) and denominator of the SPR,
+            with the same shape as e_kin
+    """
+
+    # Load relevant data from datasheet
+    ln_i_w = datasheet['basis']['ln_i_w']
+    e_0 = datasheet['constants']['e_0']
+    m_e = datasheet['constants']['m_e']
+    e_kin = np.asarray(e_kin, dtype=float)
+
     # Calculate relativistic beta squared
     beta_sq = 1 - (e_kin / e_0 + 1) ** (-2)
 
-    # Calculate SPR values
+    # Calculate SPR terms
     spr_num = np.log(2 * m_e) + np.log(beta_sq / (1 - beta_sq)) - beta_sq
     spr_den = np.log(2 * m_e) + np.log(beta_sq / (1 - beta_sq)) - ln_i_w - beta_sq
-    spr_theor = rho_e_mat * (spr_num - ln_i_mat) / spr_den
-
-    datasheet['constants'].update({'spr_num': spr_num, 'spr_den': spr_den})
 
-    return spr_theor, rho_e_mat, zeff_mat, i_mat
\ No newline at end of file
+    return spr_num, spr_den
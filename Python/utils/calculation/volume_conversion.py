@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Conversion of CT volumes with a fitted HLUT
+
+The CT volume is memory-mapped (.npy or raw) or read slice by slice (DICOM series),
+converted in slabs of slices in a thread pool and written to a memory-mapped .npy file,
+so the memory use is bounded by a few slabs, independent of the size of the volume.
+
+% SPDX-License-Identifier: MIT
+"""
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import profiling
+from utils.calculation import hlut_table
+
+# Number of slices converted at once by a worker:
+SLAB_SIZE = 16
+
+
+def main(datasheet, hluttype, input_path, output_file, shape=None, dtype='int16', header=0, rescale_slope=1,
+         rescale_intercept=0, out_of_range='clip', slab_size=SLAB_SIZE, workers=None):
+    """
+    Convert a CT volume with a HLUT fitted by fit_and_plot_hluts
+    Input:  datasheet - Dictionary containing all calculated and measured data, with fitted HLUTs
+            hluttype - 'head', 'body' or 'avgdCT'
+            Rest: see convert_volume
+    Output: volume of the output parameter (memory-mapped, if written to a file)
+    """
+
+    if output_file is not None:
+        profiling.record_file(datasheet, output_file)
+
+    return convert_volume(hlut_table.hlut_evaluator(datasheet, hluttype), input_path, output_file, shape, dtype,
+                          header, rescale_slope, rescale_intercept, out_of_range, slab_size, workers)
+
+
+def export_volumes(datasheet, hluttype, input_paths):
+    """
+    Convert CT volumes with a HLUT for the evaluation, written to the output folder as
+    <volume name>_<output parameter>_<hluttype>.npy (nothing is done without output folder)
+    Input:  datasheet - Dictionary containing all calculated and measured data, with fitted HLUTs
+            hluttype - 'head', 'body' or 'avgdCT'
+            input_paths - .npy files or folders with a DICOM series
+    """
+
+    if datasheet['output'] is None:
+        return
+
+    for input_path in input_paths:
+        name = os.path.splitext(os.path.basename(os.path.normpath(input_path)))[0]
+        output_file = '{}/{}_{}_{}.npy'.format(datasheet['output'], name, datasheet['output_parameter'], hluttype)
+        main(datasheet, hluttype, input_path, output_file)
+
+
+def convert_volume(table, input_path, output_file, shape=None, dtype='int16', header=0, rescale_slope=1,
+                   rescale_intercept=0, out_of_range='clip', slab_size=SLAB_SIZE, workers=None):
+    """
+    Convert a CT volume with a compiled HLUT, slab by slab along the first axis
+    Input:  table - compiled HLUT (see hlut_table.compile_hlut or read_hlut)
+            input_path - .npy file, raw file, folder with a DICOM series or array
+            output_file - .npy file for the converted volume, or None to return an array in memory
+            shape, dtype, header - shape (slices first), data type and header size (bytes) of a raw file
+            rescale_slope, rescale_intercept - CT number = slope * stored value + intercept
+                                               (.npy and raw, DICOM files use their own rescale values)
+            out_of_range - policy for CT numbers outside of the HLUT (see hlut_table.lookup)
+            slab_size - number of slices converted at once by a worker
+            workers - number of threads, default: number of CPUs
+    Output: volume of the output parameter (memory-mapped, if written to a file)
+    """
+
+    hlut_table.check_policy(out_of_range)
+    volume = open_volume(input_path, shape, dtype, header)
+    shape = volume_shape(volume)
+
+    if output_file is None:
+        output = np.empty(shape, dtype=table['values'].dtype)
+    else:
+        output = np.lib.format.open_memmap(output_file, mode='w+', dtype=table['values'].dtype, shape=shape)
+
+    # Convert the slabs in a thread pool (the table lookup releases the GIL for the array operations):
+    slabs = [(start, min(start + slab_size, shape[0])) for start in range(0, shape[0], slab_size)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(slabs) == 1:
+        for start, stop in slabs:
+            convert_slab(table, volume, output, start, stop, rescale_slope, rescale_intercept, out_of_range)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(convert_slab, table, volume, output, start, stop, rescale_slope,
+                                       rescale_intercept, out_of_range) for start, stop in slabs]
+            for future in futures:
+                future.result()
+
+    if output_file is not None:
+        output.flush()
+
+    return output
+
+
+def open_volume(input_path, shape=None, dtype='int16', header=0):
+    """
+    Open a CT volume without reading it into memory
+    Input:  input_path - .npy file, raw file, folder with a DICOM series or array
+            shape, dtype, header - shape, data type and header size (bytes) of a raw file
+    Output: volume - memory-mapped array, or sorted list of DICOM files
+    """
+
+    if isinstance(input_path, np.ndarray):
+        return input_path
+    if os.path.isdir(input_path):
+        return dicom_series(input_path)
+    if input_path.lower().endswith('.npy'):
+        return np.load(input_path, mmap_mode='r')
+    if shape is None:
+        raise ValueError('The shape of the raw volume {} is needed.'.format(input_path))
+
+    return np.memmap(input_path, dtype=dtype, mode='r', offset=header, shape=tuple(shape))
+
+
+def dicom_series(folder):
+    """
+    Sorted files of a DICOM series (requires pydicom)
+    Input:  folder - folder with the DICOM files of one series
+    Output: files - file names, sorted by the slice position
+    """
+
+    try:
+        import pydicom
+        from pydicom.errors import InvalidDicomError
+    except ImportError:
+        raise ImportError('Reading DICOM series requires pydicom (pip install pydicom).')
+
+    files = []
+    for name in sorted(os.listdir(folder)):
+        filename = os.path.join(folder, name)
+        if not os.path.isfile(filename):
+            continue
+        try:
+            ds = pydicom.dcmread(filename, stop_before_pixels=True)
+        except InvalidDicomError:
+            continue
+        position = float(ds.ImagePositionPatient[2]) if 'ImagePositionPatient' in ds else float(ds.InstanceNumber)
+        files.append((position, filename))
+
+    if len(files) == 0:
+        raise ValueError('No DICOM files found in {}.'.format(folder))
+
+    return [filename for position, filename in sorted(files)]
+
+
+def volume_shape(volume):
+    """
+    Shape of an opened volume
+    Input:  volume - result of open_volume
+    Output: shape - shape of the volume (slices first)
+    """
+
+    if isinstance(volume, list):
+        import pydicom
+        ds = pydicom.dcmread(volume[0], stop_before_pixels=True)
+        return len(volume), int(ds.Rows), int(ds.Columns)
+
+    return volume.shape
+
+
+def read_slab(volume, start, stop, rescale_slope=1, rescale_intercept=0):
+    """
+    Read CT numbers of a slab of slices. Integer CT numbers are kept as integers
+    (fast path of the table lookup) if the rescale values allow it.
+    Input:  volume - result of open_volume
+            start, stop - slice range
+            rescale_slope, rescale_intercept - rescale values (not used for DICOM series)
+    Output: ctn - CT numbers of the slab
+    """
+
+    if isinstance(volume, list):
+        import pydicom
+        slices = []
+        for filename in volume[start:stop]:
+            ds = pydicom.dcmread(filename)
+            slices.append(rescale(ds.pixel_array, float(getattr(ds, 'RescaleSlope', 1)),
+                                  float(getattr(ds, 'RescaleIntercept', 0))))
+        return np.stack(slices)
+
+    return rescale(np.asarray(volume[start:stop]), rescale_slope, rescale_intercept)
+
+
+def rescale(pixels, slope, intercept):
+    """
+    Convert stored values to CT numbers
+    Input:  pixels - stored values
+            slope, intercept - rescale values
+    Output: ctn - CT numbers (integer, if pixels, slope and intercept are integer)
+    """
+
+    if slope == 1 and intercept == 0:
+        return pixels
+    if np.issubdtype(pixels.dtype, np.integer) and float(slope).is_integer() and float(intercept).is_integer():
+        return pixels.astype(np.int32) * int(slope) + int(intercept)
+
+    return pixels * float(slope) + float(intercept)
+
+
+def convert_slab(table, volume, output, start, stop, rescale_slope, rescale_intercept, out_of_range):
+    """
+    Convert one slab of slices and write it to the output
+    Input:  table - compiled HLUT
+            volume - result of open_volume
+            output - output volume
+            start, stop - slice range
+            rescale_slope, rescale_intercept, out_of_range - see convert_volume
+    """
+
+    ctn = read_slab(volume, start, stop, rescale_slope, rescale_intercept)
+    output[start:stop] = hlut_table.lookup(table, ctn, out_of_range)
+
+
+def read_hlut(filename, dtype=np.float64, out_of_range='raise'):
+    """
+    Compile a HLUT from an exported .txt or .csv file (see fit_and_plot_hluts.hlut_export)
+    Input:  filename - exported HLUT
+            dtype, out_of_range - see hlut_table.compile_hlut
+    Output: table - compiled HLUT
+    """
+
+    if filename.lower().endswith('.csv'):
+        data = np.loadtxt(filename, delimiter=',', ndmin=2)
+    else:
+        data = np.loadtxt(filename, delimiter='\t', skiprows=1, ndmin=2)
+
+    return hlut_table.compile_hlut(data[:, 0], data[:, 1], dtype, out_of_range)
@@ -5,9 +5,17 @@ Control functions for input values
 % SPDX-License-Identifier: MIT
 """
 
+import os
 import argparse
 import numpy as np
 
+# Input arguments that define the HLUTs to be created (all other arguments are settings of the run):
+HLUT_ARGUMENTS = ['input_folder_name', 'file_name', 'output_parameter', 'recon_type', 'output_folder_name', 'e_prot']
+
+# Input arguments of the optional analyses, which are run for every HLUT (see check_analyses):
+ANALYSIS_ARGUMENTS = ['energies', 'ctn_sd', 'n_samples', 'seed', 'crossvalidation', 'convert_volumes',
+                      'volume_hlut', 'difference_volumes', 'difference_ctn_range']
+
 
 def check_parameters(output_parameter, recon_type):
     """
@@ -35,13 +43,75 @@ def check_parameters(output_parameter, recon_type):
                          f"Allowed values are: {', '.join(valid_parameters)}.")
 
     # Check the input variable recon_type:
+    check_recon_type(recon_type)
+
+
+def check_recon_type(recon_type):
+    """
+    Checks if the input variable "recon_type" is valid ('regular' or 'DD').
+    Returns ValueError - If recon_type is not one of the allowed values.
+    """
+
     valid_parameters = ['regular', 'DD']
     if recon_type not in valid_parameters:
         raise ValueError(f"Invalid recon_type '{recon_type}'. "
                          f"Allowed values are: {', '.join(valid_parameters)}.")
 
+
+def check_analyses(analyses):
+    """
+    Checks the settings of the optional analyses, which are run for every HLUT
+    (see hlut_generation_and_evaluation.evaluate):
+    - energies: proton energies (MeV) of an energy family of SPR HLUTs, empty for none
+    - ctn_sd: standard deviation (HU) of the mean CT numbers of the phantom inserts, one value or one per insert,
+              for the uncertainty of the HLUTs, None for none
+    - n_samples, seed: number of realizations and seed of the random numbers for the uncertainty
+    - crossvalidation: 'insert' or 'tissue' for a leave-one-out cross-validation of the HLUT accuracy, None for none
+    - convert_volumes: CT volumes (.npy files or folders with a DICOM series) to be converted with the
+                       HLUT given by volume_hlut ('head', 'body' or 'avgdCT'), empty for none
+    - difference_volumes: CT volumes for the voxel-weighted differences between the HLUTs, empty for none
+    - difference_ctn_range: (min, max) CT numbers of the voxels included in the differences, None for all
+
+    Input:
+        analyses - Dictionary with the settings, missing settings are not run
+
+    Returns ValueError - If a setting is not valid.
+    """
+
+    unknown = set(analyses) - set(ANALYSIS_ARGUMENTS)
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown analyses: {', '.join(sorted(unknown))}. "
+                         f"Allowed are: {', '.join(ANALYSIS_ARGUMENTS)}.")
+
+    if any(energy <= 0 for energy in analyses.get('energies') or []):
+        raise ValueError("The proton energies of the HLUT family must be positive.")
+
+    if analyses.get('ctn_sd') is not None and np.any(np.asarray(analyses['ctn_sd']) < 0):
+        raise ValueError("The standard deviation of the CT numbers must not be negative.")
+    if analyses.get('n_samples', 1) < 1:
+        raise ValueError("The number of realizations for the HLUT uncertainty must be at least 1.")
+
+    valid_folds = ['insert', 'tissue']
+    if analyses.get('crossvalidation') not in valid_folds + [None]:
+        raise ValueError(f"Invalid crossvalidation '{analyses['crossvalidation']}'. "
+                         f"Allowed values are: {', '.join(valid_folds)}.")
+
+    valid_hluts = ['head', 'body', 'avgdCT']
+    if analyses.get('volume_hlut', 'body') not in valid_hluts:
+        raise ValueError(f"Invalid volume_hlut '{analyses['volume_hlut']}'. "
+                         f"Allowed values are: {', '.join(valid_hluts)}.")
+    if analyses.get('difference_ctn_range') is not None and len(analyses['difference_ctn_range']) != 2:
+        raise ValueError("The CT number range of the HLUT differences needs a minimum and a maximum.")
+    for volume in (analyses.get('convert_volumes') or []) + (analyses.get('difference_volumes') or []):
+        if not (os.path.isdir(volume) or (volume.lower().endswith('.npy') and os.path.isfile(volume))):
+            raise ValueError(f"CT volume '{volume}' not found. It should be a .npy file or a folder with a "
+                             f"DICOM series.")
+
     
-def command_line_input(input_folder_name, file_name, output_parameter, recon_type, output_folder_name, e_prot):
+def command_line_input(input_folder_name, file_name, output_parameter, recon_type, output_folder_name, e_prot,
+                       batch=False, workers=1, profile=None, profiler='cProfile', trace_memory=False, energies=None,
+                       ctn_sd=None, n_samples=1000, seed=None, crossvalidation=None, convert_volumes=None,
+                       volume_hlut='body', difference_volumes=None, difference_ctn_range=None):
     """
     Parse command line arguments, if used.
     Returns:
@@ -63,6 +133,49 @@ def command_line_input(input_folder_name, file_name, output_parameter, recon_typ
                         help='Name of the output folder where results will be stored.')
     parser.add_argument('--e_prot', type=float, required=False, default=e_prot, nargs='+',
                         help='Initial energy of the proton beam (MeV). Only needed for SPR HLUTs.')
+    parser.add_argument('--batch', required=False, default=batch, action='store_true',
+                        help='Batch mode: run every combination of file_name, output_parameter, recon_type and '
+                             'e_prot in a process pool. file_name may contain wildcards, e.g. "*.xlsx".')
+    parser.add_argument('--workers', type=int, required=False, default=workers,
+                        help='Number of worker processes in batch mode, or for the HLUT fit and evaluation '
+                             'stages of each HLUT without batch mode.')
+    parser.add_argument('--profile', type=str, required=False, default=profile or [], nargs='+',
+                        help='Names of the stages to be profiled, e.g. "HLUT fit" "Report". The stage times are '
+                             'always written to trace.json in the output folder.')
+    parser.add_argument('--profiler', type=str, required=False, default=profiler,
+                        choices=['cProfile', 'pyinstrument'],
+                        help='Profiler for the stages given by --profile.')
+    parser.add_argument('--trace_memory', required=False, default=trace_memory, action='store_true',
+                        help='Trace the peak memory of each stage with tracemalloc (slows down the run).')
+    parser.add_argument('--energies', type=float, required=False, default=energies or [], nargs='+',
+                        help='Proton energies (MeV) of an energy family of SPR HLUTs, which is written to '
+                             'SPR_HLUT_family.txt for every SPR HLUT, e.g. 70 100 150 200 250.')
+    parser.add_argument('--ctn_sd', type=float, required=False, default=ctn_sd, nargs='+',
+                        help='Standard deviation (HU) of the mean CT numbers of the phantom inserts, one value or '
+                             'one per insert. If given, the uncertainty of the HLUTs is estimated by resampling the '
+                             'CT numbers and written to <output_parameter>_HLUT_uncertainty.txt.')
+    parser.add_argument('--n_samples', type=int, required=False, default=n_samples,
+                        help='Number of realizations for the uncertainty of the HLUTs.')
+    parser.add_argument('--seed', type=int, required=False, default=seed,
+                        help='Seed of the random numbers for the uncertainty of the HLUTs.')
+    parser.add_argument('--crossvalidation', type=str, required=False, default=crossvalidation,
+                        choices=['insert', 'tissue'],
+                        help='Leave-one-out cross-validation of the HLUT accuracy, holding out each phantom insert '
+                             'or each tabulated human tissue. Written to Eval_crossvalidation_<folds>.txt.')
+    parser.add_argument('--convert_volumes', type=str, required=False, default=convert_volumes or [], nargs='+',
+                        help='CT volumes (.npy files or folders with a DICOM series) to be converted with the HLUT '
+                             'given by --volume_hlut. Written to <volume>_<output_parameter>_<HLUT>.npy.')
+    parser.add_argument('--volume_hlut', type=str, required=False, default=volume_hlut,
+                        choices=['head', 'body', 'avgdCT'],
+                        help='HLUT for the conversion of the CT volumes.')
+    parser.add_argument('--difference_volumes', type=str, required=False, default=difference_volumes or [],
+                        nargs='+',
+                        help='CT volumes (.npy files or folders with a DICOM series) for the voxel-weighted '
+                             'differences between the HLUTs. Written to Eval_HLUT_differences_volumes.txt.')
+    parser.add_argument('--difference_ctn_range', type=float, required=False, default=difference_ctn_range,
+                        nargs=2, metavar=('MIN', 'MAX'),
+                        help='CT numbers of the voxels included in the HLUT differences, e.g. -950 3000 to '
+                             'exclude the air around the patient.')
 
     # Check for multiple input
     return check_arguments(parser.parse_args())
@@ -72,15 +185,32 @@ def check_arguments(args):
     """
     Check if multiple arguments are provided and if their lengths match.
     If only single values are provided, convert them to lists for uniform processing.
+    In batch mode, all combinations of the values are used, so the lengths do not need to match.
     Args:
         args: Parsed command line arguments.
     Returns:
         args: Updated arguments with lists.
     """
 
+    # Stages to be profiled, with the profiler of each stage:
+    if isinstance(getattr(args, 'profile', None), list):
+        args.profile = {name: args.profiler for name in args.profile}
+
+    # Settings of the optional analyses, which are the same for all HLUTs:
+    args.analyses = {name: getattr(args, name) for name in ANALYSIS_ARGUMENTS if hasattr(args, name)}
+    check_analyses(args.analyses)
+
+    # In batch mode, every argument is only converted to a list:
+    if getattr(args, 'batch', False):
+        for attribute in HLUT_ARGUMENTS:
+            value = getattr(args, attribute)
+            if not isinstance(value, list):
+                setattr(args, attribute, [value])
+        return args
+
     # Determine the number of values for each argument
     number_of_values = []
-    for attribute in vars(args):
+    for attribute in HLUT_ARGUMENTS:
         value = getattr(args, attribute)
         if isinstance(value, list):
             number_of_values.append(len(value))
@@ -97,7 +227,7 @@ def check_arguments(args):
                          "or only one value (which will be used for all).")
 
     # Convert single values to lists
-    for attribute in vars(args):
+    for attribute in HLUT_ARGUMENTS:
         value = getattr(args, attribute)
         if isinstance(value, list) and len(value)==1:
             value = value[0]
@@ -6,7 +6,8 @@ Evaluation of CT number estimation
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
+
+from utils import figures, tables
 
 
 def main(datasheet):
@@ -32,15 +33,20 @@ def main(datasheet):
         # Calculate the difference between the measured and estimated CT numbers:
         diff = ctn_meas - ctn_calc
 
-        # Save the results to a file:
-        with open('{}/for_report/{}.txt'.format(datasheet['output'] ,filename), 'w') as f:
-            f.write('Insert name    CT number measured    CT number calculated    Difference\n')
-            for line in range(0, len(ctn_meas)):
-                f.write(f'{name[line]}    ' + f'{round(ctn_meas[line])}    ' +
-                        f'{round(ctn_calc[line])}    ' + f'{round(diff[line])} \n')
+        # Table of the results, for the report and the text file:
+        rows = [['Insert name', 'CT number measured', 'CT number calculated', 'Difference']]
+        for line in range(0, len(ctn_meas)):
+            rows.append([name[line], round(ctn_meas[line]), round(ctn_calc[line]), round(diff[line])])
+        tables.save_table(datasheet, filename, rows)
+
+    if not figures.create_figures(datasheet):
+        return
+
+    from matplotlib.figure import Figure
 
     # Plot of CT number difference:
-    fig, ax = plt.subplots(figsize=(10, 4))
+    fig = Figure(figsize=(10, 4))
+    ax = fig.subplots()
 
     diff_head = (datasheet['CTnumbers']['CT number (Head)'] -
                  datasheet['PhantomInserts']['ctn_calc_head'])
@@ -48,8 +54,8 @@ def main(datasheet):
                  datasheet['PhantomInserts']['ctn_calc_body'])
 
     xpos = np.arange(0, len(diff_head))
-    plt.bar(xpos - 0.2, diff_head, 0.4, label='Head phantom', zorder=1000)
-    plt.bar(xpos + 0.2, diff_body, 0.4, label='Body phantom', zorder=1000)
+    ax.bar(xpos - 0.2, diff_head, 0.4, label='Head phantom', zorder=1000)
+    ax.bar(xpos + 0.2, diff_body, 0.4, label='Body phantom', zorder=1000)
 
     ax.yaxis.grid(which='major', color='gray', linestyle='-', alpha=0.3, zorder=0)  # vertical lines (major)
     ax.axhline(0, color='black', zorder=5000, linewidth=0.5)
@@ -58,13 +64,6 @@ def main(datasheet):
 
     ax.set_ylabel('$CTN_{meas} - CTN_{est}$ (HU)')
     ax.set_title('Check of estimated CT numbers')
-    plt.legend()
-
-    plt.savefig("{}/for_report/svg/Eval_box_3_ctnumber_estimation.svg".format(datasheet['output']),
-                bbox_inches="tight")
-    plt.savefig('{}/for_report/Eval_box_3_ctnumber_estimation.pdf'.format(datasheet['output']),
-                bbox_inches="tight", dpi=300)
-    
-    plt.clf()
-    plt.cla()
-    plt.close()
\ No newline at end of file
+    ax.legend()
+
+    figures.save_figure(datasheet, fig, 'Eval_box_3_ctnumber_estimation')
\ No newline at end of file
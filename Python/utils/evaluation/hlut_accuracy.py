@@ -6,9 +6,19 @@ Evaluation of HLUT accuracy
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import interpolate
-from sklearn.metrics import mean_squared_error, mean_absolute_error
+
+from utils import figures, tables
+from utils.calculation import hlut_table
+
+# HLUT variants evaluated: HLUT type and CT numbers of the phantom inserts and tabulated human tissues
+VARIANTS = {'head': ('head', 'CT number (Head)', 'ctn_calc_head'),
+            'head_avgd': ('avgdCT', 'CT number (Head)', 'ctn_calc_head'),
+            'body': ('body', 'CT number (Body)', 'ctn_calc_body'),
+            'body_avgd': ('avgdCT', 'CT number (Body)', 'ctn_calc_body')}
+
+# Tissue groups and metrics of the evaluation:
+GROUPS = {'all': None, 'lung': 1, 'adipose': 2, 'soft tissue': 3, 'bone': 4}
+METRICS = ['ME', 'MAE', 'RMSE']
 
 
 def main(datasheet):
@@ -30,255 +40,65 @@ def main(datasheet):
     elif datasheet['output_parameter'] == 'MD':
         parameter = 'Density (g/cm3)'
 
-    # Define HLUT functions:
-    hlut_head = interpolate.interp1d(datasheet['HLUTs']['head']['ctn'],
-                                     datasheet['HLUTs']['head'][datasheet['output_parameter']])
-    hlut_body = interpolate.interp1d(datasheet['HLUTs']['body']['ctn'],
-                                     datasheet['HLUTs']['body'][datasheet['output_parameter']])
-    hlut_avgd = interpolate.interp1d(datasheet['HLUTs']['avgdCT']['ctn'],
-                                     datasheet['HLUTs']['avgdCT'][datasheet['output_parameter']])
-
-    # Calculate Output based on CT number and HLUT for phantom inserts:
-    datasheet['PhantomInserts']['head_fromHLUT'] = (hlut_head(datasheet['CTnumbers']['CT number (Head)']))
-    datasheet['PhantomInserts']['body_fromHLUT'] = (hlut_body(datasheet['CTnumbers']['CT number (Body)']))
-    datasheet['PhantomInserts']['head_avgd_fromHLUT'] = (hlut_avgd(datasheet['CTnumbers']['CT number (Head)']))
-    datasheet['PhantomInserts']['body_avgd_fromHLUT'] = (hlut_avgd(datasheet['CTnumbers']['CT number (Body)']))
-
-    # Calculate Output based on CT number and HLUT for tabulates tissues:
-    datasheet['TabulatedHumanTissues']['head_fromHLUT'] = (
-        hlut_head(datasheet['TabulatedHumanTissues']['ctn_calc_head']))
-    datasheet['TabulatedHumanTissues']['body_fromHLUT'] = (
-        hlut_body(datasheet['TabulatedHumanTissues']['ctn_calc_body']))
-    datasheet['TabulatedHumanTissues']['head_avgd_fromHLUT'] = (
-        hlut_avgd(datasheet['TabulatedHumanTissues']['ctn_calc_head']))
-    datasheet['TabulatedHumanTissues']['body_avgd_fromHLUT'] = (
-        hlut_avgd(datasheet['TabulatedHumanTissues']['ctn_calc_body']))
-
-    ###########################################################################
-    # Initialize parameter lists
-    par_meas_lung, par_meas_fat, par_meas_soft, par_meas_bone = [], [], [], []
-    par_cal_head_lung, par_cal_head_fat, par_cal_head_soft, par_cal_head_bone = [], [], [], []
-    par_cal_body_lung, par_cal_body_fat, par_cal_body_soft, par_cal_body_bone = [], [], [], []
-    par_cal_body_avgd_lung, par_cal_body_avgd_fat, par_cal_body_avgd_soft, par_cal_body_avgd_bone = [], [], [], []
-    par_cal_head_avgd_lung, par_cal_head_avgd_fat, par_cal_head_avgd_soft, par_cal_head_avgd_bone = [], [], [], []
-
-    # Add Output estimation based on HLUT for phantom inserts:
+    # Calculate Output based on CT number and HLUT for phantom inserts and tabulated tissues:
+    for variant, (hluttype, phantom_ctn, tabul_ctn) in VARIANTS.items():
+        datasheet['PhantomInserts'][variant + '_fromHLUT'] = (
+            hlut_table.evaluate_hluts(datasheet, hluttype, datasheet['CTnumbers'][phantom_ctn]))
+        datasheet['TabulatedHumanTissues'][variant + '_fromHLUT'] = (
+            hlut_table.evaluate_hluts(datasheet, hluttype, datasheet['TabulatedHumanTissues'][tabul_ctn]))
+
+    # Output parameter from the HLUT variants (variants x materials) and reference values,
+    # for the phantom inserts (not for MD) and the tabulated human tissues:
+    columns = [variant + '_fromHLUT' for variant in VARIANTS]
+    par_cal = np.array(datasheet['TabulatedHumanTissues'][columns], dtype=float).T
+    par_meas = np.array(datasheet['TabulatedHumanTissues'][parameter], dtype=float)
+    groups = np.asarray(datasheet['TabulatedHumanTissues']['Tissue group'])
     if not(datasheet['output_parameter'] == 'MD'):
-        indexlist = datasheet['PhantomInserts']['Tissue group']  # tissue grouping
-        for i in range(len(indexlist)):
-            if indexlist[i] == 1:
-                par_meas_lung.append(datasheet['PhantomInserts'][partype][i])
-                par_cal_head_lung.append(datasheet['PhantomInserts']['head_fromHLUT'][i])
-                par_cal_body_lung.append(datasheet['PhantomInserts']['body_fromHLUT'][i])
-                par_cal_head_avgd_lung.append(datasheet['PhantomInserts']['head_avgd_fromHLUT'][i])
-                par_cal_body_avgd_lung.append(datasheet['PhantomInserts']['body_avgd_fromHLUT'][i])
-            elif indexlist[i] == 2:
-                par_meas_fat.append(datasheet['PhantomInserts'][partype][i])
-                par_cal_head_fat.append(datasheet['PhantomInserts']['head_fromHLUT'][i])
-                par_cal_body_fat.append(datasheet['PhantomInserts']['body_fromHLUT'][i])
-                par_cal_head_avgd_fat.append(datasheet['PhantomInserts']['head_avgd_fromHLUT'][i])
-                par_cal_body_avgd_fat.append(datasheet['PhantomInserts']['body_avgd_fromHLUT'][i])
-            elif indexlist[i] == 3:
-                par_meas_soft.append(datasheet['PhantomInserts'][partype][i])
-                par_cal_head_soft.append(datasheet['PhantomInserts']['head_fromHLUT'][i])
-                par_cal_body_soft.append(datasheet['PhantomInserts']['body_fromHLUT'][i])
-                par_cal_head_avgd_soft.append(datasheet['PhantomInserts']['head_avgd_fromHLUT'][i])
-                par_cal_body_avgd_soft.append(datasheet['PhantomInserts']['body_avgd_fromHLUT'][i])
-            elif indexlist[i] == 4:
-                par_meas_bone.append(datasheet['PhantomInserts'][partype][i])
-                par_cal_head_bone.append(datasheet['PhantomInserts']['head_fromHLUT'][i])
-                par_cal_body_bone.append(datasheet['PhantomInserts']['body_fromHLUT'][i])
-                par_cal_head_avgd_bone.append(datasheet['PhantomInserts']['head_avgd_fromHLUT'][i])
-                par_cal_body_avgd_bone.append(datasheet['PhantomInserts']['body_avgd_fromHLUT'][i])
-
-    # Add calculated CT numbers from tabulated human tissues
-    indexlist = datasheet['TabulatedHumanTissues']['Tissue group']  # tissue grouping
-    for i in range(len(indexlist)):
-        if indexlist[i] == 1:
-            par_meas_lung.append(datasheet['TabulatedHumanTissues'][parameter][i])
-            par_cal_head_lung.append(datasheet['TabulatedHumanTissues']['head_fromHLUT'][i])
-            par_cal_body_lung.append(datasheet['TabulatedHumanTissues']['body_fromHLUT'][i])
-            par_cal_head_avgd_lung.append(datasheet['TabulatedHumanTissues']['head_avgd_fromHLUT'][i])
-            par_cal_body_avgd_lung.append(datasheet['TabulatedHumanTissues']['body_avgd_fromHLUT'][i])
-        elif indexlist[i] == 2:
-            par_meas_fat.append(datasheet['TabulatedHumanTissues'][parameter][i])
-            par_cal_head_fat.append(datasheet['TabulatedHumanTissues']['head_fromHLUT'][i])
-            par_cal_body_fat.append(datasheet['TabulatedHumanTissues']['body_fromHLUT'][i])
-            par_cal_head_avgd_fat.append(datasheet['TabulatedHumanTissues']['head_avgd_fromHLUT'][i])
-            par_cal_body_avgd_fat.append(datasheet['TabulatedHumanTissues']['body_avgd_fromHLUT'][i])
-        elif indexlist[i] == 3:
-            par_meas_soft.append(datasheet['TabulatedHumanTissues'][parameter][i])
-            par_cal_head_soft.append(datasheet['TabulatedHumanTissues']['head_fromHLUT'][i])
-            par_cal_body_soft.append(datasheet['TabulatedHumanTissues']['body_fromHLUT'][i])
-            par_cal_head_avgd_soft.append(datasheet['TabulatedHumanTissues']['head_avgd_fromHLUT'][i])
-            par_cal_body_avgd_soft.append(datasheet['TabulatedHumanTissues']['body_avgd_fromHLUT'][i])
-        elif indexlist[i] == 4:
-            par_meas_bone.append(datasheet['TabulatedHumanTissues'][parameter][i])
-            par_cal_head_bone.append(datasheet['TabulatedHumanTissues']['head_fromHLUT'][i])
-            par_cal_body_bone.append(datasheet['TabulatedHumanTissues']['body_fromHLUT'][i])
-            par_cal_head_avgd_bone.append(datasheet['TabulatedHumanTissues']['head_avgd_fromHLUT'][i])
-            par_cal_body_avgd_bone.append(datasheet['TabulatedHumanTissues']['body_avgd_fromHLUT'][i])
-
-    if datasheet['output_parameter'] == 'MD':
-        par_cal_head_all = np.array(datasheet['TabulatedHumanTissues']['head_fromHLUT'])
-        par_cal_body_all = np.array(datasheet['TabulatedHumanTissues']['body_fromHLUT'])
-        par_meas_all = np.array(datasheet['TabulatedHumanTissues'][parameter])
-    else:
-        par_cal_head_all = np.concatenate((np.array(datasheet['PhantomInserts']['head_fromHLUT']),
-                                           np.array(datasheet['TabulatedHumanTissues']['head_fromHLUT'])))
-        par_cal_body_all = np.concatenate((np.array(datasheet['PhantomInserts']['body_fromHLUT']),
-                                           np.array(datasheet['TabulatedHumanTissues']['body_fromHLUT'])))
-        par_meas_all = np.concatenate((np.array(datasheet['PhantomInserts'][partype]),
-                                       np.array(datasheet['TabulatedHumanTissues'][parameter])))
-
-    # Calculate ME, MAE, RMSE for difference between HLUT and datapoints
-    roundto = 2
-
-    me_head_lung = round(100.0 *np.mean(np.subtract(np.array(par_cal_head_lung), np.array(par_meas_lung))), roundto)
-    me_head_fat = round(100.0 *np.mean(np.subtract(np.array(par_cal_head_fat), np.array(par_meas_fat))), roundto)
-    me_head_soft = round(100.0 *np.mean(np.subtract(np.array(par_cal_head_soft), np.array(par_meas_soft))), roundto)
-    me_head_bone = round(100.0 *np.mean(np.subtract(np.array(par_cal_head_bone), np.array(par_meas_bone))), roundto)
-    me_head_all = round(100.0 *np.mean(np.subtract(np.array(par_cal_head_all), np.array(par_meas_all))), roundto)
-
-    me_body_lung = round(100.0 *np.mean(np.subtract(np.array(par_cal_body_lung), np.array(par_meas_lung))), roundto)
-    me_body_fat = round(100.0 *np.mean(np.subtract(np.array(par_cal_body_fat), np.array(par_meas_fat))), roundto)
-    me_body_soft = round(100.0 *np.mean(np.subtract(np.array(par_cal_body_soft), np.array(par_meas_soft))), roundto)
-    me_body_bone = round(100.0 *np.mean(np.subtract(np.array(par_cal_body_bone), np.array(par_meas_bone))), roundto)
-    me_body_all = round(100.0 *np.mean(np.subtract(np.array(par_cal_body_all), np.array(par_meas_all))), roundto)
-
-    mae_head_lung = round(100.0 *mean_absolute_error(par_cal_head_lung, par_meas_lung), roundto)
-    mae_head_fat = round(100.0 *mean_absolute_error(par_cal_head_fat, par_meas_fat), roundto)
-    mae_head_soft = round(100.0 *mean_absolute_error(par_cal_head_soft, par_meas_soft), roundto)
-    mae_head_bone = round(100.0 *mean_absolute_error(par_cal_head_bone, par_meas_bone), roundto)
-    mae_head_all = round(100.0 *mean_absolute_error(par_cal_head_all, par_meas_all), roundto)
-
-    mae_body_lung = round(100.0 *mean_absolute_error(par_cal_body_lung, par_meas_lung), roundto)
-    mae_body_fat = round(100.0 *mean_absolute_error(par_cal_body_fat, par_meas_fat), roundto)
-    mae_body_soft = round(100.0 *mean_absolute_error(par_cal_body_soft, par_meas_soft), roundto)
-    mae_body_bone = round(100.0 *mean_absolute_error(par_cal_body_bone, par_meas_bone), roundto)
-    mae_body_all = round(100.0 *mean_absolute_error(par_cal_body_all, par_meas_all), roundto)
-
-    rmse_head_lung = round(100.0 *np.sqrt(mean_squared_error(par_cal_head_lung, par_meas_lung)), roundto)
-    rmse_head_fat = round(100.0 *np.sqrt(mean_squared_error(par_cal_head_fat, par_meas_fat)), roundto)
-    rmse_head_soft = round(100.0 *np.sqrt(mean_squared_error(par_cal_head_soft, par_meas_soft)), roundto)
-    rmse_head_bone = round(100.0 *np.sqrt(mean_squared_error(par_cal_head_bone, par_meas_bone)), roundto)
-    rmse_head_all = round(100.0 *np.sqrt(mean_squared_error(par_cal_head_all, par_meas_all)), roundto)
-
-    rmse_body_lung = round(100.0 *np.sqrt(mean_squared_error(par_cal_body_lung, par_meas_lung)), roundto)
-    rmse_body_fat = round(100.0 *np.sqrt(mean_squared_error(par_cal_body_fat, par_meas_fat)), roundto)
-    rmse_body_soft = round(100.0 *np.sqrt(mean_squared_error(par_cal_body_soft, par_meas_soft)), roundto)
-    rmse_body_bone = round(100.0 *np.sqrt(mean_squared_error(par_cal_body_bone, par_meas_bone)), roundto)
-    rmse_body_all = round(100.0 *np.sqrt(mean_squared_error(par_cal_body_all, par_meas_all)), roundto)
-
-    with open('{}/for_report/Eval_box_6_accuracy_head.txt'.format(datasheet['output']), 'w') as f:
-        f.write('Metric    All tissues    Lung    Adipose    Soft tissue    Bone\n')
-        f.write('Mean error (%)    {}    {}    {}    {}    {}\n'.format(
-            me_head_all, me_head_lung, me_head_fat, me_head_soft, me_head_bone))
-        f.write('Mean absolute error (%)    {}    {}    {}    {}    {}\n'.format(
-            mae_head_all, mae_head_lung, mae_head_fat, mae_head_soft, mae_head_bone))
-        f.write('RMSE (%)    {}    {}    {}    {}    {}\n'.format(
-            rmse_head_all, rmse_head_lung, rmse_head_fat, rmse_head_soft, rmse_head_bone))
-
-    with open('{}/for_report/Eval_box_6_accuracy_body.txt'.format(datasheet['output']), 'w') as f:
-        f.write('Metric    All tissues    Lung    Adipose    Soft tissue    Bone\n')
-        f.write('Mean error (%)    {}    {}    {}    {}    {}\n'.format(
-            me_body_all, me_body_lung, me_body_fat, me_body_soft, me_body_bone))
-        f.write('Mean absolute error (%)    {}    {}    {}    {}    {}\n'.format(
-            mae_body_all, mae_body_lung, mae_body_fat, mae_body_soft, mae_body_bone))
-        f.write('RMSE (%)    {}    {}    {}    {}    {}\n'.format(
-            rmse_body_all, rmse_body_lung, rmse_body_fat, rmse_body_soft, rmse_body_bone))
+        par_cal = np.concatenate((np.array(datasheet['PhantomInserts'][columns], dtype=float).T, par_cal), axis=1)
+        par_meas = np.concatenate((np.array(datasheet['PhantomInserts'][partype], dtype=float), par_meas))
+        groups = np.concatenate((np.asarray(datasheet['PhantomInserts']['Tissue group']), groups))
+    difference = 100.0 * (par_cal - par_meas)
+
+    # Calculate ME, MAE, RMSE (%) for difference between HLUT and datapoints, for all variants at once:
+    metrics = np.round(grouped_metrics(difference, groups), 2)
+
+    # Store the metrics of the head and body HLUTs for the programmatic use of the results:
+    variants = list(VARIANTS)
+    datasheet['accuracy'] = {variant: metrics_dict(metrics[variants.index(variant)]) for variant in ['head', 'body']}
+
+    # Tables for the report and the text files:
+    tables.save_table(datasheet, 'Eval_box_6_accuracy_head', accuracy_table(datasheet, 'head'))
+    tables.save_table(datasheet, 'Eval_box_6_accuracy_body', accuracy_table(datasheet, 'body'))
+
+    if not figures.create_figures(datasheet):
+        return
+
+    from matplotlib.figure import Figure
 
     # Plot figures:
-    fig, ax_1 = plt.subplots(figsize=(10, 4))
+    fig = Figure(figsize=(10, 4))
+    ax_1 = fig.subplots()
 
     xpos = [0.7, 0.9, 1.1, 1.3]
     colors = ['royalblue', 'powderblue', 'seagreen', 'yellowgreen']
+    labels = ['CTN head, HLUT head', 'CTN head, HLUT avgd', 'CTN body, HLUT body', 'CTN body, HLUT avgd']
     ax_1.axhline(0, color='black', linewidth=0.5)
 
-    # Plot results for lung tisues:
-    if len(par_meas_lung) < 5:
-        ax_1.plot(xpos[0 ] *np.ones(len(par_meas_lung)), 100.0 *np.subtract(
-            np.array(par_cal_head_lung), np.array(par_meas_lung)), 'o', color=colors[0],
-                  label='CTN head, HLUT head')
-        ax_1.plot(xpos[1 ] *np.ones(len(par_meas_lung)), 100.0 *np.subtract(
-            np.array(par_cal_head_avgd_lung), np.array(par_meas_lung)), 'o', color=colors[1],
-                  label='CTN head, HLUT avgd')
-        ax_1.plot(xpos[2 ] *np.ones(len(par_meas_lung)), 100.0 *np.subtract(
-            np.array(par_cal_body_lung), np.array(par_meas_lung)), 'o', color=colors[2],
-                  label='CTN body, HLUT body')
-        ax_1.plot(xpos[3 ] *np.ones(len(par_meas_lung)), 100.0 *np.subtract(
-            np.array(par_cal_body_avgd_lung), np.array(par_meas_lung)), 'o', color=colors[3],
-                  label='CTN body, HLUT avgd')
-    else:
-        bp0 = ax_1.boxplot([100.0 *np.subtract(np.array(par_cal_head_lung), np.array(par_meas_lung)),
-                            100.0 *np.subtract(np.array(par_cal_head_avgd_lung), np.array(par_meas_lung)),
-                            100.0 *np.subtract(np.array(par_cal_body_lung), np.array(par_meas_lung)),
-                            100.0 *np.subtract(np.array(par_cal_body_avgd_lung), np.array(par_meas_lung))],
-                           positions=list(map(lambda x: x + 0, xpos)), patch_artist=True, showmeans=True)
-        for patch, color in zip(bp0['boxes'], colors):
-            patch.set_facecolor(color)
-        # Plot fake data to create a legend:
-        ax_1.plot([], [], 'o', color=colors[0], label='CTN head, HLUT head')
-        ax_1.plot([], [], 'o', color=colors[1], label='CTN head, HLUT avgd')
-        ax_1.plot([], [], 'o', color=colors[2], label='CTN body, HLUT body')
-        ax_1.plot([], [], 'o', color=colors[3], label='CTN body, HLUT avgd')
-
-    # Plot results for adipose tisues:
-    if len(par_meas_fat) < 5:
-        ax_1.plot((xpos[0 ] +1 ) *np.ones(len(par_meas_fat)), 100.0 *np.subtract(
-            np.array(par_cal_head_fat), np.array(par_meas_fat)), 'o', color=colors[0])
-        ax_1.plot((xpos[1 ] +1 ) *np.ones(len(par_meas_fat)), 100.0 *np.subtract(
-            np.array(par_cal_head_avgd_fat), np.array(par_meas_fat)), 'o', color=colors[1])
-        ax_1.plot((xpos[2 ] +1 ) *np.ones(len(par_meas_fat)), 100.0 *np.subtract(
-            np.array(par_cal_body_fat), np.array(par_meas_fat)), 'o', color=colors[2])
-        ax_1.plot((xpos[3 ] +1 ) *np.ones(len(par_meas_fat)), 100.0 *np.subtract(
-            np.array(par_cal_body_avgd_fat), np.array(par_meas_fat)), 'o', color=colors[3])
-    else:
-        bp1 = ax_1.boxplot([100.0 *np.subtract(np.array(par_cal_head_fat), np.array(par_meas_fat)),
-                            100.0 *np.subtract(np.array(par_cal_head_avgd_fat), np.array(par_meas_fat)),
-                            100.0 *np.subtract(np.array(par_cal_body_fat), np.array(par_meas_fat)),
-                            100.0 *np.subtract(np.array(par_cal_body_avgd_fat), np.array(par_meas_fat))],
-                           positions=list(map(lambda x: x + 1, xpos)), patch_artist=True, showmeans=True)
-        for patch, color in zip(bp1['boxes'], colors):
-            patch.set_facecolor(color)
-
-    # Plot results for soft tisues:
-    if len(par_meas_soft) < 5:
-        ax_1.plot((xpos[0 ] +2 ) *np.ones(len(par_meas_soft)), 100.0 *np.subtract(
-            np.array(par_cal_head_soft), np.array(par_meas_soft)), 'o', color=colors[0])
-        ax_1.plot((xpos[1 ] +2 ) *np.ones(len(par_meas_soft)), 100.0 *np.subtract(
-            np.array(par_cal_head_avgd_soft), np.array(par_meas_soft)), 'o', color=colors[1])
-        ax_1.plot((xpos[2 ] +2 ) *np.ones(len(par_meas_soft)), 100.0 *np.subtract(
-            np.array(par_cal_body_soft), np.array(par_meas_soft)), 'o', color=colors[2])
-        ax_1.plot((xpos[3 ] +2 ) *np.ones(len(par_meas_soft)), 100.0 *np.subtract(
-            np.array(par_cal_body_avgd_soft), np.array(par_meas_soft)), 'o', color=colors[3])
-    else:
-        bp2 = ax_1.boxplot([100.0 *np.subtract(np.array(par_cal_head_soft), np.array(par_meas_soft)),
-                            100.0 *np.subtract(np.array(par_cal_head_avgd_soft), np.array(par_meas_soft)),
-                            100.0 *np.subtract(np.array(par_cal_body_soft), np.array(par_meas_soft)),
-                            100.0 *np.subtract(np.array(par_cal_body_avgd_soft), np.array(par_meas_soft))],
-                           positions=list(map(lambda x: x + 2, xpos)), patch_artist=True, showmeans=True)
-        for patch, color in zip(bp2['boxes'], colors):
-            patch.set_facecolor(color)
-
-    # Plot results for bone tisues:
-    if len(par_meas_bone) < 5:
-        ax_1.plot((xpos[0 ] +3 ) *np.ones(len(par_meas_bone)), 100.0 *np.subtract(
-            np.array(par_cal_head_bone), np.array(par_meas_bone)), 'o', color=colors[0])
-        ax_1.plot((xpos[1 ] +3 ) *np.ones(len(par_meas_bone)), 100.0 *np.subtract(
-            np.array(par_cal_head_avgd_bone), np.array(par_meas_bone)), 'o', color=colors[1])
-        ax_1.plot((xpos[2 ] +3 ) *np.ones(len(par_meas_bone)), 100.0 *np.subtract(
-            np.array(par_cal_body_bone), np.array(par_meas_bone)), 'o', color=colors[2])
-        ax_1.plot((xpos[3 ] +3 ) *np.ones(len(par_meas_bone)), 100.0 *np.subtract(
-            np.array(par_cal_body_avgd_bone), np.array(par_meas_bone)), 'o', color=colors[3])
-    else:
-        bp3 = ax_1.boxplot([100.0 *np.subtract(np.array(par_cal_head_bone), np.array(par_meas_bone)),
-                            100.0 *np.subtract(np.array(par_cal_head_avgd_bone), np.array(par_meas_bone)),
-                            100.0 *np.subtract(np.array(par_cal_body_bone), np.array(par_meas_bone)),
-                            100.0 *np.subtract(np.array(par_cal_body_avgd_bone), np.array(par_meas_bone))],
-                           positions=list(map(lambda x: x + 3, xpos)), patch_artist=True, showmeans=True)
-        for patch, color in zip(bp3['boxes'], colors):
-            patch.set_facecolor(color)
+    # Plot results per tissue group (lung, adipose, soft tissues and bones):
+    for i, group in enumerate([1, 2, 3, 4]):
+        selected = difference[:, groups == group]
+        if selected.shape[1] < 5:
+            for j in range(len(xpos)):
+                ax_1.plot((xpos[j] + i) * np.ones(selected.shape[1]), selected[j], 'o', color=colors[j],
+                          label=labels[j] if i == 0 else None)
+        else:
+            bp = ax_1.boxplot(list(selected), positions=[x + i for x in xpos], patch_artist=True, showmeans=True)
+            for patch, color in zip(bp['boxes'], colors):
+                patch.set_facecolor(color)
+            if i == 0:
+                # Plot fake data to create a legend:
+                for j in range(len(xpos)):
+                    ax_1.plot([], [], 'o', color=colors[j], label=labels[j])
 
     output_parameter = datasheet['output_parameter'] # For labeling purposes
     ax_1.set_title(f'{output_parameter} accuracy with different HLUTs')
@@ -293,9 +113,57 @@ def main(datasheet):
 
     ax_1.legend()
 
-    plt.savefig("{}/for_report/svg/{}.svg".format(datasheet['output'] ,'Eval_endtoend_hlut_accuracy'))
-    plt.savefig('{}/for_report/{}.pdf'.format(datasheet['output'] ,'Eval_endtoend_hlut_accuracy'), bbox_inches="tight", dpi=300)
-    
-    plt.clf()
-    plt.cla()
-    plt.close()
\ No newline at end of file
+    figures.save_figure(datasheet, fig, 'Eval_endtoend_hlut_accuracy')
+
+
+def grouped_metrics(difference, groups):
+    """
+    Mean error, mean absolute error and root-mean-square error per tissue group, for any number
+    of data sets (e.g. HLUT variants or realizations) in one grouped reduction
+    Input:  difference - difference between the parameter from the HLUT and the reference (..., materials)
+            groups - tissue group of the materials
+    Output: metrics - array (..., metrics, groups), in the order of METRICS and GROUPS
+                      (NaN for tissue groups without materials)
+    """
+
+    groups = np.asarray(groups)
+    membership = np.stack([np.ones(len(groups), dtype=bool) if group is None else groups == group
+                           for group in GROUPS.values()], axis=1)
+    difference = np.asarray(difference, dtype=float)
+
+    # Sums of the differences, absolute and squared differences per group (..., metrics, groups):
+    values = np.stack((difference, np.abs(difference), difference ** 2), axis=-2)
+    sums = np.where(membership, values[..., np.newaxis], 0).sum(axis=-2)
+    with np.errstate(invalid='ignore'):
+        metrics = sums / membership.sum(axis=0)
+    metrics[..., 2, :] = np.sqrt(metrics[..., 2, :])
+
+    return metrics
+
+
+def metrics_dict(metrics):
+    """
+    Metrics per name and tissue group
+    Input:  metrics - array (..., metrics, groups) from grouped_metrics
+    Output: Dictionary of the metrics per group, floats or arrays (...)
+    """
+
+    return {metric: {group: metrics[..., i, j] if metrics.ndim > 2 else float(metrics[i, j])
+                     for j, group in enumerate(GROUPS)}
+            for i, metric in enumerate(METRICS)}
+
+
+def accuracy_table(datasheet, hluttype):
+    """
+    Table of the accuracy metrics of the head or body HLUT, as written to the text file and the PDF report
+    Input:  datasheet - Dictionary containing all calculated and measured data
+            hluttype - 'head' or 'body'
+    Output: rows of the table (strings)
+    """
+
+    metrics = datasheet['accuracy'][hluttype]
+    rows = [['Metric', 'All tissues', 'Lung', 'Adipose', 'Soft tissue', 'Bone']]
+    for metric, name in [('ME', 'Mean error (%)'), ('MAE', 'Mean absolute error (%)'), ('RMSE', 'RMSE (%)')]:
+        rows.append([name] + [str(metrics[metric][group]) for group in GROUPS])
+
+    return rows
@@ -6,8 +6,9 @@ Assessment of HLUTs created from averaged CT numbers against size-specific HLUTs
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import interpolate
+
+from utils import figures
+from utils.calculation import hlut_table
 
 
 def main(datasheet, recon_type):
@@ -15,6 +16,9 @@ def main(datasheet, recon_type):
     Evaluation box 5: Assessment of the need for body-site specific HLUTs:
     '''
 
+    if not figures.create_figures(datasheet):
+        return
+
     # Define value used:
     if datasheet['output_parameter'] == 'SPR':
         parameter = 'SPR_calc'
@@ -26,16 +30,11 @@ def main(datasheet, recon_type):
         parameter = 'Density (g/cm3)'
         y_axis = 'Mass Density (g/cm³)'
 
-    # Define HLUT functions:
-    hlut_head = interpolate.interp1d(datasheet['HLUTs']['head']['ctn'],
-                                     datasheet['HLUTs']['head'][datasheet['output_parameter']])
-    hlut_body = interpolate.interp1d(datasheet['HLUTs']['body']['ctn'],
-                                     datasheet['HLUTs']['body'][datasheet['output_parameter']])
-    hlut_avgd = interpolate.interp1d(datasheet['HLUTs']['avgdCT']['ctn'],
-                                     datasheet['HLUTs']['avgdCT'][datasheet['output_parameter']])
+    from matplotlib.figure import Figure
 
     # Create figure - subfigure 1 is used to visually evaluate the HLUTs:
-    fig6, ax6 = plt.subplots(2, figsize=(10, 10))
+    fig6 = Figure(figsize=(10, 10))
+    ax6 = fig6.subplots(2)
 
     # Plot the datapoints for the phantom inserts and tabulated human tissues:
     if not (datasheet['output_parameter'] == 'MD'):
@@ -81,7 +80,7 @@ def main(datasheet, recon_type):
     ax6[0].set_xlim([-1024, x_max])
 
     # Compute Output values at the maximum CT number:
-    y_max = np.ceil(max(hlut_head(x_max), hlut_body(x_max)) * 10) / 10
+    y_max = np.ceil(hlut_table.evaluate_hluts(datasheet, ['head', 'body'], x_max).max() * 10) / 10
     ax6[0].set_ylim([0, y_max])
 
     # Find the CT number for the second most dense phantom insert, and round it up:
@@ -92,11 +91,11 @@ def main(datasheet, recon_type):
         ctn_bone = ctn_bone + 100
 
     # Compute Output values at ctn_bone:
-    output_ctn_bone_head = hlut_head(ctn_bone)
-    output_ctn_bone_body = hlut_body(ctn_bone)
-    output_ctn_bone_average = hlut_avgd(ctn_bone)
-    output_ctn_bone_min = min(hlut_head(ctn_bone - 50), hlut_body(ctn_bone - 50))
-    output_ctn_bone_max = max(hlut_head(ctn_bone + 50), hlut_body(ctn_bone + 50))
+    output_ctn_bone_head, output_ctn_bone_body, output_ctn_bone_average = (
+        hlut_table.evaluate_hluts(datasheet, ['head', 'body', 'avgdCT'], ctn_bone))
+    output_ctn_bone_around = hlut_table.evaluate_hluts(datasheet, ['head', 'body'], [ctn_bone - 50, ctn_bone + 50])
+    output_ctn_bone_min = output_ctn_bone_around[:, 0].min()
+    output_ctn_bone_max = output_ctn_bone_around[:, 1].max()
 
     ax6[0].yaxis.grid(which='major', color='gray', linestyle='-', alpha=0.3)  # vertical lines (major)
     ax6[0].legend()
@@ -148,9 +147,8 @@ def main(datasheet, recon_type):
 
     # Create difference plot bottom
     xlist = np.arange(-1024, x_max)
-    y_value_head = hlut_head(xlist)
-    y_value_body = hlut_body(xlist)
-    y_value_average = hlut_avgd(xlist)
+    y_value_head, y_value_body, y_value_average = (
+        hlut_table.evaluate_hluts(datasheet, ['head', 'body', 'avgdCT'], xlist))
 
     ax6[1].plot(xlist, 100 * (y_value_head - y_value_average), '-', color='steelblue',
                 label='HLUT head - HLUT average')
@@ -170,10 +168,4 @@ def main(datasheet, recon_type):
     ax6[1].set_xlim([-1024, x_max])
     ax6[1].legend()
 
-    plt.savefig("{}/for_report/svg/Eval_box_5_hlut_comp.svg".format(datasheet['output']))
-    plt.savefig('{}/for_report/Eval_box_5_hlut_comp.pdf'.format(datasheet['output']), bbox_inches="tight",
-                dpi=300)
-    
-    plt.clf()
-    plt.cla()
-    plt.close()
\ No newline at end of file
+    figures.save_figure(datasheet, fig6, 'Eval_box_5_hlut_comp')
\ No newline at end of file
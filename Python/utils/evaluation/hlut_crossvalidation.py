@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-validation of the HLUT accuracy
+
+% SPDX-License-Identifier: MIT
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import profiling
+from utils.calculation import fit_and_estimate_ctnumbers
+from utils.calculation import fit_and_plot_hluts
+from utils.evaluation import hlut_accuracy
+
+# HLUT types evaluated (as in hlut_accuracy) and the respective CT number columns:
+HLUT_TYPES = ['head', 'body']
+CTN_COLUMNS = ['CT number (Head)', 'CT number (Body)']
+CTN_CALC_COLUMNS = ['ctn_calc_head', 'ctn_calc_body']
+
+
+def main(datasheet, recon_type, folds='insert', workers=1):
+    """
+    Leave-one-out cross-validation of the HLUT accuracy. In contrast to hlut_accuracy,
+    every material is evaluated with a HLUT that was fitted without it:
+    folds='insert' - each phantom insert is held out from the k value fit and the HLUT fit
+    folds='tissue' - each tabulated human tissue is held out from the HLUT fit
+    Materials which would leave their tissue group empty are skipped and reported (see held_out_materials),
+    since the respective HLUT segment could not be fitted or would be extrapolated.
+    The k value fits and the HLUT fits of all folds are solved in one batch, the folds can be
+    split over a process pool.
+    Input:  datasheet - Dictionary containing all calculated and measured data, with fitted HLUTs
+            recon_type - Reconstruction type
+            folds - 'insert' or 'tissue'
+            workers - number of processes for the folds
+    Output: datasheet, addended with the out-of-sample predictions (NaN for the skipped materials),
+            the skipped materials and the ME, MAE and RMSE (%) per tissue group for the head and body HLUTs
+    """
+
+    # Reference values and materials of the folds:
+    par_values = fit_and_plot_hluts.reference_values(datasheet)
+    if folds == 'insert':
+        dataset, name, par_ref = 'PhantomInserts', 'Insert name', par_values[0]
+    elif folds == 'tissue':
+        dataset, name, par_ref = 'TabulatedHumanTissues', 'Tissue name', par_values[1]
+    else:
+        raise ValueError("Invalid folds '{}'. It should be 'insert' or 'tissue'.".format(folds))
+    groups = np.asarray(datasheet[dataset]['Tissue group'])
+
+    # Materials which cannot be held out:
+    valid = held_out_materials(datasheet, folds)
+    held_out = np.flatnonzero(valid)
+    skipped = list(np.asarray(datasheet[dataset][name])[~valid])
+    if len(skipped) > 0:
+        print('--- Cross-validation: {} not held out, since it is the only material of its tissue group '
+              'in the HLUT fit.'.format(', '.join(str(i) for i in skipped)))
+
+    # Data needed for the fits (as small as possible to be sent to the workers):
+    data = {key: datasheet[key] for key in ['PhantomInserts', 'TabulatedHumanTissues', 'CTnumbers', 'basis',
+                                            'output_parameter']}
+
+    # Fit and evaluate the folds, in chunks of a process pool if requested:
+    predictions = np.full((len(CTN_COLUMNS), len(groups)), np.nan)
+    chunks = np.array_split(held_out, max(1, min(workers, len(held_out))))
+    if len(held_out) == 0:
+        pass
+    elif len(chunks) == 1:
+        predictions[:, held_out] = fold_predictions(data, recon_type, folds, chunks[0], par_values)
+    else:
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            futures = [executor.submit(fold_predictions, data, recon_type, folds, chunk, par_values)
+                       for chunk in chunks]
+            predictions[:, held_out] = np.concatenate([future.result() for future in futures], axis=1)
+
+    # Out-of-sample accuracy per tissue group, of the materials which were held out:
+    datasheet['crossvalidation'] = {'folds': folds, 'predictions': {}, 'accuracy': {}, 'skipped': skipped}
+    metrics = hlut_accuracy.grouped_metrics(100.0 * (predictions[:, valid] - np.asarray(par_ref)[valid]),
+                                            groups[valid])
+    for i, hluttype in enumerate(HLUT_TYPES):
+        datasheet['crossvalidation']['predictions'][hluttype] = predictions[i]
+        datasheet['crossvalidation']['accuracy'][hluttype] = hlut_accuracy.metrics_dict(metrics[i])
+
+    if datasheet['output'] is not None:
+        write_crossvalidation(datasheet)
+
+    return datasheet
+
+
+def held_out_materials(datasheet, folds):
+    """
+    Materials which can be held out. A material is skipped if it is the only material of its
+    tissue group in the HLUT fit (the segment would be extrapolated from the other tissue groups),
+    if the straight line of its tissue group (lung and soft tissue share one) would be fitted to
+    less than two materials, or if it is the only tabulated human tissue of the adipose, soft tissue
+    or bone group (both are needed to fit the HLUT, see fit_and_plot_hluts.hlut_fit_batch). For MD,
+    the phantom inserts are not used in the HLUT fit, so all of them can be held out.
+    Input:  datasheet - Dictionary with (at least) PhantomInserts, TabulatedHumanTissues and output_parameter
+            folds - 'insert' or 'tissue'
+    Output: valid - boolean array, True for the materials which can be held out
+    """
+
+    groups_phantom = np.asarray(datasheet['PhantomInserts']['Tissue group'])
+    groups_tiss = np.asarray(datasheet['TabulatedHumanTissues']['Tissue group'])
+    if datasheet['output_parameter'] == 'MD':
+        if folds == 'insert':
+            return np.ones(len(groups_phantom), dtype=bool)
+        groups_phantom = groups_phantom[:0]
+
+    # Number of materials in the HLUT fit and of tabulated human tissues per tissue group of each material:
+    groups = groups_phantom if folds == 'insert' else groups_tiss
+    groups_fit = np.concatenate((groups_phantom, groups_tiss))
+    n_fit = (groups_fit[:, np.newaxis] == groups).sum(axis=0)
+    n_tabulated = (groups_tiss[:, np.newaxis] == groups).sum(axis=0)
+
+    # Number of materials of the straight line of each material (lung and soft tissue are fitted together):
+    lines_fit, lines = [np.where(i == 1, 3, i) for i in (groups_fit, groups)]
+    n_line = (lines_fit[:, np.newaxis] == lines).sum(axis=0)
+
+    valid = (n_fit > 1) & (n_line > 2)
+    if folds == 'tissue':
+        valid &= (n_tabulated > 1) | (groups == 1)
+
+    return valid
+
+
+def fold_predictions(datasheet, recon_type, folds, held_out, par_values):
+    """
+    Out-of-sample predictions of the output parameter for a set of folds
+    Input:  datasheet - Dictionary with (at least) PhantomInserts, TabulatedHumanTissues, CTnumbers,
+                        basis and output_parameter
+            recon_type - Reconstruction type
+            folds - 'insert' or 'tissue'
+            held_out - indices of the held-out materials, one per fold
+            par_values - reference values (par_phantom, par_tiss, par_air), see fit_and_plot_hluts.reference_values
+    Output: predictions - output parameter of the held-out materials from the head and body HLUTs (2 x folds)
+    """
+
+    ctn = np.array(datasheet['CTnumbers'][CTN_COLUMNS], dtype=float)
+    n_inserts = len(ctn)
+    n_tissues = len(datasheet['TabulatedHumanTissues'])
+
+    if folds == 'insert':
+        # k values without the held-out insert, for all folds at once:
+        selections = np.array(list(fit_and_estimate_ctnumbers.tissue_selections(datasheet['PhantomInserts'],
+                                                                                recon_type).values()))
+        keep = ~np.eye(n_inserts, dtype=bool)[held_out]
+        masks = (keep[:, np.newaxis, :] & selections[np.newaxis]).reshape(-1, n_inserts)
+        k_values = fit_and_estimate_ctnumbers.k_value_fit_batch(datasheet, ctn, masks)
+        k_values = k_values.reshape(len(CTN_COLUMNS), len(held_out), len(selections), 3)
+
+        # Estimate the CT numbers of the tabulated human tissues with the k values of each fold:
+        ctn_calc = fit_and_estimate_ctnumbers.ctn_calculation_batch(datasheet, 'TabulatedHumanTissues', k_values)
+        masks = fit_and_estimate_ctnumbers.tissue_selections(datasheet['TabulatedHumanTissues'], recon_type).values()
+        tabul_ctn = np.concatenate([ctn_calc[:, :, j][..., mask] for j, mask in enumerate(masks)], axis=-1)
+    else:
+        # The k value fit does not depend on the tabulated human tissues:
+        tabul_ctn = np.array(datasheet['TabulatedHumanTissues'][CTN_CALC_COLUMNS], dtype=float).T
+        tabul_ctn = np.broadcast_to(tabul_ctn[:, np.newaxis], (len(CTN_COLUMNS), len(held_out), n_tissues))
+
+    # Materials used for the HLUT fits of the folds:
+    if folds == 'insert':
+        phantom_keep, tabul_keep = ~np.eye(n_inserts, dtype=bool)[held_out], None
+    else:
+        phantom_keep, tabul_keep = None, ~np.eye(n_tissues, dtype=bool)[held_out]
+
+    predictions = np.empty((len(CTN_COLUMNS), len(held_out)))
+    for i in range(len(CTN_COLUMNS)):
+        # HLUTs of all folds in one batch, with the held-out material masked:
+        cp_ctn, cp_par, notes = fit_and_plot_hluts.hlut_fit_batch(datasheet, ctn[:, i], tabul_ctn[i], par_values,
+                                                                  phantom_keep, tabul_keep)
+        for j, held in enumerate(held_out):
+            if folds == 'insert':
+                predictions[i, j] = np.interp(ctn[held, i], cp_ctn[j], cp_par[j])
+            else:
+                predictions[i, j] = np.interp(tabul_ctn[i, j][held], cp_ctn[j], cp_par[j])
+
+    return predictions
+
+
+def write_crossvalidation(datasheet):
+    """
+    Write the out-of-sample accuracy metrics to a text file
+    Input:  datasheet - Dictionary containing all calculated and measured data
+    """
+
+    crossvalidation = datasheet['crossvalidation']
+    groups = ['all', 'lung', 'adipose', 'soft tissue', 'bone']
+    file_name = '{}/Eval_crossvalidation_{}.txt'.format(datasheet['output'], crossvalidation['folds'])
+    profiling.record_file(datasheet, file_name)
+    with open(file_name, 'w') as f:
+        for hluttype, metrics in crossvalidation['accuracy'].items():
+            f.write('Leave-one-{}-out accuracy, HLUT {}\n'.format(crossvalidation['folds'], hluttype))
+            f.write('Metric    All tissues    Lung    Adipose    Soft tissue    Bone\n')
+            for metric, name in [('ME', 'Mean error (%)'), ('MAE', 'Mean absolute error (%)'), ('RMSE', 'RMSE (%)')]:
+                f.write('{}    {}\n'.format(name, '    '.join([str(round(metrics[metric][i], 2)) for i in groups])))
+            f.write('\n')
+        if len(crossvalidation['skipped']) > 0:
+            f.write('Not held out (only material of its tissue group in the HLUT fit): {}\n'.format(
+                ', '.join(str(i) for i in crossvalidation['skipped'])))
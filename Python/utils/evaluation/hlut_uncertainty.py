@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Uncertainty of the HLUTs by Monte Carlo resampling of the measured CT numbers
+
+% SPDX-License-Identifier: MIT
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import profiling
+from utils.calculation import fit_and_estimate_ctnumbers
+from utils.calculation import fit_and_plot_hluts
+from utils.evaluation import hlut_accuracy
+
+# Percentiles of the reported bands (median and 95% interval):
+PERCENTILES = (2.5, 50, 97.5)
+
+
+def main(datasheet, recon_type, ctn_sd, n_samples=1000, seed=None, workers=1, percentiles=PERCENTILES):
+    """
+    Propagation of the CT number noise to the HLUTs and their accuracy.
+    The mean CT numbers of the phantom inserts (head and body) are resampled from a
+    normal distribution, the averaged CT numbers follow from them. For every realization,
+    the k values are refitted, the CT numbers of the tabulated human tissues are estimated,
+    the HLUTs are fitted and the accuracy metrics are calculated. The k value fits and
+    CT number estimations and the HLUT fits of all realizations are solved in one batch.
+    Input:  datasheet - Dictionary containing all calculated and measured data, with fitted HLUTs
+            recon_type - Reconstruction type
+            ctn_sd - standard deviation of the mean CT numbers in the insert ROIs (HU), as scalar,
+                     per insert, or per insert for head and body phantom (inserts x 2)
+            n_samples - number of realizations
+            seed - seed of the random number generator
+            workers - number of processes for the HLUT fits of the realizations
+            percentiles - percentiles of the reported bands
+    Output: datasheet, addended with the percentile bands of the HLUT connection points
+            and accuracy metrics, and the connection points of all realizations
+    """
+
+    ctn = np.array(datasheet['CTnumbers'][['CT number (Head)', 'CT number (Body)']], dtype=float)
+    ctn_sd = np.asarray(ctn_sd, dtype=float)
+    if ctn_sd.size > 1 and ctn_sd.shape not in [(len(ctn),), (len(ctn), 2)]:
+        raise ValueError(f"The standard deviation of the CT numbers has the shape {ctn_sd.shape}. It should be a "
+                         f"single value, one value per insert ({len(ctn)}) or one per insert for head and body phantom "
+                         f"({len(ctn)} x 2).")
+
+    # Resample the CT numbers of the phantom inserts:
+    rng = np.random.default_rng(seed)
+    if ctn_sd.ndim == 1:
+        ctn_sd = ctn_sd[:, np.newaxis]
+    samples = ctn + rng.normal(size=(n_samples,) + ctn.shape) * ctn_sd
+    samples = np.concatenate((samples, np.nanmean(samples, axis=-1, keepdims=True)), axis=-1)
+
+    # Reference values and the data needed for the fits (as small as possible to be sent to the workers):
+    par_values = fit_and_plot_hluts.reference_values(datasheet)
+    data = {key: datasheet[key] for key in ['PhantomInserts', 'TabulatedHumanTissues', 'basis', 'output_parameter']}
+
+    # Fit the realizations, in chunks of a process pool if requested:
+    chunks = np.array_split(samples, max(1, min(workers, n_samples)))
+    if len(chunks) == 1:
+        results = [realizations(data, recon_type, samples, par_values)]
+    else:
+        with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            futures = [executor.submit(realizations, data, recon_type, chunk, par_values) for chunk in chunks]
+            results = [future.result() for future in futures]
+
+    # Combine the chunks:
+    hluts = {hluttype: np.concatenate([i[0][hluttype] for i in results])
+             for hluttype in fit_and_estimate_ctnumbers.HLUT_TYPES}
+    accuracy = {hluttype: np.concatenate([i[1][hluttype] for i in results]) for hluttype in ['head', 'body']}
+
+    # Percentile bands of the connection points and accuracy metrics:
+    par = datasheet['output_parameter']
+    datasheet['uncertainty'] = {
+        'n_samples': n_samples,
+        'percentiles': list(percentiles),
+        'HLUTs': {hluttype: {'ctn': np.percentile(hluts[hluttype][:, 0], percentiles, axis=0),
+                             par: np.percentile(hluts[hluttype][:, 1], percentiles, axis=0)}
+                  for hluttype in hluts},
+        'accuracy': {hluttype: hlut_accuracy.metrics_dict(np.nanpercentile(accuracy[hluttype], percentiles, axis=0))
+                     for hluttype in accuracy},
+        'samples': {hluttype: {'ctn': hluts[hluttype][:, 0], par: hluts[hluttype][:, 1]} for hluttype in hluts}}
+
+    if datasheet['output'] is not None:
+        write_uncertainty(datasheet)
+
+    return datasheet
+
+
+def realizations(datasheet, recon_type, samples, par_values):
+    """
+    HLUTs and accuracy metrics for realizations of the CT numbers of the phantom inserts
+    Input:  datasheet - Dictionary with (at least) PhantomInserts, TabulatedHumanTissues,
+                        basis and output_parameter
+            recon_type - Reconstruction type
+            samples - CT numbers of the phantom inserts (realizations x inserts x 3, for head, body and averaged)
+            par_values - reference values (par_phantom, par_tiss, par_air), see fit_and_plot_hluts.reference_values
+    Output: hluts - connection points per HLUT type (realizations x 2 x connection points, CT numbers and parameter)
+            accuracy - accuracy metrics (%) of the head and body HLUT (realizations x metrics x groups,
+                       see hlut_accuracy.grouped_metrics)
+    """
+
+    n_samples, n_inserts = samples.shape[:2]
+    n_types = len(fit_and_estimate_ctnumbers.HLUT_TYPES)
+
+    # k values of all realizations and CT number types in one batch (column = type * n_samples + realization):
+    masks = list(fit_and_estimate_ctnumbers.tissue_selections(datasheet['PhantomInserts'], recon_type).values())
+    ctn_columns = samples.transpose(1, 2, 0).reshape(n_inserts, -1)
+    k_values = fit_and_estimate_ctnumbers.k_value_fit_batch(datasheet, ctn_columns, masks)
+
+    # Estimate the CT numbers of the tabulated human tissues for all k sets:
+    ctn_calc = fit_and_estimate_ctnumbers.ctn_calculation_batch(datasheet, 'TabulatedHumanTissues', k_values)
+    masks = fit_and_estimate_ctnumbers.tissue_selections(datasheet['TabulatedHumanTissues'], recon_type).values()
+    tabul_ctn = np.concatenate([ctn_calc[:, j][:, mask] for j, mask in enumerate(masks)], axis=-1)
+    tabul_ctn = tabul_ctn.reshape(n_types, n_samples, -1)
+
+    # Fit the HLUTs of all realizations in one batch per HLUT type:
+    hluts = {}
+    for i, hluttype in enumerate(fit_and_estimate_ctnumbers.HLUT_TYPES):
+        cp_ctn, cp_par, notes = fit_and_plot_hluts.hlut_fit_batch(datasheet, samples[:, :, i], tabul_ctn[i],
+                                                                  par_values)
+        hluts[hluttype] = np.stack((cp_ctn, cp_par), axis=1)
+
+    # Accuracy of the head and body HLUTs, for the phantom inserts (not for MD) and the tabulated human tissues:
+    par_phantom, par_tiss = par_values[:2]
+    if datasheet['output_parameter'] == 'MD':
+        groups = np.asarray(datasheet['TabulatedHumanTissues']['Tissue group'])
+        par_ref = par_tiss
+    else:
+        groups = np.concatenate((np.asarray(datasheet['PhantomInserts']['Tissue group']),
+                                 np.asarray(datasheet['TabulatedHumanTissues']['Tissue group'])))
+        par_ref = np.concatenate((par_phantom, par_tiss))
+
+    accuracy = {}
+    for i, hluttype in enumerate(['head', 'body']):
+        ctn = tabul_ctn[i]
+        if datasheet['output_parameter'] != 'MD':
+            ctn = np.concatenate((samples[:, :, i], ctn), axis=1)
+        par_cal = interpolate_realizations(ctn, hluts[hluttype][:, 0], hluts[hluttype][:, 1])
+        accuracy[hluttype] = hlut_accuracy.grouped_metrics(100.0 * (par_cal - par_ref), groups)
+
+    return hluts, accuracy
+
+
+def interpolate_realizations(ctn, cp_ctn, cp_par):
+    """
+    Piecewise linear HLUTs of all realizations at once, constant beyond the first and the last
+    connection point (as numpy.interp). The realizations are shifted to disjoint CT number ranges,
+    so the segments of all CT numbers are found with one sorted search.
+    Input:  ctn - CT numbers (realizations x materials)
+            cp_ctn, cp_par - connection points of the HLUTs (realizations x connection points)
+    Output: par_cal - output parameter (realizations x materials)
+    """
+
+    n_samples, n_points = cp_ctn.shape
+    ctn = np.clip(ctn, cp_ctn[:, :1], cp_ctn[:, -1:])
+
+    # Segment of every CT number (index of its first connection point):
+    offset = (np.max(cp_ctn) - np.min(cp_ctn) + 1) * np.arange(n_samples)[:, np.newaxis]
+    segment = np.searchsorted((cp_ctn + offset).ravel(), (ctn + offset).ravel(), side='right').reshape(ctn.shape)
+    segment = np.clip(segment - 1 - n_points * np.arange(n_samples)[:, np.newaxis], 0, n_points - 2)
+
+    rows = np.arange(n_samples)[:, np.newaxis]
+    x_0, x_1 = cp_ctn[rows, segment], cp_ctn[rows, segment + 1]
+    y_0, y_1 = cp_par[rows, segment], cp_par[rows, segment + 1]
+    width = x_1 - x_0
+    weight = np.divide(ctn - x_0, width, out=np.zeros(ctn.shape), where=width > 0)
+
+    return y_0 + weight * (y_1 - y_0)
+
+
+def write_uncertainty(datasheet):
+    """
+    Write the percentile bands of the HLUT connection points and the accuracy metrics to a text file
+    Input:  datasheet - Dictionary containing all calculated and measured data
+    """
+
+    par = datasheet['output_parameter']
+    uncertainty = datasheet['uncertainty']
+    labels = ['P{:g}'.format(i) for i in uncertainty['percentiles']]
+
+    file_name = '{}/{}_HLUT_uncertainty.txt'.format(datasheet['output'], par)
+    profiling.record_file(datasheet, file_name)
+    with open(file_name, 'w') as f:
+        f.write('Percentile bands from {} realizations\n'.format(uncertainty['n_samples']))
+        for hluttype, bands in uncertainty['HLUTs'].items():
+            f.write('\nHLUT {}\n'.format(hluttype))
+            f.write('\t'.join(['CT number ' + i for i in labels] + [par + ' ' + i for i in labels]) + '\n')
+            for ctn, value in zip(bands['ctn'].T, bands[par].T):
+                f.write('\t'.join(['{:.1f}'.format(i) for i in ctn] + ['{:.4f}'.format(i) for i in value]) + '\n')
+        for hluttype, metrics in uncertainty['accuracy'].items():
+            f.write('\nAccuracy (%) {}\n'.format(hluttype))
+            f.write('\t'.join(['Metric', 'Group'] + labels) + '\n')
+            for metric, groups in metrics.items():
+                for group, values in groups.items():
+                    f.write('\t'.join([metric, group] + ['{:.2f}'.format(i) for i in values]) + '\n')
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Differences between the HLUTs on patient CT volumes
+
+Each volume is streamed once to count the voxels per CT number. The differences
+between the HLUTs are then evaluated per CT number and weighted with the histogram,
+so the cost of the comparison does not depend on the number of voxels.
+
+% SPDX-License-Identifier: MIT
+"""
+
+import os
+import itertools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import profiling
+from utils.calculation import hlut_table
+from utils.calculation import volume_conversion
+
+# Range of the histogram bins (integer CT numbers), CT numbers outside are counted in the first or last bin:
+HISTOGRAM_RANGE = (-32768, 32767)
+
+
+def main(datasheet, input_paths, hluttypes=('head', 'body', 'avgdCT'), ctn_range=None, shape=None, dtype='int16',
+         header=0, rescale_slope=1, rescale_intercept=0, workers=1):
+    """
+    Voxel-weighted differences of the output parameter between every pair of HLUTs,
+    for each patient volume and for all volumes together
+    Input:  datasheet - Dictionary containing all calculated and measured data, with fitted HLUTs
+            input_paths - CT volumes (see volume_conversion.open_volume)
+            hluttypes - HLUTs to be compared
+            ctn_range - (min, max) CT numbers of the voxels included in the statistics, e.g. (-950, None)
+                        to exclude the air around the patient, None for all voxels
+            shape, dtype, header, rescale_slope, rescale_intercept - see volume_conversion.convert_volume
+            workers - number of volumes processed at once
+    Output: datasheet, addended with the histograms and difference statistics
+    """
+
+    # Stream the volumes and count the CT numbers:
+    arguments = (shape, dtype, header, rescale_slope, rescale_intercept)
+    if workers == 1:
+        histograms = [ctn_histogram(i, *arguments) for i in input_paths]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            histograms = list(executor.map(lambda i: ctn_histogram(i, *arguments), input_paths))
+
+    tables = {i: hlut_table.hlut_evaluator(datasheet, i) for i in hluttypes}
+    statistics = [difference_statistics(tables, i, ctn_range) for i in histograms]
+    total = difference_statistics(tables, combine_histograms(histograms), ctn_range)
+
+    names = [i if isinstance(i, str) else 'volume {}'.format(j + 1) for j, i in enumerate(input_paths)]
+    datasheet['volume_differences'] = {'volumes': names, 'ctn_range': ctn_range, 'histograms': histograms,
+                                       'statistics': statistics, 'total': total}
+
+    if datasheet['output'] is not None:
+        write_differences(datasheet)
+
+    return datasheet
+
+
+def ctn_histogram(input_path, shape=None, dtype='int16', header=0, rescale_slope=1, rescale_intercept=0,
+                  slab_size=volume_conversion.SLAB_SIZE):
+    """
+    Number of voxels per integer CT number, streamed slab by slab
+    Input:  input_path - CT volume (see volume_conversion.open_volume)
+            Rest: see volume_conversion.convert_volume
+    Output: histogram - Dictionary with the CT number of the first bin (offset) and the counts
+    """
+
+    volume = volume_conversion.open_volume(input_path, shape, dtype, header)
+    n_slices = volume_conversion.volume_shape(volume)[0]
+    first, last = HISTOGRAM_RANGE
+
+    counts = np.zeros(last - first + 1, dtype=np.int64)
+    for start in range(0, n_slices, slab_size):
+        ctn = volume_conversion.read_slab(volume, start, min(start + slab_size, n_slices), rescale_slope,
+                                          rescale_intercept)
+        if not np.issubdtype(ctn.dtype, np.integer):
+            ctn = np.rint(ctn)
+        index = np.clip(ctn, first, last).astype(np.intp).ravel() - first
+        counts += np.bincount(index, minlength=len(counts))
+
+    # Keep the range of CT numbers that occur:
+    occupied = np.flatnonzero(counts)
+    if len(occupied) == 0:
+        return {'offset': 0, 'counts': np.zeros(0, dtype=np.int64)}
+
+    return {'offset': first + occupied[0], 'counts': counts[occupied[0]:occupied[-1] + 1]}
+
+
+def combine_histograms(histograms):
+    """
+    Sum of several histograms
+    Input:  histograms - list of histograms from ctn_histogram
+    Output: histogram - combined histogram
+    """
+
+    histograms = [i for i in histograms if len(i['counts']) > 0]
+    if len(histograms) == 0:
+        return {'offset': 0, 'counts': np.zeros(0, dtype=np.int64)}
+
+    first = min(i['offset'] for i in histograms)
+    last = max(i['offset'] + len(i['counts']) - 1 for i in histograms)
+    counts = np.zeros(last - first + 1, dtype=np.int64)
+    for i in histograms:
+        counts[i['offset'] - first:i['offset'] - first + len(i['counts'])] += i['counts']
+
+    return {'offset': first, 'counts': counts}
+
+
+def difference_statistics(tables, histogram, ctn_range=None):
+    """
+    Voxel-weighted statistics of the differences between the HLUTs, evaluated once per CT number
+    Input:  tables - compiled HLUTs per HLUT type
+            histogram - histogram from ctn_histogram
+            ctn_range - (min, max) CT numbers included, see main
+    Output: statistics - per pair of HLUTs (e.g. 'head - body'): number of voxels and mean, mean
+                         absolute, RMS, 95th percentile of the absolute and maximum absolute
+                         difference (in % of the output parameter, as in hlut_assessment)
+    """
+
+    ctn = histogram['offset'] + np.arange(len(histogram['counts']))
+    counts = histogram['counts']
+    if ctn_range is not None:
+        selected = np.ones(len(ctn), dtype=bool)
+        if ctn_range[0] is not None:
+            selected &= ctn >= ctn_range[0]
+        if ctn_range[1] is not None:
+            selected &= ctn <= ctn_range[1]
+        ctn, counts = ctn[selected], counts[selected]
+
+    # Output parameter of every HLUT for the CT numbers of the histogram:
+    par = {i: hlut_table.lookup(tables[i], ctn, out_of_range='clip').astype(np.float64) for i in tables}
+
+    statistics = {}
+    n_voxels = counts.sum()
+    for a, b in itertools.combinations(tables, 2):
+        difference = 100 * (par[a] - par[b])
+        if n_voxels == 0:
+            values = [np.nan] * 5
+        else:
+            weights = counts / n_voxels
+            absolute = np.abs(difference)
+            order = np.argsort(absolute, kind='stable')
+            p95 = absolute[order][np.searchsorted(np.cumsum(counts[order]), 0.95 * n_voxels)]
+            values = [np.sum(weights * difference), np.sum(weights * absolute),
+                      np.sqrt(np.sum(weights * difference ** 2)), p95, absolute[counts > 0].max()]
+        statistics['{} - {}'.format(a, b)] = dict(zip(['voxels', 'ME', 'MAE', 'RMSE', 'P95', 'max'],
+                                                      [int(n_voxels)] + [float(i) for i in values]))
+
+    return statistics
+
+
+def write_differences(datasheet):
+    """
+    Write the difference statistics to a text file
+    Input:  datasheet - Dictionary containing all calculated and measured data
+    """
+
+    differences = datasheet['volume_differences']
+    metrics = ['ME', 'MAE', 'RMSE', 'P95', 'max']
+    file_name = '{}/Eval_HLUT_differences_volumes.txt'.format(datasheet['output'])
+    profiling.record_file(datasheet, file_name)
+    with open(file_name, 'w') as f:
+        f.write('Differences of the {} between the HLUTs (%), weighted with the voxels of the CT volumes\n'
+                .format(datasheet['output_parameter']))
+        if differences['ctn_range'] is not None:
+            low, high = differences['ctn_range']
+            f.write('CT numbers included: {} to {}\n'.format('lowest' if low is None else '{:g} HU'.format(low),
+                                                               'highest' if high is None else '{:g} HU'.format(high)))
+        f.write('\t'.join(['Volume', 'HLUTs', 'Voxels'] + metrics) + '\n')
+        for name, statistics in zip(differences['volumes'] + ['All volumes'],
+                                    differences['statistics'] + [differences['total']]):
+            for pair, values in statistics.items():
+                f.write('\t'.join([os.path.basename(name), pair, str(values['voxels'])]
+                                  + ['{:.3f}'.format(values[i]) for i in metrics]) + '\n')
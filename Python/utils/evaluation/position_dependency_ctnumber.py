@@ -5,7 +5,10 @@ Assessment of position dependency of CT numbers
 % SPDX-License-Identifier: MIT
 """
 
-from scipy import interpolate
+import numpy as np
+
+from utils import tables
+from utils.calculation import hlut_table
 
 
 def main(datasheet):
@@ -18,20 +21,17 @@ def main(datasheet):
     datasheet['CTnumbers']['CT number (middle - outer)'] = (
             datasheet['CTnumbers']['CT number (Body)'] - datasheet['CTnumbers']['CT number (Body periphery)'])
 
-    with open('{}/for_report/Eval_ctn_positiondependency.txt'.format(datasheet['output']), 'w') as f:
-        f.write('Insert name    CTN middle (HU)    CTN outer (HU)    Difference (HU) \n')
-        for i in range(0, len(datasheet['CTnumbers']['CT number (Body)'])):
-            if str(datasheet['CTnumbers']['CT number (Body periphery)'][i]) != 'nan':
-                f.write('{}    {}    {}    {}\n'.format(
-                    datasheet['CTnumbers']['Insert name'][i],
-                    round(datasheet['CTnumbers']['CT number (Body)'][i]),
-                    round(datasheet['CTnumbers']['CT number (Body periphery)'][i]),
-                    round(datasheet['CTnumbers']['CT number (middle - outer)'][i])))
+    # Table of the CT numbers measured in the center and periphery:
+    rows = [['Insert name', 'CTN middle (HU)', 'CTN outer (HU)', 'Difference (HU)']]
+    for i in range(0, len(datasheet['CTnumbers']['CT number (Body)'])):
+        if str(datasheet['CTnumbers']['CT number (Body periphery)'][i]) != 'nan':
+            rows.append([datasheet['CTnumbers']['Insert name'][i],
+                         round(datasheet['CTnumbers']['CT number (Body)'][i]),
+                         round(datasheet['CTnumbers']['CT number (Body periphery)'][i]),
+                         round(datasheet['CTnumbers']['CT number (middle - outer)'][i])])
+    tables.save_table(datasheet, 'Eval_ctn_positiondependency', rows)
 
     # Parameter estimation accuracy for bone insert in center and periphery of large phantom:
-    # Define HLUT functions:
-    hlut_body = interpolate.interp1d(datasheet['HLUTs']['body']['ctn'],
-                                     datasheet['HLUTs']['body'][datasheet['output_parameter']])
     # Define value used:
     if datasheet['output_parameter'] == 'SPR':
         parameter = 'SPR_calc'
@@ -39,19 +39,23 @@ def main(datasheet):
         parameter = 'rhoe_calc'
     elif datasheet['output_parameter'] == 'MD':
         parameter = 'Density (g/cm3)'
-    with open('{}/for_report/Eval_parameter_positiondependency.txt'.format(datasheet['output']), 'w') as f:
-        f.write(
-            'Insert name    Reference ' + datasheet['output_parameter'] + '    Est. ' + datasheet['output_parameter'] + \
-            ' middle    Dev. middle (%)    Est. ' + datasheet['output_parameter'] + ' outer    Dev. outer (%)\n')
-        for i in range(0, len(datasheet['CTnumbers']['CT number (Body)'])):
-            if str(datasheet['CTnumbers']['CT number (Body periphery)'][i]) != 'nan':
-                ref_value = datasheet['PhantomInserts'][parameter][i]
-                par_bone_center = hlut_body(datasheet['CTnumbers']['CT number (Body)'][i])
-                par_bone_peri = hlut_body(datasheet['CTnumbers']['CT number (Body periphery)'][i])
-                f.write('{}    {}    {}    {}%    {}    {}%\n'.format(
-                    datasheet['CTnumbers']['Insert name'][i],
-                    round(ref_value, 3),
-                    round(float(par_bone_center), 3),
-                    round((float(par_bone_center) - ref_value) * 100, 2),
-                    round(float(par_bone_peri), 3),
-                    round((float(par_bone_peri) - ref_value) * 100, 2)))
\ No newline at end of file
+
+    # Output parameter from the body HLUT for the inserts measured in center and periphery:
+    measured = np.flatnonzero(np.isfinite(np.asarray(datasheet['CTnumbers']['CT number (Body periphery)'],
+                                                     dtype=float)))
+    par_bone_center, par_bone_peri = hlut_table.evaluate_hluts(datasheet, 'body', np.array(
+        datasheet['CTnumbers'][['CT number (Body)', 'CT number (Body periphery)']], dtype=float)[measured].T)
+
+    # Table of the output parameter estimated for the center and periphery:
+    par = datasheet['output_parameter']
+    rows = [['Insert name', 'Reference ' + par, 'Est. ' + par + ' middle', 'Dev. middle (%)', 'Est. ' + par + ' outer',
+             'Dev. outer (%)']]
+    for j, i in enumerate(measured):
+        ref_value = datasheet['PhantomInserts'][parameter][i]
+        rows.append([datasheet['CTnumbers']['Insert name'][i],
+                     round(ref_value, 3),
+                     round(float(par_bone_center[j]), 3),
+                     '{}%'.format(round((float(par_bone_center[j]) - ref_value) * 100, 2)),
+                     round(float(par_bone_peri[j]), 3),
+                     '{}%'.format(round((float(par_bone_peri[j]) - ref_value) * 100, 2))])
+    tables.save_table(datasheet, 'Eval_parameter_positiondependency', rows)
@@ -5,6 +5,8 @@ Assessment of the size-dependent impact of beam hardening on CT numbers.
 % SPDX-License-Identifier: MIT
 """
 
+from utils import tables
+
 
 def main(datasheet):
     """
@@ -18,9 +20,8 @@ def main(datasheet):
     name = datasheet['PhantomInserts']['Insert name']
     diff = ctn_head - ctn_body
 
-    # Write the results to a file:
-    with open('{}/for_report/{}.txt'.format(datasheet['output'] ,'Eval_box_1_beamhardening'), 'w') as f:
-        f.write('Insert name    CT number head    CT number body    Difference\n')
-        for line in range(0, len(ctn_head)):
-            f.write(f'{name[line]}    ' + f'{round(ctn_head[line])}    ' +
-                    f'{round(ctn_body[line])}    ' + f'{round(diff[line])} \n')
\ No newline at end of file
+    # Table of the results, for the report and the text file:
+    rows = [['Insert name', 'CT number head', 'CT number body', 'Difference']]
+    for line in range(0, len(ctn_head)):
+        rows.append([name[line], round(ctn_head[line]), round(ctn_body[line]), round(diff[line])])
+    tables.save_table(datasheet, 'Eval_box_1_beamhardening', rows)
@@ -6,7 +6,8 @@ Comparison of measured and calculated SPR for phantom inserts.
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
+
+from utils import figures, tables
 
 
 def main(datasheet):
@@ -28,18 +29,23 @@ def main(datasheet):
         # Calculate the difference between the measured and calculated SPR:
         diff = spr_meas - spr_calc
         name = datasheet['PhantomInserts']['Insert name']
-        with open('{}/for_report/{}.txt'.format(datasheet['output'], filename), 'w') as f:
-            f.write('Insert name    SPR measured    SPR calculated    Difference    Difference (%)\n')
-            for line in range(0, len(spr_meas)):
-                f.write(f'{name[line]}    ' + f'{np.round(spr_meas[line], spr_digits)}    ' +
-                        f'{np.round(spr_calc[line], spr_digits)}    ' + f'{np.round(diff[line], spr_digits)}    ' +
-                        f'{np.round(diff[line] * 100, 2)} \n')
+        rows = [['Insert name', 'SPR measured', 'SPR calculated', 'Difference', 'Difference (%)']]
+        for line in range(0, len(spr_meas)):
+            rows.append([name[line], np.round(spr_meas[line], spr_digits), np.round(spr_calc[line], spr_digits),
+                         np.round(diff[line], spr_digits), np.round(diff[line] * 100, 2)])
+        tables.save_table(datasheet, filename, rows)
+
+        if not figures.create_figures(datasheet):
+            return
+
+        from matplotlib.figure import Figure
 
         # Plot of SPR difference
-        figx, axx = plt.subplots(figsize=(10, 4))
+        figx = Figure(figsize=(10, 4))
+        axx = figx.subplots()
 
         xpos = np.arange(0, len(diff))
-        plt.bar(xpos, diff * 100, 0.8, label='SPR difference', zorder=1000)
+        axx.bar(xpos, diff * 100, 0.8, label='SPR difference', zorder=1000)
 
         axx.yaxis.grid(which='major', color='gray', linestyle='-', alpha=0.3, zorder=0)  # vertical lines (major)
         axx.axhline(0, color='black', zorder=5000)
@@ -48,12 +54,7 @@ def main(datasheet):
 
         axx.set_ylabel('$SPR_{meas} - SPR_{est}$ (%)')
         axx.set_title('Comparison measured vs calculated SPR')
-        plt.legend()
+        axx.legend()
 
         # Save the figure:
-        plt.savefig("{}/for_report/svg/{}.svg".format(datasheet['output'], filename))
-        plt.savefig('{}/for_report/{}.pdf'.format(datasheet['output'], filename), bbox_inches="tight", dpi=300)
-        
-        plt.clf()
-        plt.cla()
-        plt.close()
\ No newline at end of file
+        figures.save_figure(datasheet, figx, filename)
\ No newline at end of file
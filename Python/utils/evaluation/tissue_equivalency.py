@@ -5,7 +5,7 @@ Assessment of tissue equivalency of phantom materials.
 % SPDX-License-Identifier: MIT
 """
 
-import matplotlib.pyplot as plt
+from utils import figures
 
 
 def main(datasheet):
@@ -14,6 +14,9 @@ def main(datasheet):
     Creating figures to evaluate the tissue equivalency of the phantom inserts.
     """
 
+    if not figures.create_figures(datasheet):
+        return
+
     # Load the data for the tabulated human tissues and phantom inserts:
     density_tissues = datasheet['TabulatedHumanTissues']['Density (g/cm3)']
     rhoe_tissues = datasheet['TabulatedHumanTissues']['rhoe_calc']
@@ -32,7 +35,11 @@ def main(datasheet):
         i = 1
     elif datasheet['output_parameter'] == 'MD':
         i = 2
-    fig, axs = plt.subplots(i, figsize=(6, 6* i))
+
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(6, 6* i))
+    axs = fig.subplots(i)
     alphavalue = 0.2
 
     # Plot of Zeff vs rhoe
@@ -90,10 +97,4 @@ def main(datasheet):
         axs[2].grid(alpha=alphavalue)
 
     # Save the figures:
-    plt.savefig("{}/for_report/svg/Eval_box_2_tissue_equivalence.svg".format(datasheet['output']), bbox_inches="tight")
-    plt.savefig('{}/for_report/Eval_box_2_tissue_equivalence.pdf'.format(datasheet['output']), bbox_inches="tight",
-                dpi=300)
-    
-    plt.clf()
-    plt.cla()
-    plt.close()
\ No newline at end of file
+    figures.save_figure(datasheet, fig, 'Eval_box_2_tissue_equivalence')
\ No newline at end of file
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Output of figures
+
+Figures are created as matplotlib Figure objects without pyplot, so no global
+plotting state is used and several calibrations can run in one process. Each figure
+is rendered once, as PDF file, which is also embedded in the PDF report. The files
+have no creation date, so the same figure always gives the same file content.
+
+% SPDX-License-Identifier: MIT
+"""
+
+from utils import profiling
+
+
+def create_figures(datasheet):
+    """
+    Check if figures are needed, i.e. if they are written to the output folder
+    or passed to a figure sink.
+    Input:  datasheet - Dictionary containing all calculated and measured data
+    Output: True if figures are to be created
+    """
+
+    return datasheet['output'] is not None or datasheet.get('figure_sink') is not None
+
+
+def figure_file(datasheet, name):
+    """
+    PDF file of a figure in the output folder
+    Input:  datasheet - Dictionary containing all calculated and measured data
+            name - file name of the figure without extension
+    Output: path of the .pdf file
+    """
+
+    return '{}/for_report/{}.pdf'.format(datasheet['output'], name)
+
+
+def save_figure(datasheet, fig, name):
+    """
+    Pass a figure to the figure sink and save it as .pdf (also used by the report)
+    Input:  datasheet - Dictionary containing all calculated and measured data
+            fig - matplotlib Figure
+            name - file name of the figure without extension
+    """
+
+    if datasheet.get('figure_sink') is not None:
+        datasheet['figure_sink'](name, fig)
+
+    if datasheet['output'] is not None:
+        file_name = figure_file(datasheet, name)
+        fig.savefig(file_name, bbox_inches="tight", dpi=300, metadata={'CreationDate': None})
+        profiling.record_file(datasheet, file_name)
@@ -5,88 +5,293 @@ HLUT export and plot functions for the HLUT definition
 % SPDX-License-Identifier: MIT
 """
 
-from utils import report, control_input
+from utils import control_input, stage_scheduler, profiling, tables, report_queue, results_store
 
-from utils.calculation import fit_and_estimate_ctnumbers
-from utils.calculation import fit_and_plot_hluts
-from utils.calculation import initialize_data
+import os
+import copy
+import traceback
 
-from utils.evaluation import estimation_ctnumber
-from utils.evaluation import hlut_accuracy
-from utils.evaluation import hlut_assessment
-from utils.evaluation import position_dependency_ctnumber
-from utils.evaluation import size_dependency_ctnumber
-from utils.evaluation import spr_comparison
-from utils.evaluation import tissue_equivalency
+# The calculation and evaluation modules, and with them matplotlib, pandas, reportlab and
+# pdfrw, are imported by the functions that use them, so that the command line interface
+# and the worker processes start without loading the libraries of stages that are not run.
 
-import os
-import matplotlib.pyplot as plt
 
-def main(input_folder_name, file_name, output_parameter, recon_type, output_folder_name, e_prot):
+def main(input_folder_name, file_name, output_parameter, recon_type, output_folder_name, e_prot, workers=1,
+         profile=None, trace_memory=False, analyses=None):
     ##############################################################
     # CODE INITIALIZATION ########################################
     ##############################################################
 
-    #Close figures from last loop:
-    plt.close('all')
-
     print('Start of HLUT generation.')
 
-    # Set working directory to the script location of main.py
-    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-
     # Check if output_parameter is valid
     control_input.check_parameters(output_parameter, recon_type)
 
+    # Relative paths are interpreted relative to the script location of main.py:
+    base_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    input_folder_name = os.path.join(base_folder, input_folder_name)
+    output_folder_name = os.path.join(base_folder, output_folder_name)
+
+    # Timing of the stages, written to trace.json in the folder for the results:
+    trace = profiling.new_trace(trace_memory, profile, file_name=file_name, output_parameter=output_parameter,
+                                recon_type=recon_type, e_prot=e_prot, workers=workers)
+
+    from utils.calculation import initialize_data
+
+    # Load the data from the Excel file and create the folder for the results:
+    with profiling.stage(trace, 'Ingestion'):
+        sheets = initialize_data.read_workbook(os.path.join(input_folder_name, file_name))
+    output = initialize_data.create_output_folder(output_folder_name, output_parameter)
+
+    # The parameters are checked above, so the stages of run() are called directly.
+    # The report is created in the background, while the next calibration can start:
+    calibration = calibrate(sheets, recon_type, e_prot, trace)
+    result = evaluate(calibration, output_parameter, recon_type, output, create_report=True, file_name=file_name,
+                      workers=workers, trace=trace, wait_report=False, analyses=analyses)
+
+    # Record the run in the results store of the Results folder:
+    try:
+        results_store.record_run(os.path.join(output_folder_name, results_store.STORE_NAME), result, file_name,
+                                 initialize_data.file_hash(os.path.join(input_folder_name, file_name)), recon_type,
+                                 e_prot, output)
+    except Exception:
+        traceback.print_exc()
+        print('--- The run could not be recorded in the results store. All result files have been written.')
+
+    print('\n###############################\nFinished (the PDF report may still be in progress).'
+          '\n###############################')
+
+    return result['datasheet']
+
+
+def run(sheets, output_parameter, recon_type, e_prot, output=None, figure_sink=None, create_report=False,
+        file_name='', workers=1, trace=None, export_tables=True, wait_report=True, analyses=None):
+    """
+    Programmatic interface of the HLUT generation and evaluation. It does not
+    change the working directory and does not use the global pyplot state, so
+    several calibrations can run concurrently in one process.
+    Input:  sheets - Dictionary with one DataFrame per sheet of the Excel file
+                     (see initialize_data.read_workbook), the DataFrames are not modified
+            output_parameter - MD, RED or SPR
+            recon_type - Reconstruction type (regular or DD)
+            e_prot - initial energy of the proton beam (MeV)
+            output - existing folder to write the result files to, or None to write no files
+            figure_sink - optional function called as figure_sink(name, fig) for every figure
+            create_report - if True, the PDF report is created (requires output)
+            file_name - name of the Excel file, shown in the PDF report
+            workers - number of worker processes for the HLUT fit and evaluation stages (see evaluation_stages)
+            trace - trace for the timing of the stages (see profiling.new_trace), created if None
+            export_tables - if True, the tables of the evaluation boxes are also written as .txt files to output
+            wait_report - if False, the function returns before the PDF report is finished (see report_queue)
+            analyses - settings of the optional analyses (see control_input.check_analyses), None for none
+    Output: result - Dictionary with the k values, the HLUT connection points, the accuracy metrics,
+                     the tables of the evaluation boxes, the complete datasheet, the trace of the stages
+                     and the report job (Future with the file name of the PDF report, or None)
+    """
+
+    # Check the input parameters before the calibration:
+    control_input.check_parameters(output_parameter, recon_type)
+    control_input.check_analyses(analyses or {})
+
+    if trace is None:
+        trace = profiling.new_trace(file_name=file_name, output_parameter=output_parameter, recon_type=recon_type,
+                                    e_prot=e_prot, workers=workers)
+
+    calibration = calibrate(sheets, recon_type, e_prot, trace)
+
+    return evaluate(calibration, output_parameter, recon_type, output, figure_sink, create_report, file_name,
+                    workers, trace, export_tables, wait_report, analyses)
+
+
+def calibrate(sheets, recon_type, e_prot, trace=None):
+    """
+    Stages that do not depend on the output parameter: initialization of the data,
+    calculation of the reference values and the stoichiometric calibration.
+    The result can be shared by the evaluation of the MD, RED and SPR HLUTs.
+    Input:  sheets - Dictionary with one DataFrame per sheet of the Excel file
+            recon_type - Reconstruction type (regular or DD)
+            e_prot - initial energy of the proton beam (MeV)
+            trace - trace for the timing of the stages (see profiling.new_trace), or None
+    Output: calibration - datasheet with the reference values, k values and estimated CT numbers
+    The parameters are not checked, this is done by the entry points (main, run and batch_processing).
+    """
+
+    from utils.calculation import fit_and_estimate_ctnumbers
+    from utils.calculation import initialize_data
+
     # Initialize the data:
-    datasheet = initialize_data.main(output_folder_name, output_parameter, input_folder_name,
-                                     file_name, e_prot)
+    with profiling.stage(trace, 'Initialization'):
+        calibration = initialize_data.initialize(sheets, None, e_prot)
 
     # Make fits based on the CT numbers for the phantom inserts and estimate CT numbers for tabulated human tissues
-    fit_and_estimate_ctnumbers.main(datasheet, recon_type)
+    with profiling.stage(trace, 'Stoichiometric calibration'):
+        fit_and_estimate_ctnumbers.main(calibration, recon_type)
 
-    # Fit HLUTs, write them to text files and plot the curves
-    fit_and_plot_hluts.main(datasheet, recon_type)
+    return calibration
+
+
+def evaluate(calibration, output_parameter, recon_type, output=None, figure_sink=None, create_report=False,
+             file_name='', workers=1, trace=None, export_tables=True, wait_report=True, analyses=None):
+    """
+    Stages that depend on the output parameter: fit of the HLUTs, evaluation, optional analyses and report.
+    Input:  calibration - result of calibrate(), which is not modified
+            output_parameter, recon_type, output, figure_sink, create_report, file_name, workers - see run()
+            trace - trace for the timing of the stages (see profiling.new_trace), created if None
+            export_tables, wait_report, analyses - see run()
+    Output: result - see run()
+    The parameters are not checked, this is done by the entry points (main, run and batch_processing).
+    """
+
+    if trace is None:
+        trace = profiling.new_trace(file_name=file_name, output_parameter=output_parameter, recon_type=recon_type,
+                                    workers=workers)
+
+    datasheet = copy.deepcopy(calibration)
+    datasheet['output_parameter'] = output_parameter
+    datasheet['output'] = output
+    datasheet['figure_sink'] = figure_sink
+    datasheet['tables'] = {}
 
     ##############################################################
-    # Evaluate HLUTs #############################################
+    # Fit and evaluate HLUTs #####################################
     ##############################################################
 
     print('\nStart evaluation of the created HLUT.')
 
+    # The stages run one after another, or concurrently as far as their dependencies allow:
+    stage_scheduler.run_stages(datasheet, evaluation_stages(output_parameter, recon_type, analyses, workers), workers,
+                               trace)
+
+    ##############################################################
+    # Create report pdf ##########################################
+    ##############################################################
+
+    # The tables are passed to the report in memory, the text files are only an export:
+    if export_tables and output is not None:
+        with profiling.stage(trace, 'Table export', datasheet):
+            tables.write_tables(datasheet)
+
+    profiling.finish_trace(trace, output)
+
+    # The report is created by the background queue from the results in memory and the figure files:
+    report_job = None
+    if create_report and output is not None:
+        report_job = report_queue.submit(file_name, datasheet, recon_type, trace)
+        if wait_report:
+            report_job.result()
+
+    return {'k_values': datasheet['k_values'],
+            'HLUTs': datasheet['HLUTs'],
+            'accuracy': datasheet['accuracy'],
+            'tables': datasheet['tables'],
+            'datasheet': datasheet,
+            'trace': trace,
+            'report': report_job}
+
+
+def evaluation_stages(output_parameter, recon_type, analyses=None, workers=1):
+    """
+    Stages from the HLUT fit to the end-to-end tests and the optional analyses, with the items of
+    the datasheet they read and write (see stage_scheduler). Only the evaluation box 5 and the
+    end-to-end tests need the HLUTs, the evaluation boxes 1 to 4 can run during the HLUT fit.
+    Input:  output_parameter - MD, RED or SPR
+            recon_type - Reconstruction type (regular or DD)
+            analyses - settings of the optional analyses (see control_input.check_analyses), None for none
+            workers - number of processes for the realizations of the HLUT uncertainty and the
+                      folds of the cross-validation
+    Output: stages - Dictionary of the stages, in the order of the sequential execution
+    """
+
+    from utils.calculation import fit_and_plot_hluts
+    from utils.calculation import volume_conversion
+    from utils.evaluation import estimation_ctnumber
+    from utils.evaluation import hlut_accuracy
+    from utils.evaluation import hlut_assessment
+    from utils.evaluation import hlut_crossvalidation
+    from utils.evaluation import hlut_uncertainty
+    from utils.evaluation import hlut_volume_differences
+    from utils.evaluation import position_dependency_ctnumber
+    from utils.evaluation import size_dependency_ctnumber
+    from utils.evaluation import spr_comparison
+    from utils.evaluation import tissue_equivalency
+
+    sheets = ['PhantomInserts', 'TabulatedHumanTissues', 'CTnumbers']
+    stages = {}
+
+    # Fit HLUTs, write them to text files and plot the curves
+    stages['HLUT fit'] = {'function': fit_and_plot_hluts.main, 'args': (recon_type,),
+                          'reads': sheets + ['Data_water', 'constants'], 'writes': ['HLUTs', 'hlut_tables']}
+
     # Evaluation box 1: CT number dependence on phantom size
-    size_dependency_ctnumber.main(datasheet)
+    stages['Box 1'] = {'function': size_dependency_ctnumber.main, 'args': (),
+                       'reads': ['PhantomInserts', 'CTnumbers'], 'writes': [('tables', 'Eval_box_1_beamhardening')]}
 
     # Evaluation box 2: Tissue equivalency of phantom inserts
-    tissue_equivalency.main(datasheet)
+    stages['Box 2'] = {'function': tissue_equivalency.main, 'args': (),
+                       'reads': ['PhantomInserts', 'TabulatedHumanTissues'], 'writes': []}
 
     # Evaluation box 3: Check of CT number estimation method
-    estimation_ctnumber.main(datasheet)
+    stages['Box 3'] = {'function': estimation_ctnumber.main, 'args': (),
+                       'reads': ['PhantomInserts', 'CTnumbers'],
+                       'writes': [('tables', 'Eval_box_3_ctnumber_estimation_' + i) for i in ['head', 'body']]}
 
     # Evaluation box 4: Comparison of measured and theoretical SPR values
-    if datasheet['output_parameter'] == 'SPR':
-        spr_comparison.main(datasheet)
+    if output_parameter == 'SPR':
+        stages['Box 4'] = {'function': spr_comparison.main, 'args': (),
+                           'reads': ['PhantomInserts'], 'writes': [('tables', 'Eval_box_4_spr_estimation')]}
 
     # Evaluation box 5: Check the need for body-site specific HLUTs
-    hlut_assessment.main(datasheet, recon_type)
+    stages['Box 5'] = {'function': hlut_assessment.main, 'args': (recon_type,),
+                       'reads': sheets + ['HLUTs', 'hlut_tables'], 'writes': []}
 
     # End-to-end testing: Evaluation of HLUT accuracy
-    hlut_accuracy.main(datasheet)
+    columns = [variant + '_fromHLUT' for variant in hlut_accuracy.VARIANTS]
+    stages['HLUT accuracy'] = {'function': hlut_accuracy.main, 'args': (),
+                               'reads': sheets + ['HLUTs', 'hlut_tables'],
+                               'writes': [('PhantomInserts', i) for i in columns]
+                               + [('TabulatedHumanTissues', i) for i in columns] + ['accuracy']
+                               + [('tables', 'Eval_box_6_accuracy_' + i) for i in ['head', 'body']]}
 
     # End-to-end testing: Evaluation of position dependency of CT numbers
-    position_dependency_ctnumber.main(datasheet)
+    stages['Position dependency'] = {'function': position_dependency_ctnumber.main, 'args': (),
+                                     'reads': ['PhantomInserts', 'CTnumbers', 'HLUTs', 'hlut_tables'],
+                                     'writes': [('CTnumbers', 'CT number (middle - outer)'),
+                                                ('tables', 'Eval_ctn_positiondependency'),
+                                                ('tables', 'Eval_parameter_positiondependency')]}
 
-    ##############################################################
-    # Create report pdf ##########################################
-    ##############################################################
+    # Optional analyses:
+    analyses = analyses or {}
 
-    try:
-        report.rep_main(file_name, datasheet, recon_type)
-    except:
-        print('Something went wrong in the PDF report creation. \n'
-              'Everything else worked. Individual results are stored as figures '
-              'or .txt files in the Results folder.')
-
-    print('\n###############################\nFinished.\n###############################')
-    
-    return datasheet
+    # Energy family of SPR HLUTs
+    if output_parameter == 'SPR' and analyses.get('energies'):
+        stages['HLUT family'] = {'function': fit_and_plot_hluts.family_main, 'args': (analyses['energies'],),
+                                 'reads': sheets + ['Data_water', 'constants', 'basis'], 'writes': ['hlut_family']}
+
+    # Uncertainty of the HLUTs and their accuracy, from the noise of the CT numbers
+    if analyses.get('ctn_sd') is not None:
+        stages['HLUT uncertainty'] = {'function': hlut_uncertainty.main,
+                                      'args': (recon_type, analyses['ctn_sd'], analyses.get('n_samples', 1000),
+                                               analyses.get('seed'), workers),
+                                      'reads': sheets + ['Data_water', 'constants', 'basis'], 'writes': ['uncertainty']}
+
+    # Leave-one-out cross-validation of the HLUT accuracy
+    if analyses.get('crossvalidation') is not None:
+        stages['Cross-validation'] = {'function': hlut_crossvalidation.main,
+                                      'args': (recon_type, analyses['crossvalidation'], workers),
+                                      'reads': sheets + ['Data_water', 'constants', 'basis'],
+                                      'writes': ['crossvalidation']}
+
+    # Conversion of CT volumes with the HLUT, written to the output folder
+    if analyses.get('convert_volumes'):
+        stages['Volume conversion'] = {'function': volume_conversion.export_volumes,
+                                       'args': (analyses.get('volume_hlut', 'body'), analyses['convert_volumes']),
+                                       'reads': ['HLUTs', 'hlut_tables'], 'writes': []}
+
+    # Differences between the HLUTs, weighted with the CT numbers of patient volumes
+    if analyses.get('difference_volumes'):
+        stages['Volume differences'] = {'function': hlut_volume_differences.main,
+                                        'args': (analyses['difference_volumes'], ('head', 'body', 'avgdCT'),
+                                                 analyses.get('difference_ctn_range')),
+                                        'reads': ['HLUTs', 'hlut_tables'], 'writes': ['volume_differences']}
+
+    return stages
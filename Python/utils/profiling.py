@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and profiling of the stages of a calibration run
+
+The trace of a run holds one record per stage with the wall and CPU time, the peak resident
+memory of the process so far and the number of files and figures written by the stage. The
+files are recorded by the functions writing them (see record_file), so that stages running
+concurrently in the same output folder are counted separately. The trace is written as JSON to the output folder
+(trace.json) and aggregated over the jobs in batch mode. Optionally, single stages are
+profiled with cProfile or pyinstrument. Memory tracing and the profilers are global to the
+process, so they are only used for stages in the main thread: stages in other threads (the
+background reports, see report_queue) are only timed, with the CPU time of their thread.
+
+% SPDX-License-Identifier: MIT
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Profilers for single stages:
+PROFILERS = ['cProfile', 'pyinstrument']
+
+
+def new_trace(memory=False, profile=None, **info):
+    """
+    Create the trace of a run
+    Input:  memory - if True, the peak memory allocated in each stage is traced with tracemalloc
+                     (this slows down the run considerably)
+            profile - stages to be profiled: stage name or list of stage names (cProfile), or
+                      Dictionary {stage name: profiler}, e.g. {'Report': 'pyinstrument'}
+            info - description of the run, e.g. file name and output parameter
+    Output: trace - Dictionary with the description, the options and the records of the stages
+    """
+
+    if profile is None:
+        profile = {}
+    elif isinstance(profile, str):
+        profile = {profile: 'cProfile'}
+    elif not isinstance(profile, dict):
+        profile = {name: 'cProfile' for name in profile}
+    for profiler in profile.values():
+        if profiler not in PROFILERS:
+            raise ValueError("Invalid profiler '{}'. It should be one of {}.".format(profiler, PROFILERS))
+
+    return {'info': info, 'memory': memory, 'profile': profile, 'started': time.time(), 'stages': []}
+
+
+@contextlib.contextmanager
+def stage(trace, name, datasheet=None, output=None):
+    """
+    Measure a stage and add its record to the trace
+    Input:  trace - trace of the run (see new_trace), or None to measure nothing
+            name - name of the stage
+            datasheet - datasheet used by the stage, to count the figures (saved or passed to the figure sink)
+                        and the files written (see record_file)
+            output - folder for the files of the profilers, default: output folder of the datasheet
+    """
+
+    if trace is None:
+        yield
+        return
+
+    # Imported here, as the figures module records its files with this module:
+    from utils import figures
+
+    if output is None and datasheet is not None:
+        output = datasheet.get('output')
+
+    # Collect the files written by the stage:
+    written = set()
+    if datasheet is not None:
+        datasheet['written_files'] = written
+
+    # Count the figures with a wrapper of the figure sink:
+    counted = []
+    count_figures = datasheet is not None and figures.create_figures(datasheet)
+    if count_figures:
+        figure_sink = datasheet.get('figure_sink')
+
+        def counting_sink(figure_name, fig):
+            counted.append(figure_name)
+            if figure_sink is not None:
+                figure_sink(figure_name, fig)
+
+        datasheet['figure_sink'] = counting_sink
+
+    # Stages in other threads must not change the memory tracing and profiling of the main thread:
+    background = threading.current_thread() is not threading.main_thread()
+    trace_memory = trace['memory'] and not background
+    cpu_time = time.thread_time if background else time.process_time
+
+    if trace_memory:
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    profiler = None if background else start_profiler(trace['profile'].get(name))
+    start, wall, cpu = time.time(), time.perf_counter(), cpu_time()
+
+    try:
+        yield
+    finally:
+        record = {'stage': name, 'process': os.getpid(), 'start': start - trace['started'],
+                  'wall': time.perf_counter() - wall, 'cpu': cpu_time() - cpu, 'process_max_rss_mb': max_rss()}
+        if background:
+            record['thread'] = threading.current_thread().name
+        if profiler is not None:
+            record['profile'] = stop_profiler(profiler, trace['profile'][name], name, output)
+        if trace_memory:
+            record['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+            if started_tracing:
+                tracemalloc.stop()
+        record['files'] = len(written)
+        record['figures'] = len(counted)
+        if count_figures:
+            datasheet['figure_sink'] = figure_sink
+        if datasheet is not None:
+            del datasheet['written_files']
+        trace['stages'].append(record)
+
+
+def record_file(datasheet, file_name):
+    """
+    Add a file to the files written by the running stage (nothing is done outside a stage)
+    Input:  datasheet - Dictionary containing all calculated and measured data
+            file_name - path of the written file
+    """
+
+    written = datasheet.get('written_files')
+    if written is not None:
+        written.add(file_name)
+
+
+def max_rss():
+    """
+    Peak resident memory of the process so far (MB), None if not available. This includes the
+    earlier stages and, in batch mode, the earlier jobs of the worker process.
+    """
+
+    if resource is None:
+        return None
+    # ru_maxrss is given in bytes on macOS and in kB on Linux:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1e6 if sys.platform == 'darwin' else 1e3)
+
+
+def start_profiler(profiler):
+    """
+    Start a profiler
+    Input:  profiler - 'cProfile', 'pyinstrument' or None
+    Output: the running profiler, or None
+    """
+
+    if profiler is None:
+        return None
+    if profiler == 'cProfile':
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        raise ImportError('Profiling with pyinstrument requires pyinstrument (pip install pyinstrument).')
+    profile = Profiler()
+    profile.start()
+    return profile
+
+
+def stop_profiler(profile, profiler, name, output):
+    """
+    Stop a profiler and write its result to the output folder (cProfile: .prof file for pstats or
+    snakeviz, pyinstrument: .html file), or print it if there is no output folder
+    Input:  profile - running profiler from start_profiler
+            profiler - 'cProfile' or 'pyinstrument'
+            name - name of the stage
+            output - output folder or None
+    Output: file name of the profile, or None if it was printed
+    """
+
+    file_name = None
+    if output is not None:
+        file_name = os.path.join(output, 'profile_{}.{}'.format(name.replace(' ', '_'),
+                                                                'prof' if profiler == 'cProfile' else 'html'))
+
+    if profiler == 'cProfile':
+        profile.disable()
+        if file_name is None:
+            import pstats
+            print('\nProfile of the stage {}:'.format(name))
+            pstats.Stats(profile, stream=sys.stdout).sort_stats('cumulative').print_stats(20)
+        else:
+            profile.dump_stats(file_name)
+    else:
+        profile.stop()
+        if file_name is None:
+            print('\nProfile of the stage {}:\n{}'.format(name, profile.output_text()))
+        else:
+            with open(file_name, 'w') as f:
+                f.write(profile.output_html())
+
+    return file_name
+
+
+def finish_trace(trace, output=None):
+    """
+    Complete the trace with the total wall time and write it to the output folder (trace.json)
+    Input:  trace - trace of the run
+            output - output folder or None
+    """
+
+    trace['wall'] = time.time() - trace['started']
+    if output is not None:
+        write_json(trace, os.path.join(output, 'trace.json'))
+
+
+def aggregate(traces):
+    """
+    Statistics of the stages over several traces, e.g. of a batch run
+    Input:  traces - list of traces
+    Output: Dictionary per stage with the number of records, the total, mean and maximum wall
+            and CPU time (s), the maximum of the memory values (MB) and the total number of
+            files and figures written
+    """
+
+    records = {}
+    for trace in traces:
+        for record in trace['stages']:
+            records.setdefault(record['stage'], []).append(record)
+
+    statistics = {}
+    for name, values in records.items():
+        statistics[name] = {'count': len(values)}
+        for key in ['wall', 'cpu']:
+            times = [i[key] for i in values]
+            statistics[name].update({key + '_total': sum(times), key + '_mean': sum(times) / len(times),
+                                     key + '_max': max(times)})
+        for key in ['process_max_rss_mb', 'peak_memory_mb']:
+            memory = [i[key] for i in values if i.get(key) is not None]
+            if len(memory) > 0:
+                statistics[name][key] = max(memory)
+        for key in ['files', 'figures']:
+            statistics[name][key] = sum(i[key] for i in values)
+
+    return statistics
+
+
+def write_json(data, file_name):
+    """
+    Write a trace or aggregated statistics as JSON file
+    Input:  data - Dictionary
+            file_name - name of the JSON file
+    """
+
+    with open(file_name, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
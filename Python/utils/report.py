@@ -7,21 +7,41 @@ PDF creation
 
 from datetime import datetime
 from textwrap import wrap
+import hashlib
 import numpy as np
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase import pdfmetrics
 from reportlab.platypus import Table, TableStyle
-from svglib.svglib import svg2rlg
-from reportlab.graphics import renderPDF
-
-
-def scale(drawing, scaling_factor):
-    drawing.width *= scaling_factor
-    drawing.height *= scaling_factor
-    drawing.scale(scaling_factor, scaling_factor)
-    return drawing
+from pdfrw import PdfReader
+from pdfrw.buildxobj import pagexobj
+from pdfrw.toreportlab import makerl
+
+from utils import figures
+from utils.calculation import fit_and_plot_hluts
+
+# Figures converted to PDF form objects, keyed by the SHA-256 hash of the figure file, so
+# that a figure shown several times, or again in a later report, is only converted once:
+FIGURE_CACHE = {}
+FIGURE_CACHE_SIZE = 64
+
+
+def load_figure(image_path):
+    """
+    Figure as PDF form object, which is embedded as vector graphics without conversion of its content
+    Input:  image_path - PDF file of the figure (see figures.save_figure)
+    Output: form object of the first page
+    """
+
+    with open(image_path, 'rb') as f:
+        content = f.read()
+    key = hashlib.sha256(content).hexdigest()
+    if key not in FIGURE_CACHE:
+        if len(FIGURE_CACHE) >= FIGURE_CACHE_SIZE:
+            FIGURE_CACHE.pop(next(iter(FIGURE_CACHE)))
+        FIGURE_CACHE[key] = pagexobj(PdfReader(fdata=content).pages[0])
+    return FIGURE_CACHE[key]
 
 def add_text(pdf, text, x, y, font, font_size, max_width):
     pdf.setFont(font, font_size)
@@ -46,18 +66,24 @@ def add_table(pdf, data, x, y, available_height, max_width):
     return y - required_height - 20  # Adjust for spacing
 
 def add_image(pdf, image_path, y, scale_factor, max_height):
-    drawing = svg2rlg(image_path)
-    drawing = scale(drawing, scale_factor)
-    image_height = drawing.height
+    form = load_figure(image_path)
+    width = float(form.BBox[2]) - float(form.BBox[0])
+    height = float(form.BBox[3]) - float(form.BBox[1])
+    image_height = height * scale_factor
     if y - image_height < 50:  # Check if it fits with bottom margin
         pdf.showPage()
         y = A4[1] - 50  # Reset to top of new page with margin
     # Dynamically compute x-coordinate for center alignment
-    x_center = (A4[0] - drawing.width) / 2  # A4[0] is the page width
-    renderPDF.draw(drawing, pdf, x_center, y - image_height)
+    x_center = (A4[0] - width * scale_factor) / 2  # A4[0] is the page width
+    pdf.saveState()
+    pdf.translate(x_center, y - image_height)
+    pdf.scale(scale_factor, scale_factor)
+    pdf.doForm(makerl(pdf, form))
+    pdf.restoreState()
     return y - image_height - 20  # Adjust for spacing
 
-def pagedesign(title, pagenumber,datasheet):
+def pagedesign(pdf, title, pagenumber,datasheet):
+    w, h = A4
     toplineh = h-40
     bottomlineh = 50
     linel = 0.1*w
@@ -78,7 +104,6 @@ def pagedesign(title, pagenumber,datasheet):
     return linel, tp
 
 def rep_main(file_name, datasheet, recon_type):
-    global h, w, pdf
     print('\nInitiate creation of PDF report.')
 
     ts1 = 11
@@ -88,13 +113,11 @@ def rep_main(file_name, datasheet, recon_type):
 
     # Initialize pdf
     if recon_type == 'regular':
-        pdf = canvas.Canvas('{}/{}_HLUT_evaluation_{}.pdf'.format(datasheet['output'],
-                                                                  datasheet['output_parameter'], today),
-                            pagesize=A4)
+        report_file = '{}/{}_HLUT_evaluation_{}.pdf'.format(datasheet['output'], datasheet['output_parameter'], today)
     elif recon_type == 'DD':
-        pdf = canvas.Canvas('{}/DD_{}_HLUT_evaluation_{}.pdf'.format(datasheet['output'],
-                                                                     datasheet['output_parameter'], today),
-                            pagesize=A4)
+        report_file = '{}/DD_{}_HLUT_evaluation_{}.pdf'.format(datasheet['output'], datasheet['output_parameter'],
+                                                               today)
+    pdf = canvas.Canvas(report_file, pagesize=A4)
     w, h = A4
     pdf.setTitle("HLUT evaluation")
 
@@ -129,7 +152,7 @@ def rep_main(file_name, datasheet, recon_type):
     
     # Print image (exemplary HLUT)
     y_position -= 10
-    image_path = "{}/for_report/svg/hlut_head.svg".format(datasheet['output'])
+    image_path = figures.figure_file(datasheet, 'hlut_head')
     y_position = add_image(pdf, image_path, y_position, 0.65, y_position - margin)
 
     pdf.setFont('abc', 14)  #Decrease the font size
@@ -152,7 +175,7 @@ def rep_main(file_name, datasheet, recon_type):
 
     # PAGE 2
     page = 1
-    linel, y_position = pagedesign('Generated HLUTs', page,datasheet)
+    linel, y_position = pagedesign(pdf, 'Generated HLUTs', page,datasheet)
     
     y_position -= 10   
     text = 'To be visually evaluated regarding the proximity of the datapoints to the curve and the need for a' +\
@@ -162,9 +185,7 @@ def rep_main(file_name, datasheet, recon_type):
     #Insert table with the HLUT for head:
     y_position = add_text(pdf, 'HLUT for head phantom', margin, y_position - 50, 'abc_b', ts2, char_per_line)
     y_position -= 10 
-    hlut_head = np.genfromtxt('{}/{}_HLUT_head.txt'.format(datasheet['output'], 
-                                                           datasheet['output_parameter']), dtype=str, delimiter='\t')
-    hlut_head_list = hlut_head.tolist()
+    hlut_head_list = fit_and_plot_hluts.hlut_rows(datasheet, 'head', recon_type)
     y_position = add_table(pdf, hlut_head_list, margin, y_position, y_position - margin, w - 2 * margin)
 
     text = 'Please note: The highest point is set arbitrarily to ' + hlut_head_list[-1][0] + \
@@ -172,7 +193,7 @@ def rep_main(file_name, datasheet, recon_type):
     y_position = add_text(pdf, text, margin, y_position - 7, 'abc', ts1, char_per_line)
 
     #Add figure of the HLUT:
-    image_path = "{}/for_report/svg/hlut_head.svg".format(datasheet['output'])
+    image_path = figures.figure_file(datasheet, 'hlut_head')
     y_position = add_image(pdf, image_path, y_position-10, 0.65, y_position - margin)
 
     pdf.showPage()
@@ -181,15 +202,13 @@ def rep_main(file_name, datasheet, recon_type):
     # PAGE 3
     #Add page header and page number:
     page += 1
-    linel, y_position = pagedesign(' ', page,datasheet) 
+    linel, y_position = pagedesign(pdf, ' ', page,datasheet) 
     
     #HLUT for body:
     y_position -= 10
     y_position = add_text(pdf, 'HLUT for body phantom', margin, y_position, 'abc_b', ts2, char_per_line)
     
-    hlut_body = np.genfromtxt('{}/{}_HLUT_body.txt'.format(datasheet['output'], 
-                                                           datasheet['output_parameter']), dtype=str, delimiter='\t')
-    hlut_body_list = hlut_body.tolist()
+    hlut_body_list = fit_and_plot_hluts.hlut_rows(datasheet, 'body', recon_type)
     y_position = add_table(pdf, hlut_body_list, margin, y_position, y_position - margin, w - 2 * margin)
 
     text = 'Please note: The highest point is set arbitrarily to ' + hlut_body_list[-1][0] + \
@@ -197,7 +216,7 @@ def rep_main(file_name, datasheet, recon_type):
     y_position = add_text(pdf, text, margin, y_position - 7, 'abc', ts1, char_per_line)
 
     #Add figure of the HLUT:
-    image_path = "{}/for_report/svg/hlut_body.svg".format(datasheet['output'])
+    image_path = figures.figure_file(datasheet, 'hlut_body')
     y_position = add_image(pdf, image_path, y_position-10, 0.65, y_position - margin)
 
     pdf.showPage()
@@ -206,16 +225,14 @@ def rep_main(file_name, datasheet, recon_type):
     # PAGE 4
     #Add page header and page number:
     page += 1
-    linel, y_position = pagedesign(' ', page,datasheet) 
+    linel, y_position = pagedesign(pdf, ' ', page,datasheet) 
     
     #HLUT for averaged CT numbers:
     y_position -= 10
     y_position = add_text(pdf, 'HLUT for averaged CT numbers', margin, y_position, 'abc_b', ts2,
                           char_per_line)
 
-    hlut_avg = np.genfromtxt('{}/{}_HLUT_avgdCT.txt'.format(datasheet['output'], 
-                                                            datasheet['output_parameter']), dtype=str, delimiter='\t')
-    hlut_avg_list = hlut_avg.tolist()
+    hlut_avg_list = fit_and_plot_hluts.hlut_rows(datasheet, 'avgdCT', recon_type)
     y_position = add_table(pdf, hlut_avg_list, margin, y_position, y_position - margin, w - 2 * margin)
 
     text = 'Please note: The highest point is set arbitrarily to ' + hlut_avg_list[-1][0] + \
@@ -223,7 +240,7 @@ def rep_main(file_name, datasheet, recon_type):
     y_position = add_text(pdf, text, margin, y_position - 7, 'abc', ts1, char_per_line)
 
     #Add figure of the HLUT:
-    image_path = "{}/for_report/svg/hlut_avgdCT.svg".format(datasheet['output'])
+    image_path = figures.figure_file(datasheet, 'hlut_avgdCT')
     y_position = add_image(pdf, image_path, y_position-10, 0.65, y_position - margin)
 
     pdf.showPage()
@@ -231,16 +248,14 @@ def rep_main(file_name, datasheet, recon_type):
 
     # PAGE 5
     page += 1
-    linel, y_position = pagedesign('HLUT evaluation results', page,datasheet)
+    linel, y_position = pagedesign(pdf, 'HLUT evaluation results', page,datasheet)
     
     y_position -= 50
     y_position = add_text(pdf, 'Evaluation box 1: Size-dependent impact of beam hardening',
                           margin, y_position, 'abc_b', ts2, 50)
     
     #Add table:
-    eval_1 = np.genfromtxt('{}/for_report/Eval_box_1_beamhardening.txt'.format(datasheet['output']), dtype=str,
-                           delimiter='    ')
-    eval_1_list = eval_1.tolist()
+    eval_1_list = datasheet['tables']['Eval_box_1_beamhardening']
     y_position = add_table(pdf, eval_1_list, margin, y_position, y_position - margin, w - 2 * margin)
 
     pdf.showPage()
@@ -249,7 +264,7 @@ def rep_main(file_name, datasheet, recon_type):
     # PAGE 6
     #Add page header and page number:
     page += 1
-    linel, y_position = pagedesign(' ', page,datasheet) 
+    linel, y_position = pagedesign(pdf, ' ', page,datasheet) 
     
     
     y_position = add_text(pdf, 'Evaluation box 2: Tissue equivalency of phantom inserts', margin,
@@ -262,7 +277,7 @@ def rep_main(file_name, datasheet, recon_type):
     y_position = add_text(pdf, tissue_text.get(datasheet['output_parameter'], ''), margin, y_position - 25,
                           'abc', ts1, char_per_line)
 
-    image_path = "{}/for_report/svg/Eval_box_2_tissue_equivalence.svg".format(datasheet['output'])
+    image_path = figures.figure_file(datasheet, 'Eval_box_2_tissue_equivalence')
     y_position = add_image(pdf, image_path, y_position, 0.45, y_position - margin)
 
     pdf.showPage()
@@ -270,25 +285,21 @@ def rep_main(file_name, datasheet, recon_type):
 
     # PAGE 7
     page += 1
-    linel, y_position = pagedesign(' ', page,datasheet) 
+    linel, y_position = pagedesign(pdf, ' ', page,datasheet) 
     
     y_position = add_text(pdf, 'Evaluation box 3: Check of estimated CT numbers', margin, y_position+3,
                           'abc_b', ts2, 50)
 
     #Add tables:
     y_position = add_text(pdf, 'Head phantom', margin, y_position-10, 'abc_b', ts1, char_per_line)
-    eval_3 = np.genfromtxt('{}/for_report/Eval_box_3_CTnumber_estimation_head.txt'.format(datasheet['output']),
-                           dtype=str, delimiter='    ')
-    eval_3_list = eval_3.tolist()
+    eval_3_list = datasheet['tables']['Eval_box_3_ctnumber_estimation_head']
     y_position = add_table(pdf, eval_3_list, margin, y_position, y_position - margin, w - 2 * margin)
     
     y_position = add_text(pdf, 'Body phantom', margin, y_position+3, 'abc_b', ts1, char_per_line)
-    eval_3_body = np.genfromtxt('{}/for_report/Eval_box_3_CTnumber_estimation_body.txt'.format(datasheet['output']),
-                                dtype=str, delimiter='    ')
-    eval_3_body_list = eval_3_body.tolist()
+    eval_3_body_list = datasheet['tables']['Eval_box_3_ctnumber_estimation_body']
     y_position = add_table(pdf, eval_3_body_list, margin, y_position+3, y_position - margin, w - 2 * margin)
 
-    image_path = "{}/for_report/svg/Eval_box_3_ctnumber_estimation.svg".format(datasheet['output'])
+    image_path = figures.figure_file(datasheet, 'Eval_box_3_ctnumber_estimation')
     y_position = add_image(pdf, image_path, y_position, 0.55, y_position - margin)
 
     pdf.showPage()
@@ -297,25 +308,23 @@ def rep_main(file_name, datasheet, recon_type):
     # PAGE 8
     if datasheet['output_parameter'] == 'SPR' and not(np.isnan(datasheet['PhantomInserts']['SPR Measured'][0])):
         page += 1
-        linel, y_position = pagedesign(' ', page,datasheet)
+        linel, y_position = pagedesign(pdf, ' ', page,datasheet)
         
         y_position = add_text(pdf, 'Evaluation box 4: Consistency of SPR values', margin, y_position+3,
                               'abc_b', ts2, 50)
         
         #Add table:
-        eval_spr = np.genfromtxt('{}/for_report/Eval_box_4_spr_estimation.txt'.format(datasheet['output']),
-                                 dtype=str, delimiter='    ')
-        eval_spr_list = eval_spr.tolist()
+        eval_spr_list = datasheet['tables']['Eval_box_4_spr_estimation']
         y_position = add_table(pdf, eval_spr_list, margin, y_position, y_position - margin, w - 2 * margin)
         #Add figure:
-        image_path = "{}/for_report/svg/Eval_box_4_spr_estimation.svg".format(datasheet['output'])
+        image_path = figures.figure_file(datasheet, 'Eval_box_4_spr_estimation')
         y_position = add_image(pdf, image_path, y_position, 0.6, y_position - margin)
 
         pdf.showPage()
     
     elif datasheet['output_parameter'] == 'SPR' and np.isnan(datasheet['PhantomInserts']['SPR Measured'][0]):
         page += 1
-        linel, y_position = pagedesign(' ', page,datasheet)
+        linel, y_position = pagedesign(pdf, ' ', page,datasheet)
         
         y_position = add_text(pdf, 'Evaluation box 4: No measured SPR values have been provided. ' +\
                               'This evaluation is therefore skipped.',
@@ -323,7 +332,7 @@ def rep_main(file_name, datasheet, recon_type):
         pdf.showPage()
     else:
         page += 1
-        linel, y_position = pagedesign(' ', page,datasheet)
+        linel, y_position = pagedesign(pdf, ' ', page,datasheet)
         
         y_position = add_text(pdf, 'Evaluation box 4: This evaluation is only relevant for SPR HLUTs. ' +\
                               'This evaluation is therefore skipped.',
@@ -333,11 +342,11 @@ def rep_main(file_name, datasheet, recon_type):
 
     # PAGE 9
     page += 1
-    linel, y_position = pagedesign(' ', page,datasheet)
+    linel, y_position = pagedesign(pdf, ' ', page,datasheet)
     
     y_position = add_text(pdf, 'Evaluation box 5: HLUT comparison', margin, y_position+3, 'abc_b',
                           ts2, 50)
-    image_path = "{}/for_report/svg/Eval_box_5_hlut_comp.svg".format(datasheet['output'])
+    image_path = figures.figure_file(datasheet, 'Eval_box_5_hlut_comp')
     y_position = add_image(pdf, image_path, y_position, 0.6, y_position - margin)
 
     pdf.showPage()
@@ -345,7 +354,7 @@ def rep_main(file_name, datasheet, recon_type):
 
     # PAGE 10
     page += 1
-    linel, y_position = pagedesign(' ', page,datasheet)
+    linel, y_position = pagedesign(pdf, ' ', page,datasheet)
     
     y_position = add_text(pdf, 'End-to-end testing: Evaluation of the generated HLUT', margin, y_position+3,
                           'abc_b', ts2, char_per_line)
@@ -356,7 +365,7 @@ def rep_main(file_name, datasheet, recon_type):
     y_position = add_text(pdf, str_i, margin, y_position-3, 'abc', ts1, char_per_line)
   
     # Print image (HLUT comparison)
-    image_path = "{}/for_report/svg/Eval_endtoend_hlut_accuracy.svg".format(datasheet['output'])
+    image_path = figures.figure_file(datasheet, 'Eval_endtoend_hlut_accuracy')
     y_position = add_image(pdf, image_path, y_position, 0.6, y_position - margin)
     
     #Tables:
@@ -364,14 +373,10 @@ def rep_main(file_name, datasheet, recon_type):
                           ' respective HLUT (fit vs individual datapoints):',
                           margin, y_position+3, 'abc', ts1, char_per_line)
     y_position = add_text(pdf, 'Head phantom:', margin, y_position-3, 'abc_b', ts1, char_per_line)
-    accuracy_head = np.genfromtxt('{}/for_report/eval_box_6_accuracy_head.txt'.format(datasheet['output']),
-                                  dtype=str, delimiter='    ')
-    accuracy_head_list = accuracy_head.tolist()
+    accuracy_head_list = datasheet['tables']['Eval_box_6_accuracy_head']
     y_position = add_table(pdf, accuracy_head_list, margin, y_position, y_position - margin, w - 2 * margin)
     y_position = add_text(pdf, 'Body phantom:', margin, y_position+3, 'abc_b', ts1, char_per_line)
-    accuracy_body = np.genfromtxt('{}/for_report/eval_box_6_accuracy_body.txt'.format(datasheet['output']),
-                                  dtype=str, delimiter='    ')
-    accuracy_body_list = accuracy_body.tolist()
+    accuracy_body_list = datasheet['tables']['Eval_box_6_accuracy_body']
     y_position = add_table(pdf, accuracy_body_list, margin, y_position, y_position - margin, w - 2 * margin)
 
     
@@ -381,21 +386,17 @@ def rep_main(file_name, datasheet, recon_type):
 
     # PAGE 11
     page += 1
-    linel, y_position = pagedesign(' ', page,datasheet)
+    linel, y_position = pagedesign(pdf, ' ', page,datasheet)
     
     y_position = add_text(pdf, 'CT number location dependency', margin, y_position+3, 'abc_b', ts2,
                           char_per_line)
 
     #Table with CT number difference between bone inserts in the center and periphery of large phantom:
-    ct_dependency = np.genfromtxt('{}/for_report/Eval_CTN_positiondependency.txt'.format(datasheet['output']),
-                                  dtype=str, delimiter='    ')
-    ct_dependency_list = ct_dependency.tolist()
+    ct_dependency_list = datasheet['tables']['Eval_ctn_positiondependency']
     y_position = add_table(pdf, ct_dependency_list, margin, y_position, y_position - margin, w - 2 * margin)
 
     #Parameter estimates for bone inserts in the center and periphery of large phantom:
-    ct_dependency = np.genfromtxt('{}/for_report/Eval_parameter_positiondependency.txt'.format(datasheet['output']),
-                                  dtype=str, delimiter='    ')
-    ct_dependency_list = ct_dependency.tolist()
+    ct_dependency_list = datasheet['tables']['Eval_parameter_positiondependency']
     y_position = add_table(pdf, ct_dependency_list, margin, y_position, y_position - margin, w - 2 * margin)
 
     pdf.showPage()
@@ -404,3 +405,5 @@ def rep_main(file_name, datasheet, recon_type):
     # Finalize PDF
     pdf.save()
     print('\nPDF generation completed.')
+
+    return report_file
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Background creation of the PDF reports
+
+The reports are created by a queue in a background thread, from the results of the
+calibration (tables and HLUTs in memory, figures in the output folder). A calibration
+returns as soon as its results are ready, the report job is returned as Future: its
+status can be polled with done(), result() waits for the report and returns the file
+name of the PDF (None if the report could not be created). At the end of the program,
+the reports still in the queue are completed before the interpreter exits.
+If the memory of the run is traced or the report is profiled, the report is created in
+the calling thread once the queue is empty, since memory tracing and profiling are global
+to the process (see profiling.stage).
+
+% SPDX-License-Identifier: MIT
+"""
+
+import copy
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from utils import profiling
+
+# Items of the datasheet used by the report:
+REPORT_ITEMS = ['output', 'output_parameter', 'PhantomInserts', 'HLUTs', 'tables']
+
+# Reports created at the same time:
+REPORT_WORKERS = 1
+
+_executor = None
+_jobs = []
+_lock = threading.Lock()
+
+
+def submit(file_name, datasheet, recon_type, trace=None):
+    """
+    Add a report to the queue
+    Input:  file_name - name of the Excel file, shown in the PDF report
+            datasheet - Dictionary containing all calculated and measured data, the items used
+                        by the report are copied, so the datasheet can be changed afterwards
+            recon_type - Reconstruction type (regular or DD)
+            trace - trace of the run (see profiling.new_trace): the report is added as stage
+                    and trace.json is written again when the report is finished
+    Output: job - Future of the report (already finished for a traced or profiled report)
+    """
+
+    global _executor
+
+    data = copy.deepcopy({key: datasheet[key] for key in REPORT_ITEMS if key in datasheet})
+
+    # Traced or profiled reports are created in the calling thread, without other reports running:
+    if trace is not None and (trace['memory'] or 'Report' in trace['profile']):
+        wait_all()
+        job = Future()
+        job.set_result(create_report(file_name, data, recon_type, trace))
+        return job
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix='report')
+        job = _executor.submit(create_report, file_name, data, recon_type, trace)
+        _jobs[:] = [i for i in _jobs if not i.done()] + [job]
+
+    return job
+
+
+def create_report(file_name, datasheet, recon_type, trace=None):
+    """
+    Create a report, errors are reported but not raised
+    Input:  see submit
+    Output: file name of the PDF report, or None if it could not be created
+    """
+
+    from utils import report
+
+    report_file = None
+    with profiling.stage(trace, 'Report', datasheet):
+        try:
+            report_file = report.rep_main(file_name, datasheet, recon_type)
+            profiling.record_file(datasheet, report_file)
+        except Exception:
+            print('Something went wrong in the PDF report creation. \n'
+                  'Everything else worked. Individual results are stored as figures '
+                  'or .txt files in the Results folder.')
+    if trace is not None:
+        profiling.finish_trace(trace, datasheet['output'])
+
+    return report_file
+
+
+def wait_all():
+    """
+    Wait for the reports in the queue
+    Output: list with the file names of the PDF reports of the queued jobs (None for failed reports)
+    """
+
+    with _lock:
+        jobs = list(_jobs)
+        _jobs.clear()
+    wait(jobs)
+
+    return [job.result() for job in jobs]
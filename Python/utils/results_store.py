@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Results store: SQLite database with the history of all calibrations
+
+Every run is recorded with its inputs (hash of the Excel file, scanner, phantom, recon type,
+output parameter, proton energy and measured CT numbers) and its results (k values, HLUT
+connection points, accuracy metrics and tables of the evaluation boxes). The runs are
+indexed by scanner, phantom, recon type, output parameter and date, and the results by run,
+so that the history of a scanner is queried without reading the Results folders.
+
+The database is written to the Results folder (results.sqlite) by main.py and in batch mode.
+Scanner, phantom and protocol are taken from the name of the Excel file, if it follows the
+naming of the examples: DataForCTCalibration_<phantom>phantom_<vendor>_<model>_<protocol>.xlsx
+
+% SPDX-License-Identifier: MIT
+"""
+
+import os
+import json
+import sqlite3
+from datetime import datetime
+
+# File name of the database in the Results folder:
+STORE_NAME = 'results.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    date TEXT NOT NULL,
+    file_name TEXT,
+    input_hash TEXT,
+    scanner TEXT,
+    phantom TEXT,
+    protocol TEXT,
+    recon_type TEXT,
+    output_parameter TEXT,
+    e_prot REAL,
+    output TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_by_scanner ON runs (scanner, phantom, recon_type, output_parameter, date);
+CREATE INDEX IF NOT EXISTS runs_by_phantom ON runs (phantom, date);
+CREATE INDEX IF NOT EXISTS runs_by_date ON runs (date);
+CREATE INDEX IF NOT EXISTS runs_by_hash ON runs (input_hash);
+
+CREATE TABLE IF NOT EXISTS ct_numbers (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    phantom_size TEXT NOT NULL,
+    insert_index INTEGER NOT NULL,
+    insert_name TEXT,
+    value REAL,
+    PRIMARY KEY (run_id, phantom_size, insert_index)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS k_values (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    hluttype TEXT NOT NULL,
+    selection TEXT NOT NULL,
+    k1 REAL,
+    k2 REAL,
+    k3 REAL,
+    PRIMARY KEY (run_id, hluttype, selection)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS hlut_points (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    hluttype TEXT NOT NULL,
+    point INTEGER NOT NULL,
+    ctn REAL,
+    value REAL,
+    PRIMARY KEY (run_id, hluttype, point)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS accuracy (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    hluttype TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    tissue_group TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (run_id, hluttype, metric, tissue_group)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS evaluation_tables (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    rows TEXT,
+    PRIMARY KEY (run_id, name)
+) WITHOUT ROWID;
+'''
+
+# Columns of the runs used to select runs, and the tables with the results per run:
+RUN_FILTERS = ['scanner', 'phantom', 'protocol', 'recon_type', 'output_parameter', 'input_hash']
+RESULT_TABLES = ['ct_numbers', 'k_values', 'hlut_points', 'accuracy', 'evaluation_tables']
+
+# Phantom sizes of the CT number columns of the Excel file:
+CTN_COLUMNS = {'head': 'CT number (Head)', 'body': 'CT number (Body)', 'body periphery': 'CT number (Body periphery)'}
+
+
+def connect(store):
+    """
+    Open the database and create the tables, if needed
+    Input:  store - file name of the database
+    Output: connection - sqlite3 connection
+    """
+
+    connection = sqlite3.connect(store, timeout=60)
+    connection.execute('PRAGMA foreign_keys = ON')
+    # Several processes of a batch run can write at the same time:
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.executescript(SCHEMA)
+
+    return connection
+
+
+def file_info(file_name):
+    """
+    Phantom, scanner and protocol from the name of the Excel file
+    Input:  file_name - e.g. DataForCTCalibration_GammexAEDphantom_Siemens_goOpenPro_120kVp.xlsx
+    Output: Dictionary with phantom, scanner (vendor and model) and protocol, None if not in the name
+    """
+
+    parts = os.path.splitext(os.path.basename(file_name))[0].split('_')
+    if parts[0] == 'DataForCTCalibration':
+        parts = parts[1:]
+    if len(parts) == 0 or not parts[0].endswith('phantom'):
+        return {'phantom': None, 'scanner': None, 'protocol': None}
+
+    return {'phantom': parts[0][:-len('phantom')] or None,
+            'scanner': '_'.join(parts[1:3]) or None,
+            'protocol': '_'.join(parts[3:]) or None}
+
+
+def record_run(store, result, file_name, input_hash, recon_type, e_prot, output=None, date=None, **info):
+    """
+    Record a run in the database
+    Input:  store - file name of the database
+            result - result of hlut_generation_and_evaluation.run or evaluate
+            file_name - name of the Excel file
+            input_hash - SHA-256 hash of the Excel file (see initialize_data.file_hash)
+            recon_type - Reconstruction type (regular or DD)
+            e_prot - initial energy of the proton beam (MeV)
+            output - folder with the result files
+            date - date of the run (datetime), default: now
+            info - phantom, scanner and protocol, which replace the values from the file name
+    Output: run_id - id of the run in the database
+    """
+
+    datasheet = result['datasheet']
+    output_parameter = datasheet['output_parameter']
+    run = file_info(file_name)
+    run.update({key: value for key, value in info.items() if value is not None})
+    date = (datetime.now() if date is None else date).isoformat(timespec='seconds')
+
+    connection = connect(store)
+    try:
+        with connection:
+            run_id = connection.execute(
+                'INSERT INTO runs (date, file_name, input_hash, scanner, phantom, protocol, recon_type, '
+                'output_parameter, e_prot, output) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (date, os.path.basename(file_name), input_hash, run['scanner'], run['phantom'], run['protocol'],
+                 recon_type, output_parameter, float(e_prot) if output_parameter == 'SPR' else None,
+                 output)).lastrowid
+
+            ctnumbers = datasheet['CTnumbers']
+            connection.executemany(
+                'INSERT INTO ct_numbers VALUES (?, ?, ?, ?, ?)',
+                [(run_id, size, index, str(name), none_if_nan(value))
+                 for size, column in CTN_COLUMNS.items() if column in ctnumbers
+                 for index, (name, value) in enumerate(zip(ctnumbers['Insert name'], ctnumbers[column]))])
+            connection.executemany(
+                'INSERT INTO k_values VALUES (?, ?, ?, ?, ?, ?)',
+                [(run_id, hluttype, selection, *map(float, k))
+                 for hluttype, selections in result['k_values'].items() for selection, k in selections.items()])
+            connection.executemany(
+                'INSERT INTO hlut_points VALUES (?, ?, ?, ?, ?)',
+                [(run_id, hluttype, point, float(ctn), float(value))
+                 for hluttype, hlut in result['HLUTs'].items()
+                 for point, (ctn, value) in enumerate(zip(hlut['ctn'], hlut[output_parameter]))])
+            connection.executemany(
+                'INSERT INTO accuracy VALUES (?, ?, ?, ?, ?)',
+                [(run_id, hluttype, metric, group, none_if_nan(value))
+                 for hluttype, metrics in result['accuracy'].items()
+                 for metric, groups in metrics.items() for group, value in groups.items()])
+            connection.executemany(
+                'INSERT INTO evaluation_tables VALUES (?, ?, ?)',
+                [(run_id, name, json.dumps(rows)) for name, rows in result.get('tables', {}).items()])
+    finally:
+        connection.close()
+
+    return run_id
+
+
+def none_if_nan(value):
+    """
+    Float value, None for NaN (NULL in the database)
+    """
+
+    value = float(value)
+    return None if value != value else value
+
+
+def run_filter(start=None, end=None, **filters):
+    """
+    WHERE clause for the runs
+    Input:  start, end - first and last date (datetime or ISO string), or None
+            filters - values of the columns in RUN_FILTERS, a value or a list of values
+    Output: clause - SQL condition on the table runs (alias r)
+            parameters - parameters of the condition
+    """
+
+    conditions, parameters = [], []
+    for column, value in filters.items():
+        if column not in RUN_FILTERS:
+            raise ValueError("Invalid filter '{}'. It should be one of {}.".format(column, RUN_FILTERS))
+        if value is None:
+            continue
+        values = [value] if isinstance(value, str) else list(value)
+        conditions.append('r.{} IN ({})'.format(column, ', '.join('?' * len(values))))
+        parameters += values
+    for operator, date in [('>=', start), ('<=', end)]:
+        if date is not None:
+            conditions.append('r.date {} ?'.format(operator))
+            parameters.append(date.isoformat(timespec='seconds') if isinstance(date, datetime) else date)
+
+    return ' AND '.join(conditions) or '1', parameters
+
+
+def query_runs(store, start=None, end=None, **filters):
+    """
+    Runs in the database, ordered by date
+    Input:  store - file name of the database
+            start, end, filters - selection of the runs (see run_filter), e.g. scanner='Siemens_goOpenPro'
+    Output: runs - DataFrame with one row per run
+    """
+
+    import pandas as pd
+
+    clause, parameters = run_filter(start, end, **filters)
+    connection = connect(store)
+    try:
+        return pd.read_sql_query('SELECT * FROM runs r WHERE {} ORDER BY r.date, r.run_id'.format(clause),
+                                 connection, params=parameters)
+    finally:
+        connection.close()
+
+
+def history(store, table, start=None, end=None, columns=None, run_columns=True, **filters):
+    """
+    Results of the selected runs, e.g. for trend analysis
+    Input:  store - file name of the database
+            table - one of RESULT_TABLES
+            start, end, filters - selection of the runs (see run_filter)
+            columns - columns of the table to load, default: all
+            run_columns - if False, only the run_id identifies the run (faster for many runs)
+    Output: results - DataFrame with the rows of the table, with the date, scanner, phantom, protocol,
+                      recon type and output parameter of the run, ordered by date
+    """
+
+    import pandas as pd
+
+    if table not in RESULT_TABLES:
+        raise ValueError("Invalid table '{}'. It should be one of {}.".format(table, RESULT_TABLES))
+
+    selection = 't.*' if columns is None else ', '.join('t.' + i for i in ['run_id'] + list(columns))
+    if run_columns:
+        selection = 'r.date, r.scanner, r.phantom, r.protocol, r.recon_type, r.output_parameter, ' + selection
+    clause, parameters = run_filter(start, end, **filters)
+    connection = connect(store)
+    try:
+        results = pd.read_sql_query(
+            'SELECT {} FROM runs r JOIN {} t ON t.run_id = r.run_id WHERE {} ORDER BY r.date, r.run_id'.format(
+                selection, table, clause), connection, params=parameters)
+    finally:
+        connection.close()
+
+    if 'rows' in results:
+        results['rows'] = [json.loads(rows) for rows in results['rows']]
+
+    return results
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduling of the stages of a calibration run
+
+Each stage declares the items of the datasheet it reads and writes. An item is a key of
+the datasheet (e.g. 'HLUTs'), a single column of a sheet (e.g. ('CTnumbers', 'CT number
+(middle - outer)')) or a single table of an evaluation box (e.g. ('tables', 'Eval_box_1_beamhardening')).
+A sheet item stands for the columns present before the stages are run,
+columns added by a stage are separate items. A stage waits for the earlier stages that write
+an item it reads or writes, and for the earlier stages that read an item it writes.
+Independent stages are run concurrently in worker processes, which receive the items they
+read and return the items they write.
+
+% SPDX-License-Identifier: MIT
+"""
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from utils import profiling
+
+# Items of the datasheet passed to every stage (settings of the run):
+CONTEXT = ['output_parameter', 'output']
+
+
+def stage_dependencies(stages):
+    """
+    Dependencies between the stages, from their read and write sets
+    Input:  stages - Dictionary of the stages in the order of the sequential execution, each a
+                     Dictionary with the function, its arguments after the datasheet (args) and
+                     the lists of the items read and written (reads, writes)
+    Output: dependencies - Dictionary with the set of earlier stages each stage has to wait for
+    """
+
+    names = list(stages)
+    dependencies = {}
+    for j, name in enumerate(names):
+        reads, writes = set(stages[name]['reads']), set(stages[name]['writes'])
+        dependencies[name] = {earlier for earlier in names[:j]
+                              if set(stages[earlier]['writes']) & (reads | writes)
+                              or set(stages[earlier]['reads']) & writes}
+
+    return dependencies
+
+
+def run_stages(datasheet, stages, workers=1, trace=None):
+    """
+    Run the stages, one after another in this process or concurrently in a process pool.
+    In the process pool, the figures of the stages are passed to the figure sink of the
+    datasheet when the respective stage is finished.
+    Input:  datasheet - Dictionary containing all calculated and measured data
+            stages - see stage_dependencies
+            workers - number of worker processes, 1 to run the stages in the declared order in this process
+            trace - trace of the run for the records of the stages (see profiling.new_trace), or None
+    Output: datasheet, with the items written by the stages
+    """
+
+    if workers == 1:
+        for name, stage in stages.items():
+            with profiling.stage(trace, name, datasheet):
+                stage['function'](datasheet, *stage['args'])
+        return datasheet
+
+    # The worker processes add the records of their stages to a copy of the trace:
+    worker_trace = None if trace is None else dict(trace, stages=[])
+
+    dependencies = stage_dependencies(stages)
+    figure_sink = datasheet.get('figure_sink')
+    done, running = set(), {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while len(done) < len(stages):
+            # Submit the stages whose dependencies are finished:
+            for name, stage in stages.items():
+                if name not in done and name not in running.values() and dependencies[name] <= done:
+                    future = executor.submit(run_stage, name, stage['function'], stage['args'],
+                                             stage_input(datasheet, stage), stage['writes'], figure_sink is not None,
+                                             worker_trace)
+                    running[future] = name
+
+            # Merge the items written by the finished stages:
+            finished = wait(running, return_when=FIRST_COMPLETED)[0]
+            for future in finished:
+                written, figures, records = future.result()
+                for item, value in written.items():
+                    if isinstance(item, str):
+                        datasheet[item] = value
+                    else:
+                        datasheet[item[0]][item[1]] = value
+                for figure_name, fig in figures:
+                    figure_sink(figure_name, fig)
+                if trace is not None:
+                    trace['stages'].extend(records)
+                done.add(running.pop(future))
+
+    return datasheet
+
+
+def stage_input(datasheet, stage):
+    """
+    Part of the datasheet sent to a worker process
+    Input:  datasheet - Dictionary containing all calculated and measured data
+            stage - stage to be run
+    Output: data - Dictionary with the settings of the run and the sheets and items the stage reads or writes
+    """
+
+    keys = CONTEXT + [item if isinstance(item, str) else item[0] for item in stage['reads'] + stage['writes']]
+
+    return {key: datasheet[key] for key in keys if key in datasheet}
+
+
+def run_stage(name, function, args, data, writes, collect_figures, trace):
+    """
+    Run a stage in a worker process
+    Input:  name - name of the stage
+            function, args - stage function and its arguments after the datasheet
+            data - part of the datasheet from stage_input
+            writes - items written by the stage
+            collect_figures - if True, the figures are collected for the figure sink of the main process
+            trace - trace of the run without records, or None
+    Output: written - Dictionary with the written items
+            figures - list of the collected figures (name, figure)
+            records - records of the stage for the trace of the run
+    """
+
+    figures = []
+    data['figure_sink'] = (lambda figure_name, fig: figures.append((figure_name, fig))) if collect_figures else None
+    with profiling.stage(trace, name, data):
+        function(data, *args)
+    # Items that are not applicable to the run (e.g. the SPR table without measured SPR) are not written:
+    written = {item: data[item] if isinstance(item, str) else data[item[0]][item[1]] for item in writes
+               if (item in data if isinstance(item, str) else item[1] in data[item[0]])}
+
+    return written, figures, [] if trace is None else trace['stages']
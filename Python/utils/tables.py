@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Output of tables
+
+The evaluation boxes store their tables in the datasheet (datasheet['tables']), from
+where the PDF report takes them. Writing the tables as text files to the output folder
+is optional and done after the report.
+
+% SPDX-License-Identifier: MIT
+"""
+
+from utils import profiling
+
+# Separator of the columns in the text files:
+DELIMITER = '    '
+
+
+def save_table(datasheet, name, rows):
+    """
+    Store a table in the datasheet
+    Input:  datasheet - Dictionary containing all calculated and measured data
+            name - name of the table, also the file name of the text file without extension
+            rows - rows of the table, each a list of strings, starting with the header
+    """
+
+    datasheet.setdefault('tables', {})[name] = [[str(value).strip() for value in row] for row in rows]
+
+
+def write_tables(datasheet, folder='for_report'):
+    """
+    Write the tables of the datasheet as text files, one row per line and the columns separated by DELIMITER
+    Input:  datasheet - Dictionary containing all calculated and measured data
+            folder - subfolder of the output folder for the text files
+    """
+
+    if datasheet['output'] is None:
+        return
+
+    for name, rows in datasheet.get('tables', {}).items():
+        file_name = '{}/{}/{}.txt'.format(datasheet['output'], folder, name)
+        with open(file_name, 'w') as f:
+            for row in rows:
+                f.write(DELIMITER.join(row) + '\n')
+        profiling.record_file(datasheet, file_name)
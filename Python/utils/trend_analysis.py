@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""
+Constancy checks: trends of the calibrations over time
+
+The calibrations of the repeated phantom scans are taken from the results store (see
+results_store), archived Excel files are calibrated and recorded first (archive_workbooks).
+Every series of calibrations (scanner, phantom, protocol, recon type and output parameter)
+is compared with its baseline, the first calibration of the series or the mean of the
+calibrations up to a given date:
+- drift of the CT number of every insert (HU) and of the k values (%), and their drift rates
+- deviation of the HLUTs from the baseline HLUT (%)
+Runs are flagged if they exceed a tolerance (see TOLERANCES): the CT number tolerance for the
+drift of the CT numbers and for the difference between center and periphery, the tolerance of
+the maximum deviation from the baseline HLUT at any CT number and the tolerances of the accuracy
+metrics of the HLUTs.
+
+All series are evaluated at once with grouped operations on the tables of the results store,
+so the history of dozens of scanners over years is analysed in seconds.
+
+% SPDX-License-Identifier: MIT
+"""
+
+import os
+import traceback
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import results_store
+
+# Columns of the runs that define a series of calibrations:
+SERIES = ['scanner', 'phantom', 'protocol', 'recon_type', 'output_parameter']
+
+# Columns of the result tables used for the trends:
+TREND_COLUMNS = {'ct_numbers': ['phantom_size', 'insert_index', 'insert_name', 'value'],
+                 'k_values': ['hluttype', 'selection', 'k1', 'k2', 'k3'],
+                 'hlut_points': ['hluttype', 'point', 'ctn', 'value'],
+                 'accuracy': ['hluttype', 'metric', 'tissue_group', 'value']}
+
+# Checks of the runs, with the names used in the summary:
+CHECKS = {'ctn_drift': 'CT number drift', 'position': 'Center vs. periphery', 'hlut_deviation': 'HLUT deviation',
+          'accuracy': 'HLUT accuracy'}
+
+# Default tolerances of the checks, above which a run is flagged:
+# ctn, ctn_relative - drift of the CT numbers and difference between center and periphery: the larger
+#                     of an absolute tolerance (HU) and a fraction of the CT number
+# hlut_deviation - maximum deviation from the baseline HLUT at any CT number (%)
+# ME, MAE, RMSE - accuracy metrics of the HLUTs (%, absolute value for the ME)
+TOLERANCES = {'ctn': 20, 'ctn_relative': 0.05, 'hlut_deviation': 2.0, 'ME': 1.0, 'MAE': 1.5, 'RMSE': 2.0}
+
+# CT numbers at which the HLUTs are compared with the baseline HLUT:
+HLUT_GRID = np.arange(-1000, 2001, 10)
+
+# Number of HLUTs interpolated at once (limits the memory):
+HLUT_CHUNK = 4096
+
+
+def main(store, start=None, end=None, baseline_end=None, output=None, tolerances=None, **filters):
+    """
+    Trend analysis of the calibrations in the results store
+    Input:  store - file name of the results store (e.g. Results/results.sqlite)
+            start, end, filters - selection of the runs (see results_store.run_filter),
+                                  e.g. scanner=['Siemens_goOpenPro', 'GE_Revolution']
+            baseline_end - date of the last run of the baseline (see reference_runs), None for the first run
+            output - folder to write the tables of the trends to (.csv), or None
+            tolerances - Dictionary with the tolerances that differ from TOLERANCES
+    Output: trends - Dictionary of DataFrames (see analyse)
+    """
+
+    trends = analyse(load_store(store, start, end, **filters), baseline_end, tolerances)
+    print('\n' + flag_table(trends['runs']))
+
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+        for name, frame in trends.items():
+            frame.to_csv(os.path.join(output, 'trend_{}.csv'.format(name)), index=False)
+
+    return trends
+
+
+def archive_workbooks(store, file_names, output_parameter='SPR', recon_type='regular', e_prot=100, dates=None,
+                      workers=1, **info):
+    """
+    Calibrate archived Excel files and record them in the results store. Files that are already
+    recorded with the same content, output parameter, recon type and proton energy are skipped.
+    Input:  store - file name of the results store
+            file_names - list of Excel files
+            output_parameter, recon_type, e_prot - see hlut_generation_and_evaluation.run
+            dates - list with the date of each calibration (datetime), default: modification time of the files
+            workers - number of worker processes
+            info - phantom, scanner and protocol, if not given by the file names (see results_store.file_info)
+    Output: run_ids - list with the id of the run of each file in the store (None if the calibration failed)
+    """
+
+    from utils import control_input
+    from utils.calculation import initialize_data
+
+    control_input.check_parameters(output_parameter, recon_type)
+    if len(file_names) == 0:
+        return []
+    if dates is None:
+        dates = [datetime.fromtimestamp(os.path.getmtime(i)) for i in file_names]
+    hashes = [initialize_data.file_hash(i) for i in file_names]
+
+    # Runs already in the store (the proton energy is only recorded for SPR):
+    recorded = results_store.query_runs(store, input_hash=sorted(set(hashes)), output_parameter=output_parameter,
+                                        recon_type=recon_type)
+    if output_parameter == 'SPR':
+        recorded = recorded[recorded['e_prot'] == float(e_prot)]
+    recorded = dict(zip(recorded['input_hash'], recorded['run_id']))
+
+    # One calibration per new file content:
+    jobs = {}
+    for file_name, input_hash, date in zip(file_names, hashes, dates):
+        if input_hash not in recorded and input_hash not in jobs:
+            jobs[input_hash] = (store, file_name, input_hash, output_parameter, recon_type, e_prot, date, info)
+    print('{} of {} files are already in the results store, {} calibrations to run.'.format(
+        len(file_names) - sum(i not in recorded for i in hashes), len(file_names), len(jobs)))
+
+    workers = max(1, min(workers, len(jobs)))
+    if workers == 1:
+        run_ids = [archive_workbook(*job) for job in jobs.values()]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(archive_workbook, *job) for job in jobs.values()]
+            run_ids = [future.result() for future in futures]
+    recorded.update(zip(jobs, run_ids))
+
+    return [recorded.get(i) for i in hashes]
+
+
+def archive_workbook(store, file_name, input_hash, output_parameter, recon_type, e_prot, date, info):
+    """
+    Calibrate one Excel file, without result files, and record it in the results store.
+    Errors are reported but not raised, so that one failing file does not stop the others.
+    Input:  see archive_workbooks
+    Output: run_id - id of the run in the store, or None if the calibration failed
+    """
+
+    from utils import hlut_generation_and_evaluation
+    from utils.calculation import initialize_data
+
+    # The parameters are checked by archive_workbooks:
+    try:
+        sheets = initialize_data.read_workbook(file_name)
+        calibration = hlut_generation_and_evaluation.calibrate(sheets, recon_type, e_prot)
+        result = hlut_generation_and_evaluation.evaluate(calibration, output_parameter, recon_type,
+                                                         file_name=os.path.basename(file_name), export_tables=False)
+        return results_store.record_run(store, result, file_name, input_hash, recon_type, e_prot, date=date,
+                                        **info)
+    except Exception:
+        traceback.print_exc()
+        print('--- {} could not be calibrated.'.format(file_name))
+        return None
+
+
+def load_store(store, start=None, end=None, **filters):
+    """
+    Load the results of the selected runs from the results store
+    Input:  store - file name of the results store
+            start, end, filters - selection of the runs (see results_store.run_filter)
+    Output: history - Dictionary with the DataFrames 'runs', 'ct_numbers', 'k_values', 'hlut_points'
+                      and 'accuracy', ordered by date, with the date, the series (see SERIES) and the
+                      number of the series ('series') of every run
+    """
+
+    runs = results_store.query_runs(store, start, end, **filters)
+    runs['date'] = pd.to_datetime(runs['date'])
+    runs['series'] = runs.groupby(SERIES, dropna=False, sort=False).ngroup()
+
+    # The results are loaded without the columns of the runs, which are added by the run_id:
+    history = {'runs': runs}
+    for table, columns in TREND_COLUMNS.items():
+        results = results_store.history(store, table, start, end, columns, run_columns=False, **filters)
+        history[table] = results.join(runs.set_index('run_id')[['date', 'series'] + SERIES], on='run_id')
+
+    return history
+
+
+def analyse(history, baseline_end=None, tolerances=None):
+    """
+    Trends of all series of calibrations
+    Input:  history - results of the runs (see load_store)
+            baseline_end - date of the last run of the baseline (see reference_runs), None for the first run
+            tolerances - Dictionary with the tolerances that differ from TOLERANCES
+    Output: trends - Dictionary of DataFrames:
+                     'ct_numbers' - CT number of every insert and run, with the drift from the baseline (HU)
+                     'ct_rates' - drift rate of the CT number of every insert in each series (HU/year)
+                     'position' - CT number difference between center and periphery of the body phantom (HU)
+                     'k_values' - k values of every run, with the drift from the baseline (%)
+                     'k_rates' - drift rate of the k values in each series (%/year)
+                     'hlut' - mean and maximum deviation of the HLUTs from the baseline HLUT (%)
+                     'accuracy' - accuracy metrics of the HLUTs (%)
+                     'runs' - one row per run with the largest drifts and the flags of all checks
+                     The rows exceeding a tolerance are flagged (column 'flag').
+    """
+
+    tolerances = check_tolerances(tolerances)
+
+    # Drift of the CT numbers of every insert and phantom size:
+    ctn = history['ct_numbers'].copy()
+    ctn_series = ['series', 'phantom_size', 'insert_index']
+    ctn['baseline'] = baseline(ctn, ctn_series, 'value', baseline_end)
+    ctn['drift'] = ctn['value'] - ctn['baseline']
+    ctn['flag'] = ctn['drift'].abs() > ctn_tolerance(ctn['baseline'], tolerances)
+
+    # CT number difference between center and periphery:
+    columns = ['date', 'series'] + SERIES + ['run_id', 'insert_index', 'insert_name', 'value']
+    position = history['ct_numbers'].loc[history['ct_numbers']['phantom_size'] == 'body', columns].merge(
+        history['ct_numbers'].loc[history['ct_numbers']['phantom_size'] == 'body periphery',
+                                  ['run_id', 'insert_index', 'value']],
+        on=['run_id', 'insert_index'], suffixes=('_middle', '_outer')).dropna(subset=['value_middle', 'value_outer'])
+    position['difference'] = position['value_middle'] - position['value_outer']
+    position['flag'] = position['difference'].abs() > ctn_tolerance(position['value_middle'], tolerances)
+
+    # Relative drift of the k values:
+    k_values = history['k_values'].copy()
+    k_columns = ['k1', 'k2', 'k3']
+    k_drift = [i + '_drift' for i in k_columns]
+    k_series = ['series', 'hluttype', 'selection']
+    k_baseline = baseline(k_values, k_series, k_columns, baseline_end)
+    k_values[k_drift] = (100 * (k_values[k_columns] - k_baseline) / k_baseline.where(k_baseline != 0)).to_numpy()
+
+    # Deviation of the HLUTs from the baseline HLUT, flagged above its tolerance at any CT number:
+    hlut = hlut_deviation(history['hlut_points'], baseline_end)
+    hlut['flag'] = hlut['max_abs_deviation'] > tolerances['hlut_deviation']
+
+    # Accuracy metrics (the ME is a signed metric):
+    accuracy = history['accuracy'].copy()
+    accuracy['flag'] = accuracy['value'].abs() > accuracy['metric'].map(tolerances)
+
+    # Summary per run:
+    runs = history['runs'][['run_id', 'date'] + SERIES + ['file_name', 'input_hash']].copy()
+    runs['max_ctn_drift'] = runs['run_id'].map(ctn['drift'].abs().groupby(ctn['run_id']).max())
+    runs['max_k_drift'] = runs['run_id'].map(k_values[k_drift].abs().max(axis=1).groupby(k_values['run_id']).max())
+    runs['max_hlut_deviation'] = runs['run_id'].map(hlut.groupby('run_id')['max_abs_deviation'].max())
+    for check, frame in zip(CHECKS, [ctn, position, hlut, accuracy]):
+        runs[check] = runs['run_id'].isin(frame.loc[frame['flag'], 'run_id'])
+    runs['flagged'] = runs[list(CHECKS)].any(axis=1)
+
+    # Drift rates, with the columns of the series and the insert names of the last run:
+    series = history['runs'].drop_duplicates('series').set_index('series')[SERIES]
+    ct_rates = drift_rates(ctn, ctn_series, ['value']).join(series, on='series')
+    ct_rates['insert_name'] = ctn.drop_duplicates(ctn_series, keep='last').set_index(ctn_series).loc[
+        pd.MultiIndex.from_frame(ct_rates[ctn_series]), 'insert_name'].to_numpy()
+    k_rates = drift_rates(k_values, k_series, k_drift).join(series, on='series')
+
+    return {'ct_numbers': ctn,
+            'ct_rates': ct_rates,
+            'position': position,
+            'k_values': k_values,
+            'k_rates': k_rates,
+            'hlut': hlut,
+            'accuracy': accuracy,
+            'runs': runs}
+
+
+def check_tolerances(tolerances=None):
+    """
+    Complete the tolerances of the checks with the defaults
+    Input:  tolerances - Dictionary with the tolerances that differ from TOLERANCES, or None
+    Output: tolerances - Dictionary with all tolerances
+    Raises ValueError for an unknown or negative tolerance.
+    """
+
+    tolerances = dict(TOLERANCES, **(tolerances or {}))
+    for name, value in tolerances.items():
+        if name not in TOLERANCES:
+            raise ValueError("Unknown tolerance '{}'. It should be one of {}.".format(name, ', '.join(TOLERANCES)))
+        if not value >= 0:
+            raise ValueError("Invalid tolerance {} = {}. It should not be negative.".format(name, value))
+
+    return tolerances
+
+
+def ctn_tolerance(ctn, tolerances):
+    """
+    Tolerance of CT number differences
+    Input:  ctn - CT numbers (HU), scalar or array
+            tolerances - Dictionary with all tolerances (see check_tolerances)
+    Output: tolerance (HU), the larger of the absolute tolerance and the relative tolerance times the CT number
+    """
+
+    return np.maximum(tolerances['ctn'], tolerances['ctn_relative'] * np.abs(ctn))
+
+
+def reference_runs(frame, baseline_end=None):
+    """
+    Rows of the runs that form the baseline of their series
+    Input:  frame - results of the runs, ordered by date (see load_store)
+            baseline_end - date of the last run of the baseline (datetime or ISO string),
+                           None for the first run of each series
+    Output: reference - boolean Series, True for the rows of the baseline runs
+    """
+
+    if baseline_end is None:
+        return frame['run_id'] == frame.groupby('series')['run_id'].transform('first')
+
+    return frame['date'] <= pd.Timestamp(baseline_end)
+
+
+def baseline(frame, keys, columns, baseline_end=None):
+    """
+    Baseline of every series: the mean value of the reference runs (see reference_runs)
+    Input:  frame - results of the runs, ordered by date (see load_store)
+            keys - columns that identify a series, e.g. the series and the insert
+            columns - column or list of columns with the values
+            baseline_end - see reference_runs
+    Output: baseline - baseline value for every row of frame (NaN if the series has no reference run)
+    """
+
+    values = frame[columns].copy()
+    values[~reference_runs(frame, baseline_end)] = np.nan
+
+    return values.groupby([frame[i] for i in keys], dropna=False).transform('mean')
+
+
+def drift_rates(frame, keys, columns):
+    """
+    Drift rate of every series: slope of the linear regression of the values over time,
+    for all series at once from the grouped sums of the regression
+    Input:  frame - results of the runs with the date
+            keys - columns that identify a series
+            columns - list of columns with the values
+    Output: rates - DataFrame with one row per series: number of runs, first and last date,
+                    and the slope of each column per year (NaN for series with one run)
+    """
+
+    years = (frame['date'] - frame['date'].min()).dt.total_seconds() / (365.25 * 24 * 3600)
+    terms = {}
+    for column in columns:
+        value = frame[column]
+        time = years.where(value.notna())
+        terms.update({(column, 'n'): value.notna(), (column, 't'): time, (column, 'v'): value,
+                      (column, 'tv'): time * value, (column, 'tt'): time ** 2})
+    groups = [frame[i] for i in keys]
+    sums = pd.DataFrame(terms).groupby(groups, dropna=False).sum()
+
+    rates = frame['date'].groupby(groups, dropna=False).agg(['count', 'min', 'max'])
+    rates.columns = ['runs', 'first', 'last']
+    for column in columns:
+        n, t, v, tv, tt = (sums[(column, i)] for i in ['n', 't', 'v', 'tv', 'tt'])
+        denominator = n * tt - t ** 2
+        rates[column + '_per_year'] = ((n * tv - t * v) / denominator.where(denominator > 1e-12)).to_numpy()
+
+    return rates.reset_index()
+
+
+def hlut_deviation(hlut_points, baseline_end=None, grid=HLUT_GRID):
+    """
+    Deviation of every HLUT from the baseline HLUT of its series and HLUT type (see reference_runs),
+    with the HLUTs compared at the CT numbers of the grid
+    Input:  hlut_points - connection points of the HLUTs (see load_store)
+            baseline_end - see reference_runs
+            grid - CT numbers at which the HLUTs are compared
+    Output: hlut - DataFrame with one row per run and HLUT type: mean, mean absolute and maximum
+                   absolute deviation (%) and the CT number of the maximum deviation
+    """
+
+    columns = ['date', 'series'] + SERIES + ['run_id', 'hluttype']
+    points = hlut_points.sort_values(['date', 'run_id', 'hluttype', 'point'], kind='stable')
+    hlut = points.drop_duplicates(['run_id', 'hluttype'])[columns].reset_index(drop=True)
+    for column in ['mean_deviation', 'mean_abs_deviation', 'max_abs_deviation', 'ctn_max_deviation']:
+        hlut[column] = np.nan
+    if len(hlut) == 0:
+        return hlut
+
+    # Connection points of all HLUTs as arrays (HLUTs, points), padded with the last point:
+    curve = points.groupby(['run_id', 'hluttype'], sort=False).ngroup().to_numpy()
+    index = points.groupby(['run_id', 'hluttype'], sort=False).cumcount().to_numpy()
+    n_points = np.bincount(curve)
+    ctn, value = np.full((2, len(hlut), n_points.max()), np.nan)
+    ctn[curve, index] = points['ctn'].to_numpy()
+    value[curve, index] = points['value'].to_numpy()
+    padding = np.minimum(np.arange(n_points.max()), n_points[:, np.newaxis] - 1)
+    ctn = np.take_along_axis(ctn, padding, axis=1)
+    value = np.take_along_axis(value, padding, axis=1)
+
+    # Baseline HLUT of every series and HLUT type:
+    series = hlut.groupby(['series', 'hluttype'], sort=False).ngroup().to_numpy()
+    reference = np.flatnonzero(reference_runs(hlut, baseline_end).to_numpy())
+    sums = np.zeros((series.max() + 1, len(grid)))
+    for rows in np.array_split(reference, max(1, int(np.ceil(len(reference) / HLUT_CHUNK)))):
+        np.add.at(sums, series[rows], interpolate_hluts(ctn[rows], value[rows], grid))
+    with np.errstate(invalid='ignore'):
+        baselines = sums / np.bincount(series[reference], minlength=len(sums))[:, np.newaxis]
+
+    # Deviation of all HLUTs, in chunks:
+    results = np.full((len(hlut), 4), np.nan)
+    for rows in np.array_split(np.arange(len(hlut)), int(np.ceil(len(hlut) / HLUT_CHUNK))):
+        deviation = 100.0 * (interpolate_hluts(ctn[rows], value[rows], grid) - baselines[series[rows]])
+        results[rows, 0] = deviation.mean(axis=1)
+        results[rows, 1] = np.abs(deviation).mean(axis=1)
+        results[rows, 2] = np.abs(deviation).max(axis=1)
+        results[rows, 3] = grid[np.abs(deviation).argmax(axis=1)]
+    results[np.isnan(results[:, 2]), 3] = np.nan
+    hlut[['mean_deviation', 'mean_abs_deviation', 'max_abs_deviation', 'ctn_max_deviation']] = results
+
+    return hlut
+
+
+def interpolate_hluts(ctn, value, grid):
+    """
+    Piecewise linear HLUTs at the CT numbers of the grid, constant beyond the first and the last
+    connection point (as numpy.interp), for many HLUTs at once
+    Input:  ctn, value - connection points of the HLUTs (HLUTs, points), padded with the last point
+            grid - CT numbers
+    Output: values - array (HLUTs, grid)
+    """
+
+    x = np.clip(grid, ctn[:, :1], ctn[:, -1:])
+
+    # Segment of every CT number (index of its first connection point):
+    segment = np.zeros(x.shape, dtype=int)
+    for j in range(1, ctn.shape[1] - 1):
+        segment += ctn[:, j:j + 1] < x
+
+    rows = np.arange(len(ctn))[:, np.newaxis]
+    x_0, x_1 = ctn[rows, segment], ctn[rows, segment + 1]
+    y_0, y_1 = value[rows, segment], value[rows, segment + 1]
+    width = x_1 - x_0
+    weight = np.divide(x - x_0, width, out=np.zeros(x.shape), where=width > 0)
+
+    return y_0 + weight * (y_1 - y_0)
+
+
+def flag_table(runs):
+    """
+    Format the runs that exceed a tolerance as a table
+    Input:  runs - summary of the runs (see analyse)
+    Output: table - string with one line per flagged run
+    """
+
+    header = ['Date', 'Scanner', 'Phantom', 'Recon', 'Output', 'File name', 'Exceeded tolerances']
+    rows = []
+    for run in runs[runs['flagged']].itertuples(index=False):
+        rows.append([run.date.strftime('%Y-%m-%d')]
+                    + [value if isinstance(value, str) else '-' for value in
+                       [run.scanner, run.phantom, run.recon_type, run.output_parameter, run.file_name]]
+                    + [', '.join(name for check, name in CHECKS.items() if getattr(run, check))])
+
+    widths = [max(len(row[j]) for row in [header] + rows) for j in range(len(header))]
+    lines = ['    '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip()
+             for row in [header] + rows]
+    lines.insert(1, '-' * len(lines[0]))
+    lines.append('{} of {} runs exceed a tolerance.'.format(len(rows), len(runs)))
+
+    return '\n'.join(lines)